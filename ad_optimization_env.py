@@ -0,0 +1,300 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# The TorchRL environment of the project.
+#
+# torchrl loads its whole stack (collectors, modules, objectives, trainers) when any of its
+# submodules is imported. AdOptimizationEnv is therefore kept out of digital_advertising, which
+# imports this module on first use of AdOptimizationEnv, so that importing digital_advertising only
+# needs torch, numpy and pandas.
+
+import numpy as np
+import torch
+from typing import Optional
+from tensordict import TensorDict
+from torchrl.data import OneHot, Unbounded, Binary, Composite
+from torchrl.envs import EnvBase
+from digital_advertising import KeywordPanel, feature_columns, unpack_observation
+
+
+class AdOptimizationEnv(EnvBase):
+    """
+    AdOptimizationEnv is an environment for optimizing digital advertising strategies using reinforcement learning.
+
+    Attributes:
+        initial_cash (float): Initial cash balance for the environment.
+        dataset (pd.DataFrame or KeywordPanel): Dataset containing keyword metrics.
+        panel (KeywordPanel): The dataset as dense array [num_steps, num_keywords, num_columns].
+        num_features (int): Number of features for each keyword.
+        num_keywords (int): Number of keywords in the dataset.
+        num_steps (int): Number of time steps in the dataset.
+        action_spec (OneHot): Action specification for the environment.
+        reward_spec (Unbounded): Reward specification for the environment.
+        observation_spec (Composite): Observation specification for the environment.
+        done_spec (Composite): Done specification for the environment.
+        observation_dim (int): Size of the packed observation (keyword features, cash and holdings).
+        current_step (int): Current step in the environment.
+        holdings (torch.Tensor): Tensor representing the current holdings of keywords.
+        cash (float): Current cash balance.
+        obs (TensorDict): Current observation of the environment.
+
+    Methods:
+        __init__(self, dataset, initial_cash=100000.0, device="cpu", observation_slots=None, writer=None):
+            Initializes the AdOptimizationEnv with the given dataset, initial cash, and device.
+        _reset(self, tensordict=None):
+            Resets the environment to the initial state and returns the initial observation.
+        _write_observation(self):
+            Writes the current observation into the next slot of the preallocated observation buffer.
+        _step(self, tensordict):
+            Takes a step in the environment using the given action and returns the next state, reward, and done flag.
+        _compute_reward(self, action, keyword_roas, action_idx, ad_roas):
+            Computes the reward based on the selected keyword's metrics.
+        _set_seed(self, seed: Optional[int]):
+            Sets the random seed for the environment.
+    """
+
+    def __init__(self, dataset, initial_cash=100000.0, device="cpu", observation_slots=None, writer=None):
+        """
+        Initializes the digital advertising environment.
+
+        Args:
+            dataset (pd.DataFrame or KeywordPanel): The dataset containing keyword features and other relevant data.
+                A panel is used directly (e.g. a memory-mapped panel shared by several processes), a DataFrame
+                is converted into a panel once.
+            initial_cash (float, optional): The initial amount of cash available for advertising. Defaults to 100000.0.
+            device (str, optional): The device to run the environment on, either "cpu" or "cuda". Defaults to "cpu".
+            observation_slots (int, optional): Number of slots in the preallocated observation buffer. By default
+                every observation is packed into a single slot and handed out as a copy, which is safe for any
+                consumer. With observation_slots (at least 2), the observations are views into the buffer and a slot
+                is overwritten observation_slots steps later, so the consumer must not keep more observations without
+                copying them (e.g. a SyncDataCollector that stacks a whole batch needs more slots than frames per
+                batch). Defaults to None (copies).
+            writer (SummaryWriter, optional): TensorBoard writer for the step rewards. Defaults to no logging.
+
+        Attributes:
+            initial_cash (float): The initial amount of cash available for advertising.
+            dataset (Any): The dataset containing keyword features and other relevant data.
+            num_features (int): The number of features in the dataset.
+            num_keywords (int): The number of keywords in the dataset.
+            action_spec (OneHot): The specification for the action space, which includes selecting a keyword to buy or choosing to buy nothing.
+            reward_spec (Unbounded): The specification for the reward space, which is unbounded and of type torch.float32.
+            observation_spec (Composite): The specification for the observation space, which includes the packed observation (keyword features, cash and holdings) and step count.
+            done_spec (Composite): The specification for the done space, which includes flags for done, terminated, and truncated states.
+        """
+        super().__init__(device=device)
+        self.initial_cash = initial_cash
+        self.writer = writer
+        self.dataset = dataset
+        self.panel = dataset if isinstance(dataset, KeywordPanel) else KeywordPanel.from_dataframe(dataset)
+        self.num_features = len(feature_columns)
+        self.num_keywords = self.panel.num_keywords
+        self.num_steps = self.panel.num_steps
+        self.action_spec = OneHot(n=self.num_keywords + 1) # select which one to buy or the last one to buy nothing
+        self.reward_spec = Unbounded(shape=(1,), dtype=torch.float32)
+        # Packed observation: [keyword_features (num_keywords * num_features), cash (1), holdings (num_keywords)]
+        self.observation_dim = self.num_keywords * self.num_features + 1 + self.num_keywords
+        self.observation_spec = Composite(
+            observation = Composite(
+                flat=Unbounded(shape=(self.observation_dim,), dtype=torch.float32)
+            ),
+            step_count=Unbounded(shape=(1,), dtype=torch.int64)
+        )
+        self.done_spec = Composite(
+            done=Binary(shape=(1,), dtype=torch.bool),
+            terminated=Binary(shape=(1,), dtype=torch.bool),
+            truncated=Binary(shape=(1,), dtype=torch.bool)
+        )
+
+        feature_means, feature_stds = self.panel.feature_stats(feature_columns)
+        self.feature_means = torch.tensor(feature_means, dtype=torch.float32, device=device)
+        self.feature_stds = torch.tensor(feature_stds, dtype=torch.float32, device=device)
+        # Prevent division by zero
+        self.feature_stds = torch.where(self.feature_stds > 0, self.feature_stds, torch.ones_like(self.feature_stds))
+
+        # Cash normalization
+        self.cash_mean = initial_cash / 2
+        self.cash_std = initial_cash / 4
+
+        # Raw keyword features of all time steps, on the CPU a view into the (possibly memory-mapped) panel.
+        # They are normalized per step in _write_observation, so the environment holds no copy of the data.
+        keyword_features = torch.from_numpy(self.panel.features(feature_columns))
+        self.keyword_features = keyword_features if torch.device(device).type == "cpu" else keyword_features.to(device)
+
+        # Reward columns [num_steps, num_keywords]
+        self._ad_spend = self.panel.column("ad_spend")
+        self._conversion_value = self.panel.column("conversion_value")
+        self._ad_roas = self.panel.column("ad_roas")
+
+        # Preallocated observation buffer, the observations handed out are copies of its single slot or,
+        # with observation_slots, views into its slots
+        if observation_slots is not None and observation_slots < 2:
+            raise ValueError(f"observation_slots must be at least 2 (the current and the next observation), got {observation_slots}")
+        self._copy_observations = observation_slots is None
+        num_slots = 1 if observation_slots is None else observation_slots
+        self._observation_buffer = torch.zeros(num_slots, self.observation_dim, dtype=torch.float32, device=device)
+        self._observation_views = [
+            unpack_observation(self._observation_buffer[slot], self.num_keywords, self.num_features)
+            for slot in range(num_slots)
+        ]
+        self._observation_slot = 0
+
+        self.reset()
+
+    def _reset(self, tensordict: TensorDict =None):
+        """
+        Resets the environment to its initial state.
+
+        Args:
+            tensordict (TensorDict, optional): A TensorDict to be updated with the reset state. If None, a new TensorDict is created.
+
+        Returns:
+            TensorDict: A TensorDict containing the reset state of the environment, including:
+                - "done" (torch.tensor): A boolean tensor indicating if the episode is done.
+                - "observation" (TensorDict): A TensorDict containing the initial observation with:
+                    - "flat" (torch.tensor): The packed keyword features, initial cash balance and holdings.
+                - "step_count" (torch.tensor): The current step count, initialized to 0.
+                - "terminated" (torch.tensor): A boolean tensor indicating if the episode is terminated.
+                - "truncated" (torch.tensor): A boolean tensor indicating if the episode is truncated.
+        """
+        self.current_step = 0
+        self.holdings = torch.zeros(self.num_keywords, dtype=torch.int, device=self.device) # 0 = not holding, 1 = holding keyword
+        self.cash = self.initial_cash
+
+        # Create the initial observation.
+        obs = self._write_observation()
+
+        if tensordict is None:
+            tensordict = TensorDict({}, batch_size=[])
+        else:
+            tensordict = tensordict.empty()
+
+        tensordict = tensordict.update({
+            "done": torch.tensor(False, dtype=torch.bool, device=self.device),
+            "observation": obs,
+            "step_count": torch.tensor(self.current_step, dtype=torch.int64, device=self.device),
+            "terminated": torch.tensor(False, dtype=torch.bool, device=self.device),
+            "truncated": torch.tensor(False, dtype=torch.bool, device=self.device)
+        })
+        
+        self.obs = obs
+        return tensordict
+
+
+    def _step(self, tensordict: TensorDict):
+        """
+        Perform a single step in the environment using the provided tensor dictionary.
+
+        Args:
+            tensordict (TensorDict): A dictionary containing the current state and action.
+
+        Returns:
+            TensorDict: A dictionary containing the next state, reward, and termination status.
+
+        The function performs the following steps:
+        1. Extracts the action from the input tensor dictionary.
+        2. Determines the index of the selected keyword.
+        3. Retrieves the current entry from the dataset based on the current step.
+        4. Updates the holdings based on the selected action.
+        5. Calculates the reward based on the action taken.
+        6. Advances to the next time step and checks for termination conditions.
+        7. Retrieves the next keyword features for the subsequent state.
+        8. Updates the observation state with the new keyword features, cash balance, and holdings.
+        9. Updates the tensor dictionary with the new state, reward, and termination status.
+        10. Returns the updated tensor dictionary containing the next state, reward, and termination status.
+        """
+        # Get the action from the input tensor dictionary. 
+        action = tensordict["action"]
+        true_indices = torch.nonzero(action, as_tuple=True)[0]
+        action_idx = true_indices[0] if len(true_indices) > 0 else self.action_spec.n - 1
+
+        step = self.current_step
+
+        # Update cash based on the action
+        ad_roas = 0.0
+        if action_idx < self.num_keywords:
+            # Get the selected keyword's ad spend
+            keyword_idx = int(action_idx)
+            ad_cost = float(self._ad_spend[step, keyword_idx])
+            ad_revenue = float(self._conversion_value[step, keyword_idx])
+            ad_roas = float(self._ad_roas[step, keyword_idx])
+
+            # we assume the marketing budget is 10% of the cash
+            if (self.cash * 0.1) >= ad_cost:
+                # When enough balance, update cash with ad revenue and deduct ad cost
+                self.cash -= ad_cost
+                self.cash += ad_revenue
+
+        # Update holdings based on action (only one keyword is selected)
+        self.holdings.zero_()
+        if action_idx < self.num_keywords:
+            self.holdings[action_idx] = 1
+
+        # Calculate the reward based on the action taken.
+        reward = self._compute_reward(action, self._ad_roas[step], action_idx, ad_roas)
+
+         # Move to the next time step.
+        self.current_step += 1
+        terminated = self.cash < 0 or self.current_step >= self.num_steps - 2 # -2 to avoid going over the last index
+        truncated = False
+
+        # Get next pki for the keywords, cash balance and holdings
+        next_obs = self._write_observation()
+        
+        # Update the state
+        self.obs = next_obs
+        print(f'Step (_step): {self.current_step}, Action: {action_idx}, Reward: {reward}, Cash: {self.cash}')
+        if self.writer is not None:
+            self.writer.add_scalar("Reward", reward, self.current_step)
+
+        # tensordict is used from EnvBase later on, so we add the current state here
+        tensordict["done"] = torch.as_tensor(bool(terminated or truncated), dtype=torch.bool, device=self.device)
+        tensordict["observation"] = self.obs
+        tensordict["reward"] = torch.tensor(reward, dtype=torch.float32, device=self.device)
+        tensordict["step_count"] = torch.tensor(self.current_step-1, dtype=torch.int64, device=self.device)
+        tensordict["terminated"] = torch.tensor(bool(terminated), dtype=torch.bool, device=self.device)
+        tensordict["truncated"] = torch.tensor(bool(truncated), dtype=torch.bool, device=self.device)
+        # next as return value is also used by EnvBase and later added to tensordict by EnvBase
+        next = TensorDict({
+            "done": torch.tensor(bool(terminated or truncated), dtype=torch.bool, device=self.device),
+            "observation": next_obs,
+            "reward": torch.tensor(reward, dtype=torch.float32, device=self.device),
+            "step_count": torch.tensor(self.current_step, dtype=torch.int64, device=self.device),
+            "terminated": torch.tensor(bool(terminated), dtype=torch.bool, device=self.device),
+            "truncated": torch.tensor(bool(truncated), dtype=torch.bool, device=self.device)
+        }, batch_size=tensordict.batch_size)
+        
+        return next
+
+    def _write_observation(self):
+        """
+        Writes the normalized keyword features, cash and holdings of the current step into the next slot
+        of the preallocated observation buffer.
+
+        Returns:
+            TensorDict: The observation, its "flat" entry is a copy of the slot or, with observation_slots,
+                a view into the observation buffer.
+        """
+        self._observation_slot = (self._observation_slot + 1) % len(self._observation_views)
+        keyword_features, cash, holdings = self._observation_views[self._observation_slot]
+        torch.sub(self.keyword_features[self.current_step], self.feature_means, out=keyword_features)
+        keyword_features.div_(self.feature_stds)
+        cash.fill_((self.cash - self.cash_mean) / self.cash_std)
+        holdings.copy_(self.holdings)
+        flat = self._observation_buffer[self._observation_slot]
+        return TensorDict({"flat": flat.clone() if self._copy_observations else flat}, batch_size=[])
+
+    def _compute_reward(self, action, keyword_roas, action_idx, ad_roas):
+        """Compute reward based on the selected keyword's metrics (keyword_roas: ad_roas of all keywords of the step)"""
+        adjusted_reward = 0 if action_idx < self.num_keywords else 1 # encourage the agent to buy something​
+        if ad_roas > 0: # log(0) is undefined
+            adjusted_reward = np.log(ad_roas)  ## Adjust reward based on ad_roas performance, scale it with log
+        # Calculate the ad_roas we did not get because we chose another keyword​
+        not_selected = (action[:self.num_keywords] == 0).cpu().numpy()
+        missing_rewards = keyword_roas[not_selected].astype(np.float64)
+        # Adjust reward based on missing rewards to penalize the agent when not selecting keywords with high(er) ROAS
+        # clipping reduces the variance of the rewards
+        return np.clip(adjusted_reward - np.mean(missing_rewards) * 0.2, -2, 2)
+
+    def _set_seed(self, seed: Optional[int]):
+        rng = torch.manual_seed(seed)
+        self.rng = rng
@@ -5,6 +5,7 @@ import plotly.graph_objects as go
 import plotly.express as px
 from dash import Dash, dcc, html, Input, Output, State, callback_context, no_update
 import dash_bootstrap_components as dbc
+from dataset_cache import load_dataset
 
 # Define the feature columns
 feature_columns = [
@@ -14,8 +15,8 @@ feature_columns = [
 ]
 
 def read_and_organize_csv(file_path):
-    """Reads and organizes the CSV data"""
-    df = pd.read_csv(file_path)
+    """Reads and organizes the CSV data (through the columnar cache, see dataset_cache.py)"""
+    df = load_dataset(file_path, columns=["keyword"] + feature_columns)  # Only the columns the app shows
     if 'step' in df.columns:
         df = df.drop(columns=['step'])
     return df
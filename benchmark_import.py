@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Import-time benchmark for the modules of this project.
+#
+# Every measurement imports the module in a fresh interpreter (python -X importtime) from an empty
+# temporary working directory, so the numbers include the full startup cost a worker process or a
+# command line call pays. The script also checks that the import has no side effects: nothing may be
+# printed, no files or directories (e.g. a TensorBoard runs/ directory) may be created and none of the
+# heavy packages in --forbid (by default torchrl and tensordict, which are imported on first use) may be
+# loaded. It exits with status 1 if any check fails.
+
+import os
+import sys
+import time
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Packages a bare import of a project module must not load
+FORBIDDEN_PACKAGES = ["torchrl", "tensordict"]
+
+# Marker of the line with the loaded modules, written to stderr after the import
+LOADED_MODULES_MARKER = "loaded modules:"
+
+
+def parse_importtime(stderr):
+    """
+    Parses the output of python -X importtime.
+
+    Returns:
+        list: (package, self time in us, cumulative time in us) of the top-level imports
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        # Nested imports are indented below the package that imports them
+        if name.startswith(" ") and not name.startswith("  "):
+            imports.append((name.strip(), int(self_us), int(cumulative_us)))
+    return imports
+
+
+def parse_loaded_packages(stderr):
+    """Returns the top-level packages in sys.modules after the import (see LOADED_MODULES_MARKER)."""
+    for line in reversed(stderr.splitlines()):
+        if line.startswith(LOADED_MODULES_MARKER):
+            return sorted({name.split(".")[0] for name in line[len(LOADED_MODULES_MARKER):].split()})
+    return []
+
+
+def measure_import(module, repeats=5):
+    """
+    Imports a module repeatedly in fresh interpreters.
+
+    Args:
+        module (str): Name of the module
+        repeats (int): Number of measurements
+
+    Returns:
+        dict: Wall times in seconds, top-level imports of the last run, stdout, created files and the
+            top-level packages loaded by the import
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [PROJECT_DIR, os.environ.get("PYTHONPATH")])))
+    code = f"import sys, {module}; sys.stderr.write('\\n{LOADED_MODULES_MARKER} ' + ' '.join(sys.modules))"
+    wall_times = []
+    for _ in range(repeats):
+        with tempfile.TemporaryDirectory() as cwd:
+            t0 = time.perf_counter()
+            result = subprocess.run(
+                [sys.executable, "-X", "importtime", "-c", code],
+                cwd=cwd, env=env, capture_output=True, text=True
+            )
+            wall_times.append(time.perf_counter() - t0)
+            created_files = sorted(os.listdir(cwd))
+        if result.returncode != 0:
+            raise RuntimeError(f"Importing {module} failed:\n{result.stderr[-2000:]}")
+
+    return {
+        'wall_times': wall_times,
+        'imports': parse_importtime(result.stderr),
+        'stdout': result.stdout,
+        'created_files': created_files,
+        'loaded_packages': parse_loaded_packages(result.stderr)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time and check the import side effects of project modules")
+    parser.add_argument("modules", type=str, nargs="*", default=["digital_advertising"], help="Modules to import")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of fresh interpreters per module")
+    parser.add_argument("--top", type=int, default=10, help="Number of slowest top-level imports to show")
+    parser.add_argument("--forbid", type=str, nargs="*", default=FORBIDDEN_PACKAGES,
+                        help="Packages the import must not load (pass --forbid without names to disable the check)")
+    args = parser.parse_args()
+
+    side_effects = False
+    for module in args.modules:
+        report = measure_import(module, repeats=args.repeats)
+        wall_times = report['wall_times']
+        print(f"{module}: median {statistics.median(wall_times) * 1000:.0f} ms, "
+              f"min {min(wall_times) * 1000:.0f} ms, max {max(wall_times) * 1000:.0f} ms ({args.repeats} runs)")
+
+        for name, self_us, cumulative_us in sorted(report['imports'], key=lambda item: -item[2])[:args.top]:
+            print(f"  {cumulative_us / 1000:>8.1f} ms  {name}")
+
+        if report['stdout']:
+            side_effects = True
+            print(f"  Import printed output: {report['stdout'].strip()[:200]!r}")
+        if report['created_files']:
+            side_effects = True
+            print(f"  Import created files: {report['created_files']}")
+        forbidden = [name for name in args.forbid if name in report['loaded_packages']]
+        if forbidden:
+            side_effects = True
+            print(f"  Import loaded forbidden packages: {forbidden}")
+
+    sys.exit(1 if side_effects else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Bulk scoring of many advertiser accounts and time steps with an exported serving policy
+# (see ModelHandler.export_serving_model and policy_runtime.py).
+#
+# Input is a panel of raw keyword metrics with shape [accounts, steps, keywords, features] plus the
+# cash and holdings state of every account. All (account, step) rows are scored in large batches and
+# the actions and Q-values are streamed chunk by chunk into .npy files in the output directory.
+
+import os
+import time
+import argparse
+import numpy as np
+
+from policy_runtime import load_serving_policy
+
+
+def _expand_state(state, num_accounts, num_steps, rows, row_ndim):
+    """
+    Returns the state (cash or holdings) of the given flat (account, step) rows.
+
+    The state can either be given per account and step ([accounts, steps, ...]) or once per
+    account ([accounts, ...]), in which case it is repeated for every step. row_ndim is the
+    number of dimensions of the state of a single row (0 for cash, 1 for holdings).
+    """
+    if state.ndim == row_ndim + 2:
+        return state.reshape(num_accounts * num_steps, *state.shape[2:])[rows]
+    return state[rows // num_steps]
+
+
+def score_panel(policy, keyword_features, cash, holdings=None, output_dir="bulk_scores",
+                batch_size=4096, num_threads=None, save_q_values=True, log_every=10):
+    """
+    Scores a panel of observations with a serving policy and streams the results to disk.
+
+    Args:
+        policy (callable): Serving policy, e.g. from policy_runtime.load_serving_policy. Maps raw
+            (keyword_features [batch, K, F], cash [batch], holdings [batch, K]) to (actions, q_values).
+        keyword_features (np.ndarray): Raw keyword metrics with shape [accounts, steps, K, F]. Can be a memory map.
+        cash (np.ndarray): Raw cash balance with shape [accounts, steps] or [accounts].
+        holdings (np.ndarray, optional): Holdings with shape [accounts, steps, K] or [accounts, K]. Defaults to no holdings.
+        output_dir (str): Directory for actions.npy ([accounts, steps]) and q_values.npy ([accounts, steps, K + 1]).
+        batch_size (int): Number of (account, step) rows per forward pass.
+        num_threads (int, optional): Number of intra-op threads for torch. Defaults to the torch default.
+        save_q_values (bool): Whether to write the Q-values in addition to the actions.
+        log_every (int): Print the progress every log_every batches.
+
+    Returns:
+        dict: Paths of the output files, number of rows and rows per second.
+    """
+    if num_threads is not None:
+        import torch
+        torch.set_num_threads(num_threads)
+
+    num_accounts, num_steps, num_keywords, num_features = keyword_features.shape
+    num_rows = num_accounts * num_steps
+    # Flat view over all (account, step) rows, no copy for C-contiguous arrays and memory maps
+    flat_features = keyword_features.reshape(num_rows, num_keywords, num_features)
+    cash = np.asarray(cash, dtype=np.float32)
+    if holdings is None:
+        holdings = np.zeros((num_accounts, num_keywords), dtype=np.float32)
+
+    os.makedirs(output_dir, exist_ok=True)
+    actions_path = os.path.join(output_dir, "actions.npy")
+    q_values_path = os.path.join(output_dir, "q_values.npy")
+    actions_out = np.lib.format.open_memmap(actions_path, mode="w+", dtype=np.int64, shape=(num_accounts, num_steps))
+    q_values_out = None
+    if save_q_values:
+        q_values_out = np.lib.format.open_memmap(q_values_path, mode="w+", dtype=np.float32, shape=(num_accounts, num_steps, num_keywords + 1))
+    # Flat views over the (account, step) rows, writes go directly into the memory maps
+    flat_actions = actions_out.reshape(num_rows)
+    flat_q_values = q_values_out.reshape(num_rows, num_keywords + 1) if q_values_out is not None else None
+
+    num_batches = (num_rows + batch_size - 1) // batch_size
+    t0 = time.time()
+    for batch_idx, start in enumerate(range(0, num_rows, batch_size)):
+        stop = min(start + batch_size, num_rows)
+        rows = np.arange(start, stop)
+
+        actions, q_values = policy(
+            flat_features[start:stop],
+            _expand_state(cash, num_accounts, num_steps, rows, row_ndim=0),
+            _expand_state(holdings, num_accounts, num_steps, rows, row_ndim=1)
+        )
+        flat_actions[start:stop] = actions
+        if flat_q_values is not None:
+            flat_q_values[start:stop] = q_values
+
+        if log_every and (batch_idx + 1) % log_every == 0:
+            elapsed = time.time() - t0
+            print(f"Batch {batch_idx + 1}/{num_batches}: {stop} rows, {stop / elapsed:.0f} rows/s")
+
+    # Write the remaining pages of the memory maps to disk
+    actions_out.flush()
+    if q_values_out is not None:
+        q_values_out.flush()
+    elapsed = time.time() - t0
+
+    rows_per_second = num_rows / elapsed if elapsed > 0 else float("inf")
+    print(f"Scored {num_rows} rows ({num_accounts} accounts x {num_steps} steps) in {elapsed:.2f}s, {rows_per_second:.0f} rows/s")
+    return {
+        'actions_path': actions_path,
+        'q_values_path': q_values_path if save_q_values else None,
+        'rows': num_rows,
+        'rows_per_second': rows_per_second
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bulk scoring of advertiser accounts with an exported serving policy")
+    parser.add_argument("--model", type=str, default="saves/best_model_serving.pt", help="Serving artifact (TorchScript .pt or .onnx)")
+    parser.add_argument("--features", type=str, required=True, help=".npy file with raw keyword metrics [accounts, steps, keywords, features]")
+    parser.add_argument("--cash", type=str, default=None, help=".npy file with the cash balance [accounts, steps] or [accounts]")
+    parser.add_argument("--holdings", type=str, default=None, help=".npy file with holdings [accounts, steps, keywords] or [accounts, keywords]")
+    parser.add_argument("--initial_cash", type=float, default=100000.0, help="Cash balance of every account if --cash is not given")
+    parser.add_argument("--output_dir", type=str, default="bulk_scores", help="Output directory for actions.npy and q_values.npy")
+    parser.add_argument("--batch_size", type=int, default=4096, help="Number of (account, step) rows per forward pass")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of torch intra-op threads")
+    parser.add_argument("--no_q_values", action="store_true", help="Only write the actions")
+    args = parser.parse_args()
+
+    policy = load_serving_policy(args.model)
+
+    # Memory-map the inputs so that only the rows of the current batch are read
+    keyword_features = np.load(args.features, mmap_mode="r")
+    num_accounts = keyword_features.shape[0]
+    cash = np.load(args.cash, mmap_mode="r") if args.cash else np.full(num_accounts, args.initial_cash, dtype=np.float32)
+    holdings = np.load(args.holdings, mmap_mode="r") if args.holdings else None
+
+    score_panel(
+        policy,
+        keyword_features,
+        cash,
+        holdings,
+        output_dir=args.output_dir,
+        batch_size=args.batch_size,
+        num_threads=args.num_threads,
+        save_q_values=not args.no_q_values
+    )
+
+
+if __name__ == "__main__":
+    main()
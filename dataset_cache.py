@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Columnar cache of the CSV datasets.
+#
+# Parsing the CSV file is the largest part of the startup time of every tool. The first load converts
+# the CSV file into one .npy file per column (text columns as category codes) next to it, in
+# <csv directory>/.dataset_cache/<csv filename>/. Later loads only read the requested columns. The
+# dense KeywordPanel of the dataset (what AdOptimizationEnv uses) is cached in the same directory on
+# first use and memory-mapped.
+#
+# The cache is keyed on the size, the modification time and the SHA-256 hash of the CSV file. If size
+# and modification time are unchanged the cache is used directly. Otherwise the hash decides: a file
+# that was only touched keeps its cache, a changed file rebuilds it. Caches are built in a temporary
+# directory and renamed into place, so concurrent processes never read a half-written cache.
+#
+# Only numpy and pandas are needed (the panel additionally imports digital_advertising), so
+# lightweight tools like analyze_raw_data.py can use the cache without importing torch.
+
+import os
+import json
+import shutil
+import hashlib
+import argparse
+import numpy as np
+import pandas as pd
+
+CACHE_DIRNAME = ".dataset_cache"
+FORMAT_VERSION = 1
+
+
+def file_sha256(filepath, chunk_size=1 << 20):
+    """Returns the SHA-256 hex digest of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class DatasetCache:
+    """
+    The columnar cache of one CSV file.
+
+    Attributes:
+        path (str): The CSV file
+        cache_dir (str): Directory of the cache (meta.json, columns/*.npy, panel/)
+    """
+
+    META_FILENAME = "meta.json"
+    COLUMNS_DIRNAME = "columns"
+    PANEL_DIRNAME = "panel"
+
+    def __init__(self, path, cache_dir=None):
+        """
+        Args:
+            path (str): The CSV file
+            cache_dir (str, optional): Directory of the cache, defaults to
+                <csv directory>/.dataset_cache/<csv filename>
+        """
+        self.path = path
+        self.cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIRNAME, os.path.basename(path))
+
+    @property
+    def meta_path(self):
+        return os.path.join(self.cache_dir, self.META_FILENAME)
+
+    def read_meta(self):
+        """Returns the metadata of the cache or None if there is no cache."""
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def _write_meta(self, directory, meta):
+        meta_path = os.path.join(directory, self.META_FILENAME)
+        tmp_path = f"{meta_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, meta_path)
+
+    def is_valid(self):
+        """
+        Returns True if the cache matches the CSV file: same size and modification time, or the same
+        content hash (the modification time of the cache is updated in that case).
+        """
+        meta = self.read_meta()
+        if meta is None or meta.get('format_version') != FORMAT_VERSION:
+            return False
+        stat = os.stat(self.path)
+        if meta['size'] == stat.st_size and meta['mtime_ns'] == stat.st_mtime_ns:
+            return True
+        if meta['size'] != stat.st_size or file_sha256(self.path) != meta['sha256']:
+            return False
+        # Same content (e.g. the file was copied or touched), keep the cache
+        meta['mtime_ns'] = stat.st_mtime_ns
+        self._write_meta(self.cache_dir, meta)
+        return True
+
+    def build(self):
+        """Converts the CSV file into the columnar cache (replaces an existing cache)."""
+        stat = os.stat(self.path)
+        sha256 = file_sha256(self.path)
+        dataset = pd.read_csv(self.path)
+
+        tmp_dir = f"{self.cache_dir}.{os.getpid()}.tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(os.path.join(tmp_dir, self.COLUMNS_DIRNAME))
+        columns = []
+        for i, name in enumerate(dataset.columns):
+            series = dataset[name]
+            filename = f"{i}.npy"
+            column = {'name': name, 'file': filename}
+            if series.dtype == object:
+                # Text columns are stored as category codes, the categories in the metadata
+                categorical = pd.Categorical(series)
+                np.save(os.path.join(tmp_dir, self.COLUMNS_DIRNAME, filename), categorical.codes)
+                column['categories'] = [str(c) for c in categorical.categories]
+            else:
+                np.save(os.path.join(tmp_dir, self.COLUMNS_DIRNAME, filename), series.values)
+            columns.append(column)
+
+        self._write_meta(tmp_dir, {
+            'format_version': FORMAT_VERSION,
+            'source': os.path.abspath(self.path),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': sha256,
+            'num_rows': len(dataset),
+            'columns': columns
+        })
+        self._swap_in(tmp_dir, self.cache_dir)
+        print(f"Dataset cache for {self.path} written to {self.cache_dir}")
+        return dataset
+
+    @staticmethod
+    def _swap_in(tmp_dir, target):
+        """Renames a completed temporary directory to target, replacing an outdated target."""
+        if os.path.exists(target):
+            old_dir = f"{target}.{os.getpid()}.old"
+            try:
+                os.rename(target, old_dir)
+            except OSError:
+                pass  # Another process replaced it at the same time
+            shutil.rmtree(old_dir, ignore_errors=True)
+        try:
+            os.rename(tmp_dir, target)
+        except OSError:
+            # Another process renamed its (equivalent) cache into place first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def ensure(self):
+        """Builds the cache if it is missing or outdated."""
+        if not self.is_valid():
+            self.build()
+
+    def load(self, columns=None):
+        """
+        Loads the dataset from the cache (built first if needed).
+
+        Args:
+            columns (list, optional): Columns to load, defaults to all columns in the order of the CSV file
+
+        Returns:
+            pd.DataFrame: The dataset
+        """
+        self.ensure()
+        meta = self.read_meta()
+        by_name = {column['name']: column for column in meta['columns']}
+        names = list(columns) if columns is not None else [column['name'] for column in meta['columns']]
+        missing = [name for name in names if name not in by_name]
+        if missing:
+            raise KeyError(f"Columns {missing} not in {self.path}")
+
+        data = {}
+        for name in names:
+            column = by_name[name]
+            values = np.load(os.path.join(self.cache_dir, self.COLUMNS_DIRNAME, column['file']))
+            if 'categories' in column:
+                values = pd.Categorical.from_codes(values, categories=column['categories']).astype(object)
+            data[name] = values
+        return pd.DataFrame(data)
+
+    def load_panel(self, mmap=True):
+        """
+        Loads the KeywordPanel of the dataset, memory-mapped. The panel is built from the cached
+        columns on first use.
+
+        Returns:
+            KeywordPanel: The panel
+        """
+        from digital_advertising import KeywordPanel
+
+        self.ensure()
+        panel_dir = os.path.join(self.cache_dir, self.PANEL_DIRNAME)
+        if not os.path.exists(os.path.join(panel_dir, KeywordPanel.META_FILENAME)):
+            tmp_dir = f"{panel_dir}.{os.getpid()}.tmp"
+            KeywordPanel.from_dataframe(self.load()).save(tmp_dir)
+            self._swap_in(tmp_dir, panel_dir)
+        return KeywordPanel.load(panel_dir, mmap=mmap)
+
+
+def load_dataset(path, columns=None):
+    """
+    Loads a CSV dataset through its columnar cache (see DatasetCache).
+
+    Args:
+        path (str): The CSV file
+        columns (list, optional): Columns to load, defaults to all columns
+
+    Returns:
+        pd.DataFrame: The dataset
+    """
+    return DatasetCache(path).load(columns)
+
+
+def load_panel(path, mmap=True):
+    """Loads the KeywordPanel of a CSV dataset through its cache (memory-mapped, see DatasetCache.load_panel)."""
+    return DatasetCache(path).load_panel(mmap=mmap)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or inspect the columnar cache of a CSV dataset")
+    parser.add_argument("path", type=str, nargs="?", default="data/organized_dataset.csv", help="CSV dataset")
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild the cache even if it is valid")
+    parser.add_argument("--panel", action="store_true", help="Also build the KeywordPanel of the dataset")
+    args = parser.parse_args()
+
+    cache = DatasetCache(args.path)
+    if args.rebuild:
+        cache.build()
+    else:
+        cache.ensure()
+    if args.panel:
+        panel = cache.load_panel()
+        print(f"Panel: {panel.num_steps} steps x {panel.num_keywords} keywords x {len(panel.columns)} columns")
+
+    meta = cache.read_meta()
+    print(f"{args.path}: {meta['num_rows']} rows, {len(meta['columns'])} columns, sha256 {meta['sha256'][:16]}, cache {cache.cache_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,364 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Local HTTP decision service with dynamic micro-batching.
+#
+# Concurrent per-account observation requests are collected into micro-batches (up to max_batch_size
+# requests or max_wait_ms milliseconds) and each micro-batch is scored with a single forward pass.
+# The service only uses the Python standard library for HTTP (asyncio streams).
+#
+# Endpoints:
+#   POST /decide   {"keyword_features": [[...], ...], "cash": 100000.0, "holdings": [0, 1, ...]}
+#                  -> {"action": 3, "keyword": "Keyword_3", "q_values": [...]}
+#   GET  /metrics  latency percentiles and batch size histogram
+#   GET  /health   model information (num_keywords, feature_columns)
+#
+# The "loadgen" subcommand is a local load generator for testing.
+
+import os
+import json
+import time
+import asyncio
+import argparse
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+STATUS_TEXT = {200: "200 OK", 400: "400 Bad Request", 404: "404 Not Found", 500: "500 Internal Server Error"}
+
+
+class MicroBatcher:
+    """
+    Collects concurrent requests into micro-batches and runs one forward pass per batch.
+
+    Attributes:
+        model_fn (callable): Maps stacked (keyword_features, cash, holdings) arrays to (actions, q_values).
+        max_batch_size (int): Maximum number of requests per forward pass.
+        max_wait (float): Maximum time in seconds the first request of a batch waits for more requests.
+        latencies (deque): Latencies of the most recent requests in seconds.
+        batch_sizes (Counter): Histogram of the batch sizes.
+    """
+
+    def __init__(self, model_fn, max_batch_size=64, max_wait_ms=2.0, latency_window=10000):
+        self.model_fn = model_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.latencies = deque(maxlen=latency_window)
+        self.batch_sizes = Counter()
+        self.num_requests = 0
+        self._queue = None
+        # The forward pass runs in a single worker thread so that the event loop keeps accepting requests
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    async def submit(self, keyword_features, cash, holdings):
+        """Queues one observation and waits for its (action, q_values)."""
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((time.perf_counter(), keyword_features, cash, holdings, future))
+        return await future
+
+    async def run(self):
+        """Batching loop, runs until cancelled."""
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_wait
+
+            # Collect more requests until the batch is full or the first request waited max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            keyword_features = np.stack([item[1] for item in batch])
+            cash = np.array([item[2] for item in batch], dtype=np.float32)
+            holdings = np.stack([item[3] for item in batch])
+            try:
+                actions, q_values = await loop.run_in_executor(self._executor, self.model_fn, keyword_features, cash, holdings)
+            except Exception as e:
+                for item in batch:
+                    if not item[4].done():
+                        item[4].set_exception(e)
+                continue
+
+            now = time.perf_counter()
+            self.batch_sizes[len(batch)] += 1
+            for i, (received, _, _, _, future) in enumerate(batch):
+                self.latencies.append(now - received)
+                self.num_requests += 1
+                if not future.done():
+                    future.set_result((int(actions[i]), q_values[i]))
+
+    def metrics(self):
+        """Returns the latency percentiles (ms) and the batch size histogram."""
+        latencies = np.array(self.latencies) * 1000.0
+        num_batches = sum(self.batch_sizes.values())
+        return {
+            'requests': self.num_requests,
+            'batches': num_batches,
+            'mean_batch_size': (sum(size * count for size, count in self.batch_sizes.items()) / num_batches) if num_batches else 0.0,
+            'latency_ms': {
+                'p50': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p90': float(np.percentile(latencies, 90)) if len(latencies) else None,
+                'p99': float(np.percentile(latencies, 99)) if len(latencies) else None,
+                'mean': float(latencies.mean()) if len(latencies) else None
+            },
+            'batch_size_histogram': {str(size): count for size, count in sorted(self.batch_sizes.items())}
+        }
+
+
+class DecisionService:
+    """
+    HTTP front end of the decision service.
+
+    Attributes:
+        batcher (MicroBatcher): The micro-batcher that runs the policy.
+        info (dict): Model information returned by /health (num_keywords, feature_columns, keywords).
+    """
+
+    def __init__(self, batcher, info):
+        self.batcher = batcher
+        self.info = info
+
+    async def handle_connection(self, reader, writer):
+        """Serves HTTP/1.1 requests on one (keep-alive) connection."""
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                status, payload = await self.dispatch(method, path, body)
+                data = json.dumps(payload).encode()
+                writer.write(
+                    f"HTTP/1.1 {STATUS_TEXT[status]}\r\nContent-Type: application/json\r\n"
+                    f"Content-Length: {len(data)}\r\n\r\n".encode() + data
+                )
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def dispatch(self, method, path, body):
+        """Routes a request, returns (status, payload)."""
+        if method == "GET" and path == "/metrics":
+            return 200, self.batcher.metrics()
+        if method == "GET" and path == "/health":
+            return 200, self.info
+        if method != "POST" or path != "/decide":
+            return 404, {'error': f"Unknown endpoint {method} {path}"}
+
+        try:
+            request = json.loads(body)
+            keyword_features = np.asarray(request["keyword_features"], dtype=np.float32)
+            cash = float(request["cash"])
+            holdings = np.asarray(request.get("holdings", np.zeros(self.info['num_keywords'])), dtype=np.float32)
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {'error': f"Invalid request: {e}"}
+
+        expected_shape = (self.info['num_keywords'], len(self.info['feature_columns']))
+        if keyword_features.shape != expected_shape or holdings.shape != (self.info['num_keywords'],):
+            return 400, {'error': f"Expected keyword_features with shape {list(expected_shape)} and holdings with shape [{self.info['num_keywords']}]"}
+
+        try:
+            action, q_values = await self.batcher.submit(keyword_features, cash, holdings)
+        except Exception as e:
+            return 500, {'error': str(e)}
+
+        keywords = self.info.get('keywords') or []
+        return 200, {
+            'action': action,
+            'keyword': keywords[action] if action < len(keywords) else None,  # None = buy nothing
+            'q_values': q_values.tolist()
+        }
+
+
+def load_model_fn(model_path, dataset_path, num_threads=None):
+    """
+    Loads the policy through ModelHandler.load_model(inference_only=True) and wraps it into a
+    batched function on raw observations.
+
+    The policy is taken from the process-wide PolicyCache before every batch, so a new checkpoint
+    written to model_path is picked up without restarting the service. Batches that are already
+    running finish with the old weights.
+
+    Args:
+        model_path (str): Path to the checkpoint.
+        dataset_path (str): Dataset that provides the normalization constants and dimensions.
+        num_threads (int, optional): Number of torch intra-op threads.
+
+    Returns:
+        tuple: (model_fn, info)
+    """
+    import torch
+    from dataset_cache import load_panel
+    from digital_advertising import (
+        AdOptimizationEnv, ServingPolicy, create_policy_for_checkpoint, feature_columns, get_policy_cache
+    )
+
+    if num_threads is not None:
+        torch.set_num_threads(num_threads)
+    device = torch.device("cpu")
+
+    env = AdOptimizationEnv(load_panel(dataset_path), device=device)
+    cache = get_policy_cache()
+
+    def build_policy():
+        # Called on every (re)load, a new checkpoint may have a different architecture (e.g. a distilled model)
+        return create_policy_for_checkpoint(env, model_path, device)
+
+    # Raw observation -> normalization -> value network -> argmax
+    current = {'policy': None, 'serving_policy': None}
+
+    def get_serving_policy():
+        policy, metadata = cache.get(model_path, build_policy, device)
+        if policy is not current['policy']:
+            current['policy'] = policy
+            current['serving_policy'] = ServingPolicy(policy.module[1].module, env.feature_means, env.feature_stds, env.cash_mean, env.cash_std).eval()
+        return current['serving_policy'], metadata
+
+    def model_fn(keyword_features, cash, holdings):
+        serving_policy, _ = get_serving_policy()
+        with torch.no_grad():
+            actions, q_values = serving_policy(torch.from_numpy(keyword_features), torch.from_numpy(cash), torch.from_numpy(holdings))
+        return actions.numpy(), q_values.numpy()
+
+    _, metadata = get_serving_policy()
+
+    info = {
+        'model': model_path,
+        'num_keywords': env.num_keywords,
+        'feature_columns': list(feature_columns),
+        'keywords': list(env.panel.keywords),
+        'test_reward': metadata.get('test_reward')
+    }
+    return model_fn, info
+
+
+async def serve(args):
+    model_fn, info = load_model_fn(args.model, args.dataset, num_threads=args.num_threads)
+    batcher = MicroBatcher(model_fn, max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+    service = DecisionService(batcher, info)
+
+    batch_task = asyncio.ensure_future(batcher.run())
+    server = await asyncio.start_server(service.handle_connection, args.host, args.port)
+    print(f"Decision service running on http://{args.host}:{args.port} "
+          f"(max_batch_size={args.max_batch_size}, max_wait_ms={args.max_wait_ms})")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        batch_task.cancel()
+
+
+async def _http_request(reader, writer, method, path, payload=None):
+    """Sends one request on a keep-alive connection and returns the decoded JSON response."""
+    body = json.dumps(payload).encode() if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    await reader.readline()  # Status line
+    content_length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.strip().lower() == "content-length":
+            content_length = int(value.strip())
+    return json.loads(await reader.readexactly(content_length))
+
+
+async def loadgen(args):
+    """Sends random observations with many concurrent connections and reports throughput and latency."""
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    info = await _http_request(reader, writer, "GET", "/health")
+    writer.close()
+
+    num_keywords = info['num_keywords']
+    num_features = len(info['feature_columns'])
+    rng = np.random.default_rng(args.seed)
+    # A pool of random observations, the raw metrics are roughly in the range of the synthetic data
+    payloads = [
+        {
+            'keyword_features': (rng.random((num_keywords, num_features)) * 100).tolist(),
+            'cash': float(rng.uniform(10000, 200000)),
+            'holdings': rng.integers(0, 2, num_keywords).tolist()
+        }
+        for _ in range(64)
+    ]
+
+    latencies = []
+    remaining = [args.requests]
+
+    async def worker(worker_id):
+        reader, writer = await asyncio.open_connection(args.host, args.port)
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            t0 = time.perf_counter()
+            await _http_request(reader, writer, "POST", "/decide", payloads[(worker_id + remaining[0]) % len(payloads)])
+            latencies.append(time.perf_counter() - t0)
+        writer.close()
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(args.concurrency)))
+    elapsed = time.perf_counter() - t0
+
+    latencies_ms = np.array(latencies) * 1000.0
+    print(f"Sent {len(latencies)} requests with {args.concurrency} connections in {elapsed:.2f}s ({len(latencies) / elapsed:.0f} req/s)")
+    print(f"Client latency: p50 = {np.percentile(latencies_ms, 50):.2f} ms, p99 = {np.percentile(latencies_ms, 99):.2f} ms")
+
+    reader, writer = await asyncio.open_connection(args.host, args.port)
+    metrics = await _http_request(reader, writer, "GET", "/metrics")
+    writer.close()
+    print(f"Server metrics: {json.dumps(metrics, indent=2)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Decision service with dynamic micro-batching")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the decision service")
+    serve_parser.add_argument("--model", type=str, default="saves/best_model.pt", help="Path to the model checkpoint")
+    serve_parser.add_argument("--dataset", type=str, default="data/organized_dataset.csv", help="Dataset for normalization constants and dimensions")
+    serve_parser.add_argument("--host", type=str, default="127.0.0.1", help="Host to bind to")
+    serve_parser.add_argument("--port", type=int, default=8080, help="Port to bind to")
+    serve_parser.add_argument("--max_batch_size", type=int, default=64, help="Maximum number of requests per forward pass")
+    serve_parser.add_argument("--max_wait_ms", type=float, default=2.0, help="Maximum time a request waits for a batch to fill")
+    serve_parser.add_argument("--num_threads", type=int, default=None, help="Number of torch intra-op threads")
+
+    loadgen_parser = subparsers.add_parser("loadgen", help="Local load generator")
+    loadgen_parser.add_argument("--host", type=str, default="127.0.0.1", help="Host of the decision service")
+    loadgen_parser.add_argument("--port", type=int, default=8080, help="Port of the decision service")
+    loadgen_parser.add_argument("--concurrency", type=int, default=64, help="Number of concurrent connections")
+    loadgen_parser.add_argument("--requests", type=int, default=10000, help="Total number of requests")
+    loadgen_parser.add_argument("--seed", type=int, default=0, help="Seed for the random observations")
+
+    args = parser.parse_args()
+    if args.command == "serve":
+        if not os.path.exists(args.model):
+            raise FileNotFoundError(f"Model file not found: {args.model}")
+        asyncio.run(serve(args))
+    else:
+        asyncio.run(loadgen(args))
+
+
+if __name__ == "__main__":
+    main()
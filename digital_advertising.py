@@ -2,28 +2,74 @@
 # coding: utf-8
 
 import os
+import io
+import copy
+import gzip
+import contextlib
+import json
+import hashlib
+import importlib.util
+import threading
 import torch
 import torch.nn as nn
 import numpy as np
 import pandas as pd
 import time
-from typing import Dict, Optional, Any, Tuple
-from tensordict import TensorDict
-from tensordict.nn import TensorDictModule, TensorDictSequential
+from collections import OrderedDict
+from typing import TYPE_CHECKING, Callable, Dict, Optional, Any, Tuple
 from torch.optim import Adam
-from torch.utils.tensorboard import SummaryWriter
-from torchrl.collectors import SyncDataCollector
-from torchrl.data import LazyTensorStorage, ReplayBuffer
-from torchrl.data import OneHot, Bounded, Unbounded, Binary, Composite
-from torchrl.envs import EnvBase
-from torchrl.modules import EGreedyModule, MLP, QValueModule
-from torchrl.objectives import DQNLoss, SoftUpdate
+from dataset_cache import file_sha256, load_panel
+# Importing this module has no side effects and only needs torch, numpy and pandas: the TensorBoard
+# writer and the device are created on first use (get_writer, get_device), and tensordict and torchrl
+# are imported in the functions that use them. Any torchrl import loads torchrl's whole stack, so
+# AdOptimizationEnv lives in ad_optimization_env, which is imported on first use of
+# digital_advertising.AdOptimizationEnv. benchmark_import.py checks this.
+if TYPE_CHECKING:
+    from tensordict.nn import TensorDictSequential
+    from ad_optimization_env import AdOptimizationEnv
 
 # Define the file path
 file_path = 'data/organized_dataset.csv'
 
-# Tensorboard vorbereiten
-writer = SummaryWriter()
+_writer = None
+_device = None
+
+
+def get_writer():
+    """Returns the default TensorBoard writer, it is created (with a new directory in runs/) on first use."""
+    global _writer
+    if _writer is None:
+        from torch.utils.tensorboard import SummaryWriter
+
+        # Tensorboard vorbereiten
+        _writer = SummaryWriter()
+    return _writer
+
+
+def get_device():
+    """Returns the best device for this machine (CUDA, MPS or CPU), it is selected on first use."""
+    global _device
+    if _device is None:
+        _device = torch.device(
+            "cuda" if torch.cuda.is_available() else
+            "mps" if torch.backends.mps.is_available() else
+            "cpu"
+        )
+    return _device
+
+
+def __getattr__(name):
+    # Lazy module attributes for code that still uses the former globals digital_advertising.writer and .device
+    if name == "writer":
+        return get_writer()
+    if name == "device":
+        return get_device()
+    # The environment loads torchrl, it is imported on first use (from digital_advertising import AdOptimizationEnv)
+    if name == "AdOptimizationEnv":
+        from ad_optimization_env import AdOptimizationEnv
+
+        return AdOptimizationEnv
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 # Generate Realistic Synthetic Data. 
 # This is coming from Ilja's code and is left in the code for educational purposes what fields we have also in the csv file.
@@ -139,251 +185,388 @@ print(entry)
 '''
 
 
-# Define a Custom TorchRL Environment
-class AdOptimizationEnv(EnvBase):
+class KeywordPanel:
     """
-    AdOptimizationEnv is an environment for optimizing digital advertising strategies using reinforcement learning.
+    The keyword metrics of a dataset as one dense array with shape [num_steps, num_keywords, num_columns].
+
+    The dataset consists of blocks of num_keywords rows per time step (see get_entry_from_dataset).
+    The panel holds the numeric columns of these blocks as float32 with the feature columns first,
+    so AdOptimizationEnv uses the keyword features of a step as a view and reads the reward columns
+    without pandas. A panel can be saved and memory-mapped: several processes (e.g. tuning workers)
+    then share one copy of the data, and creating an environment does not parse or copy the dataset.
 
     Attributes:
-        initial_cash (float): Initial cash balance for the environment.
-        dataset (pd.DataFrame): Dataset containing keyword metrics.
-        num_features (int): Number of features for each keyword.
-        num_keywords (int): Number of keywords in the dataset.
-        action_spec (OneHot): Action specification for the environment.
-        reward_spec (Unbounded): Reward specification for the environment.
-        observation_spec (Composite): Observation specification for the environment.
-        done_spec (Composite): Done specification for the environment.
-        current_step (int): Current step in the environment.
-        holdings (torch.Tensor): Tensor representing the current holdings of keywords.
-        cash (float): Current cash balance.
-        obs (TensorDict): Current observation of the environment.
-
-    Methods:
-        __init__(self, dataset, initial_cash=100000.0, device="cpu"):
-            Initializes the AdOptimizationEnv with the given dataset, initial cash, and device.
-        _reset(self, tensordict=None):
-            Resets the environment to the initial state and returns the initial observation.
-        _step(self, tensordict):
-            Takes a step in the environment using the given action and returns the next state, reward, and done flag.
-        _compute_reward(self, action, current_pki, action_idx):
-            Computes the reward based on the selected keyword's metrics.
-        _set_seed(self, seed: Optional[int]):
-            Sets the random seed for the environment.
-    """
-
-    def __init__(self, dataset, initial_cash=100000.0, device="cpu"):
-        """
-        Initializes the digital advertising environment.
+        values (np.ndarray): Metrics with shape [num_steps, num_keywords, num_columns], can be a memory map.
+        keywords (list): Keyword names in the order of the keyword axis.
+        columns (list): Column names in the order of the last axis.
+    """
+
+    VALUES_FILENAME = "values.npy"
+    META_FILENAME = "panel.json"
+
+    def __init__(self, values, keywords, columns):
+        self.values = values
+        self.keywords = list(keywords)
+        self.columns = list(columns)
+        self._column_index = {column: i for i, column in enumerate(self.columns)}
+        self._feature_stats = {}
+        self._fingerprint = None
+
+    @classmethod
+    def from_dataframe(cls, dataset, columns=None):
+        """
+        Creates a panel from a dataset in the block layout (num_keywords rows per time step).
 
         Args:
-            dataset (Any): The dataset containing keyword features and other relevant data.
-            initial_cash (float, optional): The initial amount of cash available for advertising. Defaults to 100000.0.
-            device (str, optional): The device to run the environment on, either "cpu" or "cuda". Defaults to "cpu".
-
-        Attributes:
-            initial_cash (float): The initial amount of cash available for advertising.
-            dataset (Any): The dataset containing keyword features and other relevant data.
-            num_features (int): The number of features in the dataset.
-            num_keywords (int): The number of keywords in the dataset.
-            action_spec (OneHot): The specification for the action space, which includes selecting a keyword to buy or choosing to buy nothing.
-            reward_spec (Unbounded): The specification for the reward space, which is unbounded and of type torch.float32.
-            observation_spec (Composite): The specification for the observation space, which includes keyword features, cash, holdings, and step count.
-            done_spec (Composite): The specification for the done space, which includes flags for done, terminated, and truncated states.
-        """
-        super().__init__(device=device)
-        self.initial_cash = initial_cash
-        self.dataset = dataset
-        self.num_features = len(feature_columns)
-        self.num_keywords = get_entry_from_dataset(self.dataset, 0).shape[0]
-        self.action_spec = OneHot(n=self.num_keywords + 1) # select which one to buy or the last one to buy nothing
-        self.reward_spec = Unbounded(shape=(1,), dtype=torch.float32)
-        self.observation_spec = Composite(
-            observation = Composite(
-                keyword_features=Unbounded(shape=(self.num_keywords, self.num_features), dtype=torch.float32),
-                cash=Unbounded(shape=(1,), dtype=torch.float32),
-                holdings=Bounded(low=0, high=1, shape=(self.num_keywords,), dtype=torch.int, domain="discrete")
-            ),
-            step_count=Unbounded(shape=(1,), dtype=torch.int64)
-        )
-        self.done_spec = Composite(
-            done=Binary(shape=(1,), dtype=torch.bool),
-            terminated=Binary(shape=(1,), dtype=torch.bool),
-            truncated=Binary(shape=(1,), dtype=torch.bool)
-        )
+            dataset (pd.DataFrame): The dataset. Incomplete trailing blocks are dropped.
+            columns (list, optional): Columns of the panel. Defaults to feature_columns followed by the
+                other numeric columns of the dataset.
 
-        self.feature_means = torch.tensor(dataset[feature_columns].mean().values, dtype=torch.float32, device=device)
-        self.feature_stds = torch.tensor(dataset[feature_columns].std().values, dtype=torch.float32, device=device)
-        # Prevent division by zero
-        self.feature_stds = torch.where(self.feature_stds > 0, self.feature_stds, torch.ones_like(self.feature_stds))
+        Returns:
+            KeywordPanel: The panel
+        """
+        # The keywords of the first step, the first repeated keyword starts the second step
+        duplicated = dataset['keyword'].duplicated().values
+        num_keywords = int(np.argmax(duplicated)) if duplicated.any() else len(dataset)
+        num_steps = len(dataset) // num_keywords
+
+        if columns is None:
+            numeric_columns = [c for c in dataset.columns if c != 'keyword' and pd.api.types.is_numeric_dtype(dataset[c])]
+            columns = list(feature_columns) + [c for c in numeric_columns if c not in feature_columns]
+        values = dataset[columns].values[:num_steps * num_keywords].astype(np.float32)
+        return cls(
+            np.ascontiguousarray(values.reshape(num_steps, num_keywords, len(columns))),
+            dataset['keyword'].iloc[:num_keywords].astype(str).tolist(),
+            columns
+        )
 
-        # Cash normalization
-        self.cash_mean = initial_cash / 2
-        self.cash_std = initial_cash / 4
+    @classmethod
+    def load(cls, directory, mmap=True):
+        """
+        Loads a panel saved with save.
 
-        self.reset()
+        Args:
+            directory (str): Directory of the panel
+            mmap (bool): Memory-map the values (copy-on-write, the pages are shared between processes
+                until they are written). Defaults to True.
 
-    def _reset(self, tensordict: TensorDict =None):
+        Returns:
+            KeywordPanel: The panel
+        """
+        with open(os.path.join(directory, cls.META_FILENAME)) as f:
+            meta = json.load(f)
+        values = np.load(os.path.join(directory, cls.VALUES_FILENAME), mmap_mode='c' if mmap else None)
+        panel = cls(values, meta['keywords'], meta['columns'])
+        panel._fingerprint = meta.get('fingerprint')
+        return panel
+
+    def save(self, directory):
         """
-        Resets the environment to its initial state.
+        Saves the panel (values.npy and panel.json) so that it can be memory-mapped with load.
 
         Args:
-            tensordict (TensorDict, optional): A TensorDict to be updated with the reset state. If None, a new TensorDict is created.
+            directory (str): Target directory
 
         Returns:
-            TensorDict: A TensorDict containing the reset state of the environment, including:
-                - "done" (torch.tensor): A boolean tensor indicating if the episode is done.
-                - "observation" (TensorDict): A TensorDict containing the initial observation with:
-                    - "keyword_features" (torch.tensor): Features of the current keywords.
-                    - "cash" (torch.tensor): The initial cash balance.
-                    - "holdings" (torch.tensor): The initial holdings state for each keyword.
-                - "step_count" (torch.tensor): The current step count, initialized to 0.
-                - "terminated" (torch.tensor): A boolean tensor indicating if the episode is terminated.
-                - "truncated" (torch.tensor): A boolean tensor indicating if the episode is truncated.
-        """
-        self.current_step = 0
-        self.holdings = torch.zeros(self.num_keywords, dtype=torch.int, device=self.device) # 0 = not holding, 1 = holding keyword
-        self.cash = self.initial_cash
-
-        # Create the initial observation.
-        keyword_features = torch.tensor(get_entry_from_dataset(self.dataset, self.current_step)[feature_columns].values, dtype=torch.float32, device=self.device)
-        keyword_features = (keyword_features - self.feature_means) / self.feature_stds
-        cash_normalized = (torch.tensor(self.cash, dtype=torch.float32, device=self.device) - self.cash_mean) / self.cash_std
+            str: The directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        values_path = os.path.join(directory, self.VALUES_FILENAME)
+        tmp_path = f"{values_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, np.ascontiguousarray(self.values))
+        os.replace(tmp_path, values_path)
+        with open(os.path.join(directory, self.META_FILENAME), 'w') as f:
+            json.dump({'keywords': self.keywords, 'columns': self.columns, 'fingerprint': self.fingerprint()}, f)
+        return directory
+
+    @property
+    def num_steps(self):
+        return self.values.shape[0]
+
+    @property
+    def num_keywords(self):
+        return self.values.shape[1]
+
+    def column(self, name):
+        """Returns a column with shape [num_steps, num_keywords] (a view)."""
+        return self.values[:, :, self._column_index[name]]
+
+    def features(self, columns=None):
+        """Returns the feature columns with shape [num_steps, num_keywords, num_features], a view if they are the leading columns."""
+        indices = [self._column_index[c] for c in (columns if columns is not None else feature_columns)]
+        if indices == list(range(len(indices))):
+            return self.values[:, :, :len(indices)]
+        return self.values[:, :, indices]
+
+    def feature_stats(self, columns=None):
+        """Returns the mean and the standard deviation (ddof=1, as in pandas) of the feature columns, computed once."""
+        key = tuple(columns if columns is not None else feature_columns)
+        if key not in self._feature_stats:
+            features = self.features(list(key)).reshape(-1, len(key)).astype(np.float64)
+            self._feature_stats[key] = (features.mean(axis=0), features.std(axis=0, ddof=1))
+        return self._feature_stats[key]
+
+    def split(self, train_ratio=0.8):
+        """
+        Splits the panel by time steps into training and test panels (views, the data is not copied).
 
-        obs = TensorDict({
-            "keyword_features": keyword_features,  # Current pki for each keyword
-            "cash": cash_normalized,  # Current cash balance
-            "holdings": self.holdings.clone()  # 1 for each keyword if we are holding
-        }, batch_size=[])
+        Args:
+            train_ratio (float): Ratio of the time steps in the training panel.
 
-        if tensordict is None:
-            tensordict = TensorDict({}, batch_size=[])
+        Returns:
+            tuple: (training_panel, test_panel)
+        """
+        num_training_steps = round(self.num_steps * train_ratio)
+        train_panel = KeywordPanel(self.values[:num_training_steps], self.keywords, self.columns)
+        test_panel = KeywordPanel(self.values[num_training_steps:], self.keywords, self.columns)
+        print(f"Training panel: {train_panel.num_steps} steps, test panel: {test_panel.num_steps} steps, {self.num_keywords} keywords")
+        return train_panel, test_panel
+
+    def fingerprint(self):
+        """Returns a SHA-256 hash of the keywords, columns and values, computed once."""
+        if self._fingerprint is None:
+            digest = hashlib.sha256(json.dumps([self.keywords, self.columns, list(self.values.shape)]).encode())
+            for start in range(0, self.num_steps, 1024):
+                digest.update(np.ascontiguousarray(self.values[start:start + 1024]).tobytes())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def to_dataframe(self):
+        """Returns the panel as a dataset in the block layout (num_keywords rows per time step)."""
+        dataset = pd.DataFrame(np.asarray(self.values).reshape(-1, len(self.columns)), columns=self.columns)
+        dataset.insert(0, 'keyword', np.tile(np.asarray(self.keywords, dtype=object), self.num_steps))
+        return dataset
+
+
+# Distributions of the synthetic columns, as in generate_synthetic_data: name -> (kind, low, high).
+# "uniform" draws floats in [low, high), "integers" draws integers in [low, high).
+SYNTHETIC_COLUMNS = {
+    "competitiveness": ("uniform", 0, 1),
+    "difficulty_score": ("uniform", 0, 1),
+    "organic_rank": ("integers", 1, 11),
+    "organic_clicks": ("integers", 50, 5000),
+    "organic_ctr": ("uniform", 0.01, 0.3),
+    "paid_clicks": ("integers", 10, 3000),
+    "paid_ctr": ("uniform", 0.01, 0.25),
+    "ad_spend": ("uniform", 10, 10000),
+    "ad_conversions": ("integers", 0, 500),
+    "ad_roas": ("uniform", 0.5, 5),
+    "conversion_rate": ("uniform", 0.01, 0.3),
+    "cost_per_click": ("uniform", 0.1, 10),
+    "cost_per_acquisition": ("uniform", 5, 500),
+    "previous_recommendation": ("integers", 0, 2),
+    "impression_share": ("uniform", 0.1, 1.0),
+    "conversion_value": ("uniform", 0, 10000)
+}
+
+
+def _draw_synthetic_columns(rng, num_steps, num_keywords):
+    """Draws every synthetic column as an array with shape [num_steps, num_keywords] (float32 or int32)."""
+    columns = {}
+    for name, (kind, low, high) in SYNTHETIC_COLUMNS.items():
+        if kind == "uniform":
+            values = rng.random((num_steps, num_keywords), dtype=np.float32)
+            values *= high - low
+            values += low
         else:
-            tensordict = tensordict.empty()
-
-        tensordict = tensordict.update({
-            "done": torch.tensor(False, dtype=torch.bool, device=self.device),
-            "observation": obs,
-            "step_count": torch.tensor(self.current_step, dtype=torch.int64, device=self.device),
-            "terminated": torch.tensor(False, dtype=torch.bool, device=self.device),
-            "truncated": torch.tensor(False, dtype=torch.bool, device=self.device)
-        })
-        
-        self.obs = obs
-        return tensordict
+            values = rng.integers(low, high, (num_steps, num_keywords), dtype=np.int32)
+        columns[name] = values
+    return columns
 
 
-    def _step(self, tensordict: TensorDict):
-        """
-        Perform a single step in the environment using the provided tensor dictionary.
+def _synthetic_panel_columns():
+    # The column order of KeywordPanel.from_dataframe: feature columns first
+    return list(feature_columns) + [c for c in SYNTHETIC_COLUMNS if c not in feature_columns]
 
-        Args:
-            tensordict (TensorDict): A dictionary containing the current state and action.
 
-        Returns:
-            TensorDict: A dictionary containing the next state, reward, and termination status.
-
-        The function performs the following steps:
-        1. Extracts the action from the input tensor dictionary.
-        2. Determines the index of the selected keyword.
-        3. Retrieves the current entry from the dataset based on the current step.
-        4. Updates the holdings based on the selected action.
-        5. Calculates the reward based on the action taken.
-        6. Advances to the next time step and checks for termination conditions.
-        7. Retrieves the next keyword features for the subsequent state.
-        8. Updates the observation state with the new keyword features, cash balance, and holdings.
-        9. Updates the tensor dictionary with the new state, reward, and termination status.
-        10. Returns the updated tensor dictionary containing the next state, reward, and termination status.
-        """
-        # Get the action from the input tensor dictionary. 
-        action = tensordict["action"]
-        true_indices = torch.nonzero(action, as_tuple=True)[0]
-        action_idx = true_indices[0] if len(true_indices) > 0 else self.action_spec.n - 1
-
-        current_pki = get_entry_from_dataset(self.dataset, self.current_step)
-
-
-        # Update cash based on the action
-        ad_roas = 0.0
-        if action_idx < self.num_keywords:
-            # Get the selected keyword's ad spend
-            selected_keyword = current_pki.iloc[action_idx.item()]
-            ad_cost = selected_keyword["ad_spend"]
-            ad_revenue = selected_keyword["conversion_value"]
-            ad_roas = selected_keyword["ad_roas"]
-
-            # we assume the marketing budget is 10% of the cash
-            if (self.cash * 0.1) >= ad_cost:
-                # When enough balance, update cash with ad revenue and deduct ad cost
-                self.cash -= ad_cost
-                self.cash += ad_revenue
-
-        # Update holdings based on action (only one keyword is selected)
-        new_holdings = torch.zeros_like(self.holdings)
-        if action_idx < self.num_keywords:
-            new_holdings[action_idx] = 1
-        self.holdings = new_holdings
-
-        # Calculate the reward based on the action taken.
-        reward = self._compute_reward(action, current_pki, action_idx, ad_roas)
-
-         # Move to the next time step.
-        self.current_step += 1
-        terminated = self.cash < 0 or self.current_step >= (len(self.dataset) // self.num_keywords) - 2 # -2 to avoid going over the last index
-        truncated = False
-
-        # Get next pki for the keywords
-        next_keyword_features = torch.tensor(get_entry_from_dataset(self.dataset, self.current_step)[feature_columns].values, dtype=torch.float32, device=self.device)
-        next_keyword_features = (next_keyword_features - self.feature_means) / self.feature_stds
-        cash_normalized = (torch.tensor(self.cash, dtype=torch.float32, device=self.device) - self.cash_mean) / self.cash_std
-
-        next_obs = TensorDict({
-            "keyword_features": next_keyword_features,  # next pki for each keyword
-            "cash": cash_normalized.clone().detach(),  # Current cash balance
-            "holdings": self.holdings.clone()
-        }, batch_size=[])
-        
-        # Update the state
-        self.obs = next_obs
-        print(f'Step (_step): {self.current_step}, Action: {action_idx}, Reward: {reward}, Cash: {self.cash}')
-        writer.add_scalar("Reward", reward, self.current_step)
-
-        # tensordict is used from EnvBase later on, so we add the current state here
-        tensordict["done"] = torch.as_tensor(bool(terminated or truncated), dtype=torch.bool, device=self.device)
-        tensordict["observation"] = self.obs
-        tensordict["reward"] = torch.tensor(reward, dtype=torch.float32, device=self.device)
-        tensordict["step_count"] = torch.tensor(self.current_step-1, dtype=torch.int64, device=self.device)
-        tensordict["terminated"] = torch.tensor(bool(terminated), dtype=torch.bool, device=self.device)
-        tensordict["truncated"] = torch.tensor(bool(truncated), dtype=torch.bool, device=self.device)
-        # next as return value is also used by EnvBase and later added to tensordict by EnvBase
-        next = TensorDict({
-            "done": torch.tensor(bool(terminated or truncated), dtype=torch.bool, device=self.device),
-            "observation": next_obs,
-            "reward": torch.tensor(reward, dtype=torch.float32, device=self.device),
-            "step_count": torch.tensor(self.current_step, dtype=torch.int64, device=self.device),
-            "terminated": torch.tensor(bool(terminated), dtype=torch.bool, device=self.device),
-            "truncated": torch.tensor(bool(truncated), dtype=torch.bool, device=self.device)
-        }, batch_size=tensordict.batch_size)
-        
-        return next
-
-    def _compute_reward(self, action, current_pki, action_idx, ad_roas):
-        """Compute reward based on the selected keyword's metrics"""
-        adjusted_reward = 0 if action_idx < self.num_keywords else 1 # encourage the agent to buy something​
-        if ad_roas > 0: # log(0) is undefined
-            adjusted_reward = np.log(ad_roas)  ## Adjust reward based on ad_roas performance, scale it with log
-        missing_rewards = []
-        # Calculate the ad_roas we did not get because we chose another keyword​
-        for i in range(self.num_keywords):
-            sample = current_pki.iloc[i]
-            if action[i] == False:
-                missing_rewards.append(sample["ad_roas"])
-        # Adjust reward based on missing rewards to penalize the agent when not selecting keywords with high(er) ROAS
-        # clipping reduces the variance of the rewards
-        return np.clip(adjusted_reward - np.mean(missing_rewards) * 0.2, -2, 2)
-
-    def _set_seed(self, seed: Optional[int]):
-        rng = torch.manual_seed(seed)
-        self.rng = rng
+def generate_synthetic_panel(num_keywords=20, num_steps=5000, seed=None):
+    """
+    Generates a synthetic dataset with the distributions of generate_synthetic_data directly as a
+    KeywordPanel. All columns are drawn as [num_steps, num_keywords] arrays in one pass, instead of
+    concatenating many small DataFrames.
+
+    Args:
+        num_keywords (int): Number of keywords (Keyword_0 ... Keyword_<num_keywords - 1>)
+        num_steps (int): Number of time steps
+        seed (int, optional): Seed of the random generator
+
+    Returns:
+        KeywordPanel: The panel, to_dataframe() gives the dataset in the block layout
+    """
+    rng = np.random.default_rng(seed)
+    columns = _synthetic_panel_columns()
+    drawn = _draw_synthetic_columns(rng, num_steps, num_keywords)
+    values = np.empty((num_steps, num_keywords, len(columns)), dtype=np.float32)
+    for i, name in enumerate(columns):
+        values[:, :, i] = drawn[name]
+    return KeywordPanel(values, [f"Keyword_{i}" for i in range(num_keywords)], columns)
+
+
+def write_synthetic_dataset(path, num_keywords=20, num_steps=5000, seed=None, chunk_steps=None):
+    """
+    Writes a synthetic dataset in chunks of time steps, so the memory use does not depend on the size
+    of the dataset (e.g. 100M rows for load tests).
+
+    Paths ending in .csv are written as a CSV file in the block layout of generate_synthetic_data,
+    other paths as a saved KeywordPanel directory (values.npy and panel.json, see KeywordPanel.load).
+    The file is written under a temporary name and renamed when complete. With the same seed and
+    chunk_steps >= num_steps the data is the same as generate_synthetic_panel.
+
+    Args:
+        path (str): CSV file or panel directory
+        num_keywords (int): Number of keywords
+        num_steps (int): Number of time steps (the dataset has num_steps * num_keywords rows)
+        seed (int, optional): Seed of the random generator
+        chunk_steps (int, optional): Time steps per chunk. Defaults to about one million rows per chunk.
+
+    Returns:
+        str: The path
+    """
+    rng = np.random.default_rng(seed)
+    chunk_steps = chunk_steps or max(1, 1_000_000 // num_keywords)
+    keywords = [f"Keyword_{i}" for i in range(num_keywords)]
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+    if path.endswith(".csv"):
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        keyword_column = np.asarray(keywords, dtype=object)
+        with open(tmp_path, "w", newline="") as f:
+            for start in range(0, num_steps, chunk_steps):
+                steps = min(chunk_steps, num_steps - start)
+                drawn = _draw_synthetic_columns(rng, steps, num_keywords)
+                chunk = pd.DataFrame({'keyword': np.tile(keyword_column, steps), **{name: values.ravel() for name, values in drawn.items()}})
+                chunk.to_csv(f, header=start == 0, index=False)
+        os.replace(tmp_path, path)
+        return path
+
+    # Panel directory: the values are written into a memory-mapped .npy file chunk by chunk
+    os.makedirs(path, exist_ok=True)
+    columns = _synthetic_panel_columns()
+    values_path = os.path.join(path, KeywordPanel.VALUES_FILENAME)
+    tmp_path = f"{values_path}.{os.getpid()}.tmp.npy"
+    values = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(num_steps, num_keywords, len(columns)))
+    # Same hash as KeywordPanel.fingerprint, computed while writing
+    digest = hashlib.sha256(json.dumps([keywords, columns, list(values.shape)]).encode())
+    for start in range(0, num_steps, chunk_steps):
+        steps = min(chunk_steps, num_steps - start)
+        drawn = _draw_synthetic_columns(rng, steps, num_keywords)
+        for i, name in enumerate(columns):
+            values[start:start + steps, :, i] = drawn[name]
+        digest.update(np.ascontiguousarray(values[start:start + steps]).tobytes())
+    values.flush()
+    del values
+    os.replace(tmp_path, values_path)
+    with open(os.path.join(path, KeywordPanel.META_FILENAME), "w") as f:
+        json.dump({'keywords': keywords, 'columns': columns, 'fingerprint': digest.hexdigest()}, f)
+    return path
+
+
+def build_keyword_groups(dataset, num_groups=None, random_state=0):
+    """
+    Clusters the keywords of a dataset into groups for the hierarchical action mode.
+
+    The keywords are clustered on the same business metrics that are used in
+    visualize_keyword_clustering (ROAS, CTR, conversion rate, ad spend, expected profit
+    and funnel efficiency). The clusters are balanced so that no group holds more than
+    ceil(num_keywords / num_groups) keywords, which keeps the second level of the
+    decision small.
+
+    Args:
+        dataset (pd.DataFrame or KeywordPanel): The dataset containing the keyword metrics.
+        num_groups (int, optional): Number of keyword groups. Defaults to ceil(sqrt(num_keywords)).
+        random_state (int, optional): Seed for the clustering. Defaults to 0.
+
+    Returns:
+        np.ndarray: Group index for every keyword, in the keyword order used by AdOptimizationEnv.
+    """
+    from sklearn.cluster import KMeans
+
+    if isinstance(dataset, KeywordPanel):
+        dataset = dataset.to_dataframe()
+    keywords = get_entry_from_dataset(dataset, 0)['keyword']
+    num_keywords = len(keywords)
+    if num_groups is None:
+        num_groups = int(np.ceil(np.sqrt(num_keywords)))
+    num_groups = max(1, min(num_groups, num_keywords))
+
+    # Average the business metrics per keyword (same metrics as in visualize_keyword_clustering)
+    keyword_metrics = dataset.groupby('keyword')[['ad_roas', 'paid_ctr', 'conversion_rate', 'ad_spend']].mean()
+    keyword_metrics['expected_profit'] = (keyword_metrics['ad_roas'] - 1) * keyword_metrics['ad_spend']
+    keyword_metrics['funnel_efficiency'] = keyword_metrics['paid_ctr'] * keyword_metrics['conversion_rate']
+    keyword_metrics = keyword_metrics.reindex(keywords.values).fillna(0.0)
+
+    # Normalize the metrics so that large scales (ad_spend) do not dominate the clustering
+    X = keyword_metrics.values.astype(np.float64)
+    stds = X.std(axis=0)
+    X = (X - X.mean(axis=0)) / np.where(stds > 0, stds, 1.0)
+
+    kmeans = KMeans(n_clusters=num_groups, n_init=10, random_state=random_state).fit(X)
+    distances = kmeans.transform(X)  # [num_keywords, num_groups]
+
+    # Balanced assignment: the keywords closest to a centroid are placed first, a group is full
+    # once it holds ceil(num_keywords / num_groups) keywords
+    capacity = int(np.ceil(num_keywords / num_groups))
+    group_fill = np.zeros(num_groups, dtype=np.int64)
+    keyword_groups = np.empty(num_keywords, dtype=np.int64)
+    preferences = np.argsort(distances, axis=1)
+    for k in np.argsort(distances.min(axis=1)):
+        for g in preferences[k]:
+            if group_fill[g] < capacity:
+                keyword_groups[k] = g
+                group_fill[g] += 1
+                break
+
+    # Renumber the groups so that the group indices are contiguous
+    _, keyword_groups = np.unique(keyword_groups, return_inverse=True)
+    return keyword_groups.astype(np.int64)
+
+
+def pack_observation(keyword_features, cash, holdings, out=None):
+    """
+    Packs keyword features, cash and holdings into one flat observation tensor.
+
+    The layout is [keyword_features (num_keywords * num_features), cash (1), holdings (num_keywords)],
+    which is the input layout of the policy network. If out is given, the values are written into it
+    in place and no new tensor is allocated.
+
+    Args:
+        keyword_features (torch.Tensor): Features with shape [..., num_keywords, num_features].
+        cash (torch.Tensor): Cash with shape [...], [..., 1] or a scalar.
+        holdings (torch.Tensor): Holdings with shape [..., num_keywords] or [num_keywords].
+        out (torch.Tensor, optional): Preallocated tensor with shape [..., observation_dim].
+
+    Returns:
+        torch.Tensor: The packed observation (out if it was given).
+    """
+    batch_shape = keyword_features.shape[:-2]
+    num_keywords, num_features = keyword_features.shape[-2:]
+    features_size = num_keywords * num_features
+    if out is None:
+        out = keyword_features.new_empty(*batch_shape, features_size + 1 + num_keywords, dtype=torch.float32)
+
+    out[..., :features_size].unflatten(-1, (num_keywords, num_features)).copy_(keyword_features)
+    if cash.dim() == len(batch_shape):
+        cash = cash.unsqueeze(-1)  # [...] -> [..., 1]
+    out[..., features_size:features_size + 1].copy_(cash)
+    out[..., features_size + 1:].copy_(holdings)  # Broadcasts [num_keywords] and casts holdings to float
+    return out
+
+
+def unpack_observation(flat, num_keywords, num_features):
+    """
+    Returns views of the keyword features, cash and holdings inside a packed observation (no copy).
+
+    Args:
+        flat (torch.Tensor): Packed observation with shape [..., observation_dim].
+        num_keywords (int): Number of keywords.
+        num_features (int): Number of features per keyword.
+
+    Returns:
+        tuple: (keyword_features [..., num_keywords, num_features], cash [..., 1], holdings [..., num_keywords])
+    """
+    features_size = num_keywords * num_features
+    keyword_features = flat[..., :features_size].unflatten(-1, (num_keywords, num_features))
+    return keyword_features, flat[..., features_size:features_size + 1], flat[..., features_size + 1:]
 
 
 class FlattenInputs(nn.Module):
@@ -408,47 +591,255 @@ class FlattenInputs(nn.Module):
     -------
     torch.Tensor
         A combined tensor with all inputs flattened and concatenated along the appropriate dimension.
+
+    Notes
+    -----
+    AdOptimizationEnv already provides the packed observation as ("observation", "flat"), so the
+    policy does not need this module. It is kept for inputs that come as separate tensors.
     """
     def forward(self, keyword_features, cash, holdings):
-        # Check if we have a batch dimension
-        has_batch = keyword_features.dim() > 2
-        
-        if has_batch:
-            batch_size = keyword_features.shape[0]
-            # Flatten keyword features while preserving batch dimension: 
-            # [batch, num_keywords, feature_dim] -> [batch, num_keywords * feature_dim]
-            flattened_features = keyword_features.reshape(batch_size, -1)
-            
-            # Ensure cash has correct dimensions [batch, 1]
-            if cash.dim() == 1:  # [batch]
-                cash = cash.unsqueeze(-1)  # [batch, 1]
-            elif cash.dim() == 0:  # scalar
-                cash = cash.unsqueeze(0).expand(batch_size, 1)  # [batch, 1]
-            
-            # Ensure holdings has correct dimensions [batch, num_keywords]
-            if holdings.dim() == 1:  # [num_keywords]
-                holdings = holdings.unsqueeze(0).expand(batch_size, -1)  # [batch, num_keywords]
-            
-            # Convert holdings to float
-            holdings = holdings.float()
-            
-            # Combine all inputs along dimension 1
-            combined = torch.cat([flattened_features, cash, holdings], dim=1)
-        else:
-            # No batch dimension - single sample case
-            # Flatten keyword features: [num_keywords, feature_dim] -> [num_keywords * feature_dim]
-            flattened_features = keyword_features.reshape(-1)
-            
-            # Ensure cash has a dimension
-            cash = cash.unsqueeze(-1) if cash.dim() == 0 else cash
-            
-            # Convert holdings to float
-            holdings = holdings.float()
-            
-            # Combine all inputs
-            combined = torch.cat([flattened_features, cash, holdings], dim=0)
-            
-        return combined
+        return pack_observation(keyword_features, cash, holdings)
+
+
+class HierarchicalQNet(nn.Module):
+    """
+    A two-level Q-network for large keyword catalogs.
+
+    The first level scores the keyword groups (plus the "buy nothing" action), the second level
+    scores the keywords inside a group. The flat Q-value of keyword k in group g is
+
+        Q(k) = Q_group(g) + Q_keyword(k) - max_{k' in g} Q_keyword(k')
+
+    so the best keyword of each group carries the value of its group. The argmax over the flat
+    Q-values is therefore the same as first picking the best group and then the best keyword
+    inside that group. forward() returns the flat Q-values for all num_keywords + 1 actions,
+    which keeps the network compatible with QValueModule, EGreedyModule and DQNLoss, while
+    greedy_action() only evaluates the chosen group (O(sqrt K) instead of O(K) per decision).
+
+    Parameters
+    ----------
+    in_features : int
+        Size of the flattened input.
+    keyword_groups : array-like
+        Group index for every keyword (see build_keyword_groups).
+    num_cells : list of int
+        Hidden layer sizes of the shared body, the last entry is the size of the embedding
+        that is fed to both heads.
+    """
+    def __init__(self, in_features, keyword_groups, num_cells=(256, 256, 128, 64)):
+        super().__init__()
+        keyword_groups = torch.as_tensor(np.asarray(keyword_groups), dtype=torch.long)
+        num_keywords = keyword_groups.numel()
+        num_groups = int(keyword_groups.max().item()) + 1
+        max_group_size = int(torch.bincount(keyword_groups, minlength=num_groups).max().item())
+
+        # member_index[g, s] is the keyword in slot s of group g, unused slots hold num_keywords
+        member_index = torch.full((num_groups, max_group_size), num_keywords, dtype=torch.long)
+        slot_of_keyword = torch.zeros(num_keywords, dtype=torch.long)
+        group_fill = [0] * num_groups
+        for k, g in enumerate(keyword_groups.tolist()):
+            member_index[g, group_fill[g]] = k
+            slot_of_keyword[k] = group_fill[g]
+            group_fill[g] += 1
+
+        self.num_keywords = num_keywords
+        self.num_groups = num_groups
+        self.register_buffer("group_of_keyword", keyword_groups)
+        self.register_buffer("slot_of_keyword", slot_of_keyword)
+        self.register_buffer("member_index", member_index)
+        self.register_buffer("slot_mask", member_index < num_keywords)
+
+        from torchrl.modules import MLP
+
+        hidden_dim = num_cells[-1]
+        self.body = MLP(
+            in_features=in_features,
+            out_features=hidden_dim,
+            num_cells=list(num_cells[:-1]),
+            activation_class=nn.ReLU,
+            activate_last_layer=True
+        )
+        # Level 1: one Q-value per keyword group and one for "buy nothing"
+        self.group_head = nn.Linear(hidden_dim, num_groups + 1)
+        # Level 2: one linear head per keyword group
+        bound = 1.0 / np.sqrt(hidden_dim)
+        self.keyword_weight = nn.Parameter(torch.empty(num_groups, max_group_size, hidden_dim).uniform_(-bound, bound))
+        self.keyword_bias = nn.Parameter(torch.empty(num_groups, max_group_size).uniform_(-bound, bound))
+
+    def forward(self, x):
+        hidden = self.body(x)
+        group_values = self.group_head(hidden)  # [..., num_groups + 1]
+
+        # Q-values of all keywords inside their groups: [..., num_groups, max_group_size]
+        keyword_values = torch.einsum("...h,gsh->...gs", hidden, self.keyword_weight) + self.keyword_bias
+        keyword_values = keyword_values.masked_fill(~self.slot_mask, float("-inf"))
+        advantage = keyword_values - keyword_values.max(dim=-1, keepdim=True).values
+
+        # Map back to the flat keyword index used by the environment
+        flat_values = group_values[..., self.group_of_keyword] + advantage[..., self.group_of_keyword, self.slot_of_keyword]
+        return torch.cat([flat_values, group_values[..., -1:]], dim=-1)
+
+    def greedy_action(self, x):
+        """Returns the flat index of the greedy action, only evaluating the selected group."""
+        hidden = self.body(x)
+        group = self.group_head(hidden).argmax(dim=-1)
+        keyword_group = group.clamp(max=self.num_groups - 1)
+
+        # Only the weights of the selected group are used: [..., max_group_size, hidden_dim]
+        weight = self.keyword_weight[keyword_group]
+        keyword_values = (weight @ hidden.unsqueeze(-1)).squeeze(-1) + self.keyword_bias[keyword_group]
+        keyword_values = keyword_values.masked_fill(~self.slot_mask[keyword_group], float("-inf"))
+        keyword = self.member_index[keyword_group, keyword_values.argmax(dim=-1)]
+
+        # The last group index is the "buy nothing" action
+        return torch.where(group == self.num_groups, torch.full_like(keyword, self.num_keywords), keyword)
+
+
+class HierarchicalGreedyModule(nn.Module):
+    """
+    Greedy action selection for a HierarchicalQNet, returns the one-hot encoded action
+    (num_keywords + 1 entries) that is expected by AdOptimizationEnv.
+    """
+    def __init__(self, q_net: HierarchicalQNet):
+        super().__init__()
+        self.q_net = q_net
+
+    def forward(self, flattened_input):
+        action_idx = self.q_net.greedy_action(flattened_input)
+        return torch.nn.functional.one_hot(action_idx, self.q_net.num_keywords + 1)
+
+
+class ServingPolicy(nn.Module):
+    """
+    Self-contained greedy policy for serving, see ModelHandler.export_serving_model.
+
+    It contains the normalization constants of the environment, the flatten step, the value network
+    and the argmax, so it works on raw keyword metrics and does not need torchrl, tensordict or
+    AdOptimizationEnv at inference time.
+
+    Methods
+    -------
+    forward(keyword_features, cash, holdings)
+        Returns the greedy action index and the Q-values for a batch of raw observations.
+
+    Parameters
+    ----------
+    keyword_features : torch.Tensor
+        Raw keyword metrics (feature_columns) with shape [batch, num_keywords, num_features].
+    cash : torch.Tensor
+        Raw cash balance with shape [batch] or [batch, 1].
+    holdings : torch.Tensor
+        Holdings (0 or 1) with shape [batch, num_keywords].
+
+    Returns
+    -------
+    tuple of torch.Tensor
+        action [batch] (num_keywords = buy nothing) and q_values [batch, num_keywords + 1].
+    """
+    def __init__(self, value_net, feature_means, feature_stds, cash_mean, cash_std):
+        super().__init__()
+        self.value_net = value_net
+        self.register_buffer("feature_means", torch.as_tensor(feature_means, dtype=torch.float32))
+        self.register_buffer("feature_stds", torch.as_tensor(feature_stds, dtype=torch.float32))
+        self.register_buffer("cash_mean", torch.tensor(float(cash_mean), dtype=torch.float32))
+        self.register_buffer("cash_std", torch.tensor(float(cash_std), dtype=torch.float32))
+
+    def forward(self, keyword_features, cash, holdings):
+        keyword_features = (keyword_features - self.feature_means) / self.feature_stds
+        cash = (cash.reshape(-1, 1) - self.cash_mean) / self.cash_std
+        flat = torch.cat([keyword_features.flatten(1), cash, holdings.to(torch.float32)], dim=1)
+        q_values = self.value_net(flat)
+        return q_values.argmax(dim=-1), q_values
+
+
+def _json_default(value):
+    """Converts numpy and torch values for json.dump, everything else is stored as string."""
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (np.ndarray, torch.Tensor)):
+        return value.tolist()
+    return str(value)
+
+
+# Element types of the weights-only inference format (safetensors naming)
+_WEIGHTS_DTYPES = {
+    torch.float64: "F64", torch.float32: "F32", torch.float16: "F16", torch.bfloat16: "BF16",
+    torch.int64: "I64", torch.int32: "I32", torch.int16: "I16", torch.int8: "I8",
+    torch.uint8: "U8", torch.bool: "BOOL"
+}
+
+
+def save_inference_weights(state_dict: Dict[str, torch.Tensor], filepath: str, metadata: Optional[Dict[str, Any]] = None):
+    """
+    Writes a state dict in a weights-only, memory-mappable layout (compatible with safetensors).
+
+    The file starts with the length of the JSON header as little-endian uint64, followed by the
+    header (dtype, shape and byte offsets of every tensor plus the metadata) and the raw tensor data.
+    The header is padded to a multiple of 8 bytes and the tensors are ordered by descending element
+    size, so every tensor is aligned to its element size and can be used directly from the mapping.
+
+    Args:
+        state_dict: Tensors to save (quantized tensors are not supported)
+        filepath: Path of the file
+        metadata: Metadata stored (as JSON) in the header
+    """
+    tensors = []
+    for name, value in state_dict.items():
+        if not isinstance(value, torch.Tensor) or value.dtype not in _WEIGHTS_DTYPES:
+            raise ValueError(f"{name} cannot be stored in the inference weights format (quantized models are not supported)")
+        tensors.append((name, value.detach().cpu().contiguous()))
+    tensors.sort(key=lambda item: item[1].element_size(), reverse=True)
+
+    header = {"__metadata__": {"metadata": json.dumps(metadata or {}, default=_json_default)}}
+    offset = 0
+    for name, tensor in tensors:
+        num_bytes = tensor.numel() * tensor.element_size()
+        header[name] = {"dtype": _WEIGHTS_DTYPES[tensor.dtype], "shape": list(tensor.shape), "data_offsets": [offset, offset + num_bytes]}
+        offset += num_bytes
+    header_bytes = json.dumps(header).encode()
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(len(header_bytes).to_bytes(8, "little"))
+        f.write(header_bytes)
+        for _, tensor in tensors:
+            f.write(tensor.reshape(-1).view(torch.uint8).numpy().tobytes())
+    os.replace(tmp_path, filepath)
+
+
+def read_inference_header(filepath: str) -> Tuple[Dict[str, Any], int]:
+    """Returns the header of an inference weights file and the offset of the tensor data."""
+    with open(filepath, "rb") as f:
+        header_size = int.from_bytes(f.read(8), "little")
+        header = json.loads(f.read(header_size))
+    return header, 8 + header_size
+
+
+def load_inference_weights(filepath: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, Any]]:
+    """
+    Memory-maps an inference weights file written by save_inference_weights.
+
+    The tensors are views into a private (copy-on-write) mapping of the file: nothing is read
+    until a page is used, and all processes on the host share the pages of the file in the page
+    cache instead of holding their own copy of the weights.
+
+    Args:
+        filepath: Path of the file
+
+    Returns:
+        Tuple: (state_dict with the memory-mapped tensors, metadata)
+    """
+    header, data_offset = read_inference_header(filepath)
+    metadata = json.loads(header.pop("__metadata__", {}).get("metadata", "{}"))
+    dtypes = {name: dtype for dtype, name in _WEIGHTS_DTYPES.items()}
+
+    mapping = torch.from_file(filepath, shared=False, size=os.path.getsize(filepath), dtype=torch.uint8)
+    state_dict = {}
+    for name, info in header.items():
+        start, end = info["data_offsets"]
+        state_dict[name] = mapping[data_offset + start:data_offset + end].view(dtypes[info["dtype"]]).reshape(info["shape"])
+    return state_dict, metadata
 
 
 class ModelHandler:
@@ -459,20 +850,266 @@ class ModelHandler:
     1. Save models during training based on performance criteria
     2. Load models for inference or continued training
     3. Manage model versioning and metadata
+
+    Every saved model is recorded in a manifest (manifest.json in the save directory) with its
+    metrics, training step, hyperparameters, file size and hash. Listing and selecting models
+    only reads the manifest, the checkpoints themselves are not deserialized.
+
+    Optionally, the handler applies a retention policy after every save (keep the top-k models by
+    test reward plus the last N), stores the optimizer state in a separate file (<name>.optim.pt)
+    or not at all, compresses the checkpoints with gzip and deduplicates identical weights with
+    hard links. A deduplicated file shares the embedded metadata of the file it is linked to, its
+    own metadata is kept in the manifest and in a small <name>.meta.json file next to it.
     """
+
+    MANIFEST_FILENAME = 'manifest.json'
+    OPTIMIZER_SUFFIX = '.optim.pt'
+    METADATA_SUFFIX = '.meta.json'
+    INFERENCE_WEIGHTS_SUFFIX = '.safetensors'
     
-    def __init__(self, save_dir: str = 'saves'):
+    def __init__(self,
+                 save_dir: str = 'saves',
+                 keep_top_k: Optional[int] = None,
+                 keep_last_n: Optional[int] = None,
+                 save_optimizer: bool = True,
+                 compress: bool = False,
+                 dedup: bool = False):
         """
         Initialize the ModelHandler.
         
         Args:
             save_dir (str): Directory to save models to and load models from.
+            keep_top_k (int, optional): Keep only the k models with the highest test reward (plus keep_last_n). None keeps all.
+            keep_last_n (int, optional): Keep only the n most recent models (plus keep_top_k). None keeps all.
+            save_optimizer (bool): Save the optimizer state (in a separate <name>.optim.pt file). Defaults to True.
+            compress (bool): Compress the checkpoints with gzip. Defaults to False.
+            dedup (bool): Hard-link to an existing file instead of writing identical weights again. Defaults to False.
         """
         self.save_dir = save_dir
+        self.manifest_path = os.path.join(save_dir, self.MANIFEST_FILENAME)
+        self.keep_top_k = keep_top_k
+        self.keep_last_n = keep_last_n
+        self.save_optimizer = save_optimizer
+        self.compress = compress
+        self.dedup = dedup
         os.makedirs(save_dir, exist_ok=True)
+
+    @staticmethod
+    def load_checkpoint(filepath: str, map_location=None) -> Dict[str, Any]:
+        """
+        Load a checkpoint file, gzip compressed files are detected by their magic bytes.
+
+        Args:
+            filepath: Path to the model file
+            map_location: Device to map the tensors to
+
+        Returns:
+            dict: The save dictionary
+        """
+        with open(filepath, 'rb') as f:
+            compressed = f.read(2) == b'\x1f\x8b'
+        if compressed:
+            with gzip.open(filepath, 'rb') as f:
+                return torch.load(io.BytesIO(f.read()), map_location=map_location)
+        return torch.load(filepath, map_location=map_location)
+
+    def optimizer_path(self, filepath: str) -> str:
+        """Returns the path of the separate optimizer state file of a model file."""
+        return filepath[:-len('.pt')] + self.OPTIMIZER_SUFFIX
+
+    def metadata_path(self, filepath: str) -> str:
+        """Returns the path of the separate metadata file of a deduplicated model file."""
+        return filepath[:-len('.pt')] + self.METADATA_SUFFIX
+
+    def _read_metadata_file(self, filepath: str) -> Optional[Dict[str, Any]]:
+        """Returns the separate metadata record (metadata, timestamp, deduplicated_from) of a model file, if any."""
+        metadata_path = self.metadata_path(filepath)
+        if not os.path.exists(metadata_path):
+            return None
+        with open(metadata_path) as f:
+            return json.load(f)
+
+    @staticmethod
+    def weights_hash(state_dict: Dict[str, Any]) -> Optional[str]:
+        """Returns a SHA-256 hash over the names and contents of the tensors of a state dict (None if not hashable)."""
+        digest = hashlib.sha256()
+        try:
+            for name in sorted(state_dict):
+                value = state_dict[name]
+                if isinstance(value, torch.Tensor):
+                    digest.update(name.encode())
+                    digest.update(str(value.dtype).encode())
+                    digest.update(value.detach().cpu().contiguous().numpy().tobytes())
+        except (TypeError, RuntimeError):
+            # e.g. quantized tensors cannot be converted to numpy
+            return None
+        return digest.hexdigest()
+
+    def _lock_manifest(self, timeout: float = 30.0):
+        """
+        Acquires a lock file next to the manifest, so that several processes (e.g. parallel tuning
+        workers) can update it. A lock older than the timeout is treated as stale and removed.
+        """
+        lock_path = self.manifest_path + '.lock'
+        start = time.time()
+        while True:
+            try:
+                fd = os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                os.close(fd)
+                return lock_path
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > timeout:
+                        os.remove(lock_path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.time() - start > timeout:
+                    raise TimeoutError(f"Could not lock {self.manifest_path}")
+                time.sleep(0.01)
+
+    def read_manifest(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Read the manifest of the save directory.
+
+        Returns:
+            dict: Manifest entries by filename (empty if there is no manifest yet)
+        """
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            return json.load(f).get('checkpoints', {})
+
+    def _write_manifest(self, entries: Dict[str, Dict[str, Any]]):
+        """Writes the manifest atomically (temporary file and rename)."""
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'checkpoints': entries}, f, indent=1, default=_json_default)
+        os.replace(tmp_path, self.manifest_path)
+
+    def update_manifest(self, updates: Dict[str, Optional[Dict[str, Any]]]):
+        """
+        Add, replace or remove manifest entries atomically.
+
+        Args:
+            updates: New entries by filename, None removes the entry
+        """
+        lock_path = self._lock_manifest()
+        try:
+            entries = self.read_manifest()
+            for filename, entry in updates.items():
+                if entry is None:
+                    entries.pop(filename, None)
+                else:
+                    entries[filename] = entry
+            self._write_manifest(entries)
+        finally:
+            os.remove(lock_path)
+
+    @staticmethod
+    def is_derived_model(entry: Dict[str, Any]) -> bool:
+        """
+        Returns True for a manifest entry of a model derived from a training checkpoint (quantized or
+        distilled). Their test rewards are not measured like the rewards of learn, so they are neither
+        candidates of find_best_model nor subject to retention.
+        """
+        metadata = entry.get('metadata', {})
+        return bool(metadata.get('quantization') or metadata.get('distillation'))
+
+    def _manifest_entry(self, filepath: str, metadata: Dict[str, Any], timestamp: float) -> Dict[str, Any]:
+        """Creates the manifest entry of a saved model file."""
+        return {
+            'filename': os.path.basename(filepath),
+            'test_reward': metadata.get('test_reward'),
+            'step': metadata.get('total_steps'),
+            'metrics': {k: v for k, v in metadata.items() if isinstance(v, (int, float, np.number)) and not isinstance(v, bool)},
+            'hyperparameters': metadata.get('hyperparameters', {}),
+            'size': os.path.getsize(filepath),
+            'sha256': file_sha256(filepath),
+            'timestamp': timestamp,
+            'metadata': metadata
+        }
+
+    def rebuild_manifest(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Rebuild the manifest from the model files in the save directory. This loads every
+        checkpoint once and is only needed for directories written before the manifest existed.
+        Deduplicated files take their metadata from their separate metadata file, the metadata
+        embedded in the shared file belongs to the file it was linked to.
+
+        Returns:
+            dict: The new manifest entries by filename
+        """
+        entries = {}
+        for filename in sorted(os.listdir(self.save_dir)):
+            if filename.endswith('.pt') and not filename.endswith(self.OPTIMIZER_SUFFIX):
+                filepath = os.path.join(self.save_dir, filename)
+                try:
+                    record = self._read_metadata_file(filepath)
+                    if record is not None:
+                        entries[filename] = self._manifest_entry(filepath, record['metadata'], record['timestamp'])
+                        entries[filename]['deduplicated_from'] = record.get('deduplicated_from')
+                    else:
+                        checkpoint = self.load_checkpoint(filepath, map_location='cpu')
+                        entries[filename] = self._manifest_entry(filepath, checkpoint.get('metadata', {}), checkpoint.get('timestamp', os.path.getmtime(filepath)))
+                except Exception as e:
+                    print(f"Error loading {filepath}: {e}")
+
+        lock_path = self._lock_manifest()
+        try:
+            self._write_manifest(entries)
+        finally:
+            os.remove(lock_path)
+        print(f"Manifest rebuilt with {len(entries)} models: {self.manifest_path}")
+        return entries
+
+    def list_models(self, sort_by: str = 'test_reward', descending: bool = True) -> list:
+        """
+        List the models of the save directory from the manifest.
+
+        Args:
+            sort_by: Manifest field or metric to sort by
+            descending: Sort order
+
+        Returns:
+            list: Manifest entries of the models whose files exist
+        """
+        entries = [
+            entry for filename, entry in self.read_manifest().items()
+            if os.path.exists(os.path.join(self.save_dir, filename))
+        ]
+
+        def sort_key(entry):
+            value = entry.get(sort_by, entry.get('metrics', {}).get(sort_by))
+            return float('-inf') if value is None else value
+
+        return sorted(entries, key=sort_key, reverse=descending)
+
+    def get_metadata(self, filepath: str) -> Dict[str, Any]:
+        """
+        Get the metadata of a saved model from the manifest, falls back to the separate metadata
+        file of a deduplicated model and then to loading the checkpoint.
+
+        Args:
+            filepath: Path to the model file
+
+        Returns:
+            dict: The metadata
+        """
+        if filepath.endswith(self.INFERENCE_WEIGHTS_SUFFIX):
+            header, _ = read_inference_header(filepath)
+            return json.loads(header.get("__metadata__", {}).get("metadata", "{}"))
+        if os.path.abspath(os.path.dirname(filepath)) == os.path.abspath(self.save_dir):
+            entry = self.read_manifest().get(os.path.basename(filepath))
+            if entry is not None and entry.get('size') == os.path.getsize(filepath):
+                return entry.get('metadata', {})
+        record = self._read_metadata_file(filepath)
+        if record is not None:
+            return record['metadata']
+        return self.load_checkpoint(filepath, map_location='cpu').get('metadata', {})
     
     def save_model(self, 
-                  policy: TensorDictSequential,
+                  policy: "TensorDictSequential",
                   optim: Optional[torch.optim.Optimizer] = None,
                   metadata: Dict[str, Any] = None,
                   filename: Optional[str] = None) -> str:
@@ -502,6 +1139,19 @@ class ModelHandler:
         if optim is not None:
             save_dict['optimizer_state_dict'] = optim.state_dict()
             
+        return self.write_checkpoint(save_dict, self.resolve_filename(filename, metadata))
+
+    def resolve_filename(self, filename: Optional[str], metadata: Dict[str, Any]) -> str:
+        """
+        Returns the filename for a model, generates a timestamped name if filename is None.
+
+        Args:
+            filename: Custom filename or None
+            metadata: Metadata of the model (test_reward and total_steps are used in generated names)
+
+        Returns:
+            str: Filename with .pt extension
+        """
         # Generate filename if not provided
         if filename is None:
             timestamp = time.strftime("%Y%m%d-%H%M%S")
@@ -512,23 +1162,149 @@ class ModelHandler:
         # Ensure file has .pt extension
         if not filename.endswith('.pt'):
             filename += '.pt'
-            
+        return filename
+
+    def _atomic_save(self, obj: Any, filepath: str):
+        """Serializes obj (optionally gzip compressed) to a temporary file and renames it to filepath."""
+        tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+        if self.compress:
+            buffer = io.BytesIO()
+            torch.save(obj, buffer)
+            with gzip.open(tmp_path, 'wb', compresslevel=6) as f:
+                f.write(buffer.getbuffer())
+        else:
+            torch.save(obj, tmp_path)
+        os.replace(tmp_path, filepath)
+
+    def _find_duplicate(self, weights_hash: Optional[str], filename: str) -> Optional[str]:
+        """Returns the path of an existing model file with the same weights, if any."""
+        if weights_hash is None:
+            return None
+        for other_filename, entry in self.read_manifest().items():
+            other_path = os.path.join(self.save_dir, other_filename)
+            if other_filename != filename and entry.get('weights_hash') == weights_hash and os.path.exists(other_path):
+                return other_path
+        return None
+
+    def write_checkpoint(self, save_dict: Dict[str, Any], filename: str) -> str:
+        """
+        Write a save dictionary to the save directory. The file is written to a temporary file
+        first and then renamed, so readers never see a partially written model. The optimizer
+        state is written to a separate file (or dropped if save_optimizer is False) and the
+        retention policy is applied afterwards.
+
+        Args:
+            save_dict: Dictionary with policy_state_dict, metadata, timestamp and optionally optimizer_state_dict
+            filename: Filename of the model
+
+        Returns:
+            str: Path to the saved model file
+        """
         filepath = os.path.join(self.save_dir, filename)
-        
-        # Save the model
-        torch.save(save_dict, filepath)
-        print(f"Model saved to {filepath}")
+        save_dict = dict(save_dict)
+        optimizer_state_dict = save_dict.pop('optimizer_state_dict', None)
+        metadata = save_dict.get('metadata', {})
+        weights_hash = self.weights_hash(save_dict['policy_state_dict'])
+
+        duplicate_path = self._find_duplicate(weights_hash, filename) if self.dedup else None
+        if duplicate_path is not None:
+            # Identical weights exist already: hard-link the file, the manifest keeps the new metadata
+            tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try:
+                os.link(duplicate_path, tmp_path)
+                os.replace(tmp_path, filepath)
+                print(f"Model saved to {filepath} (same weights as {duplicate_path})")
+            except OSError:
+                duplicate_path = None
+        metadata_path = self.metadata_path(filepath)
+        if duplicate_path is not None:
+            # The embedded metadata is the one of the linked file, keep the own metadata next to it,
+            # so that rebuild_manifest and get_metadata do not depend on the manifest
+            tmp_path = f"{metadata_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({
+                    'metadata': metadata,
+                    'timestamp': save_dict['timestamp'],
+                    'deduplicated_from': os.path.basename(duplicate_path)
+                }, f, default=_json_default)
+            os.replace(tmp_path, metadata_path)
+        else:
+            # Save the model
+            self._atomic_save(save_dict, filepath)
+            print(f"Model saved to {filepath}")
+            if os.path.exists(metadata_path):
+                os.remove(metadata_path)  # Do not keep the metadata of an overwritten deduplicated model
+
+        # The optimizer state is only needed for continued training and is stored separately
+        optimizer_path = self.optimizer_path(filepath)
+        if optimizer_state_dict is not None and self.save_optimizer:
+            self._atomic_save(optimizer_state_dict, optimizer_path)
+        elif os.path.exists(optimizer_path):
+            os.remove(optimizer_path)  # Do not keep the optimizer state of an overwritten model
+
+        # Record the model in the manifest
+        entry = self._manifest_entry(filepath, metadata, save_dict['timestamp'])
+        entry.update({
+            'weights_hash': weights_hash,
+            'compressed': self.compress,
+            'has_optimizer': optimizer_state_dict is not None and self.save_optimizer,
+            'deduplicated_from': os.path.basename(duplicate_path) if duplicate_path is not None else None
+        })
+        self.update_manifest({filename: entry})
+
+        self.apply_retention(keep=filename)
         
         return filepath
+
+    def apply_retention(self, keep: Optional[str] = None, keep_top_k: Optional[int] = None, keep_last_n: Optional[int] = None) -> list:
+        """
+        Delete models that are neither among the top-k by test reward nor among the last N saved,
+        together with their optimizer state and metadata files. Nothing is deleted if neither limit is set.
+
+        Args:
+            keep: Filename that is always kept (e.g. the model that was just saved)
+            keep_top_k: Overrides the keep_top_k of the handler
+            keep_last_n: Overrides the keep_last_n of the handler
+
+        Returns:
+            list: Filenames of the deleted models
+        """
+        keep_top_k = self.keep_top_k if keep_top_k is None else keep_top_k
+        keep_last_n = self.keep_last_n if keep_last_n is None else keep_last_n
+        if keep_top_k is None and keep_last_n is None:
+            return []
+
+        # Quantized and distilled models are derived from a training checkpoint and not subject to retention
+        entries = [entry for entry in self.list_models(sort_by='test_reward') if not self.is_derived_model(entry)]
+        kept = {keep} if keep is not None else set()
+        if keep_top_k is not None:
+            kept.update(entry['filename'] for entry in entries[:keep_top_k])
+        if keep_last_n is not None:
+            by_time = sorted(entries, key=lambda entry: entry.get('timestamp') or 0, reverse=True)
+            kept.update(entry['filename'] for entry in by_time[:keep_last_n])
+
+        deleted = [entry['filename'] for entry in entries if entry['filename'] not in kept]
+        for filename in deleted:
+            filepath = os.path.join(self.save_dir, filename)
+            for path in (filepath, self.optimizer_path(filepath), self.metadata_path(filepath)):
+                if os.path.exists(path):
+                    os.remove(path)
+        if deleted:
+            self.update_manifest({filename: None for filename in deleted})
+            print(f"Retention policy removed {len(deleted)} models")
+        return deleted
     
     def load_model(self, 
-                  policy: TensorDictSequential,
+                  policy: "TensorDictSequential",
                   filepath: str, 
                   device: torch.device,
                   optim: Optional[torch.optim.Optimizer] = None,
-                  inference_only: bool = False) -> Tuple[TensorDictSequential, Dict[str, Any]]:
+                  inference_only: bool = False) -> Tuple["TensorDictSequential", Dict[str, Any]]:
         """
         Load a model from a file.
+
+        Inference weights files (.safetensors, see export_inference_weights) are memory-mapped, on
+        the CPU the parameters of the policy use the mapped pages directly.
         
         Args:
             policy: The policy model architecture to load weights into
@@ -543,9 +1319,25 @@ class ModelHandler:
         # Check file exists
         if not os.path.exists(filepath):
             raise FileNotFoundError(f"Model file not found: {filepath}")
+
+        if filepath.endswith(self.INFERENCE_WEIGHTS_SUFFIX):
+            # Weights only, there is no optimizer state in these files
+            state_dict, metadata = load_inference_weights(filepath)
+            if torch.device(device).type == "cpu":
+                policy.load_state_dict(state_dict, assign=True)
+            else:
+                policy.load_state_dict(state_dict)
+            if inference_only:
+                policy.eval()
+            print(f"Model loaded from {filepath} (memory-mapped weights)")
+            return policy, metadata
             
         # Load the checkpoint
-        checkpoint = torch.load(filepath, map_location=device)
+        checkpoint = self.load_checkpoint(filepath, map_location=device)
+
+        # Dynamically quantized checkpoints contain packed int8 weights, the policy needs the same structure
+        if checkpoint.get('metadata', {}).get('quantization') == 'dynamic_int8':
+            policy = quantize_policy(policy)
         
         # Load the policy state dict
         policy.load_state_dict(checkpoint['policy_state_dict'])
@@ -554,12 +1346,22 @@ class ModelHandler:
         if inference_only:
             policy.eval()
         
-        # Load optimizer if provided and available in checkpoint
-        if optim is not None and not inference_only and 'optimizer_state_dict' in checkpoint:
-            optim.load_state_dict(checkpoint['optimizer_state_dict'])
+        # Load optimizer if provided and available (separate file or, for older models, in the checkpoint)
+        if optim is not None and not inference_only:
+            optimizer_path = self.optimizer_path(filepath)
+            if os.path.exists(optimizer_path):
+                optim.load_state_dict(self.load_checkpoint(optimizer_path, map_location=device))
+            elif 'optimizer_state_dict' in checkpoint:
+                optim.load_state_dict(checkpoint['optimizer_state_dict'])
             
-        # Get metadata
+        # Get metadata (deduplicated files are shared, their metadata is in the manifest and in a separate file)
         metadata = checkpoint.get('metadata', {})
+        entry = self.read_manifest().get(os.path.basename(filepath)) if os.path.abspath(os.path.dirname(filepath)) == os.path.abspath(self.save_dir) else None
+        record = self._read_metadata_file(filepath)
+        if entry is not None and entry.get('deduplicated_from'):
+            metadata = entry.get('metadata', metadata)
+        elif record is not None:
+            metadata = record['metadata']
         
         print(f"Model loaded from {filepath}")
         if 'test_reward' in metadata:
@@ -571,27 +1373,27 @@ class ModelHandler:
     
     def find_best_model(self) -> Optional[str]:
         """
-        Find the best performing model in the save directory.
+        Find the best performing model in the save directory. Only the manifest is read, it is
+        rebuilt once if the directory contains models but no manifest.
         
         Returns:
             str or None: Path to the best model file, or None if no models found
         """
         best_reward = float('-inf')
         best_model_path = None
-        
-        for filename in os.listdir(self.save_dir):
-            if filename.endswith('.pt'):
-                filepath = os.path.join(self.save_dir, filename)
-                try:
-                    checkpoint = torch.load(filepath, map_location='cpu')
-                    metadata = checkpoint.get('metadata', {})
-                    reward = metadata.get('test_reward', float('-inf'))
-                    
-                    if reward > best_reward:
-                        best_reward = reward
-                        best_model_path = filepath
-                except Exception as e:
-                    print(f"Error loading {filepath}: {e}")
+
+        if not os.path.exists(self.manifest_path) and any(f.endswith('.pt') and not f.endswith(self.OPTIMIZER_SUFFIX) for f in os.listdir(self.save_dir)):
+            self.rebuild_manifest()
+
+        for entry in self.list_models(sort_by='test_reward'):
+            reward = entry.get('test_reward')
+            # Quantized models need run_inference(quantized=True), distilled models are evaluated
+            # differently (see distill_policy.py), neither are candidates here
+            if reward is None or self.is_derived_model(entry):
+                continue
+            if reward > best_reward:
+                best_reward = reward
+                best_model_path = os.path.join(self.save_dir, entry['filename'])
         
         if best_model_path:
             print(f"Found best model: {best_model_path} with reward: {best_reward}")
@@ -600,8 +1402,266 @@ class ModelHandler:
             
         return best_model_path
 
+    def export_inference_weights(self, filepath: str, output_path: Optional[str] = None) -> str:
+        """
+        Convert a checkpoint into the weights-only inference format (see save_inference_weights).
+
+        The result contains the policy weights and the metadata, but no optimizer state and no
+        pickled objects. Loading it (load_model, run_inference) memory-maps the file, which makes
+        the start of inference workers fast and lets the workers of a host share the weights.
+
+        Args:
+            filepath: Path to a checkpoint written by save_model
+            output_path: Path of the inference weights file, defaults to the checkpoint path with .safetensors
+
+        Returns:
+            str: Path to the inference weights file
+        """
+        checkpoint = self.load_checkpoint(filepath, map_location='cpu')
+        if checkpoint.get('metadata', {}).get('quantization'):
+            raise ValueError("Quantized checkpoints cannot be exported as inference weights")
+
+        if output_path is None:
+            output_path = os.path.splitext(filepath)[0] + self.INFERENCE_WEIGHTS_SUFFIX
+        # get_metadata, the metadata embedded in a deduplicated checkpoint belongs to the file it is linked to
+        metadata = dict(self.get_metadata(filepath), source_checkpoint=os.path.basename(filepath))
+        save_inference_weights(checkpoint['policy_state_dict'], output_path, metadata)
+        print(f"Inference weights exported to {output_path}")
+        return output_path
+
+    def export_quantized_model(self,
+                               policy: "TensorDictSequential",
+                               dataset_test: Optional[pd.DataFrame] = None,
+                               metadata: Dict[str, Any] = None,
+                               filename: str = "best_model_int8.pt") -> Tuple[str, Optional[Dict[str, float]]]:
+        """
+        Export a dynamically quantized (int8 Linear layers) variant of the policy for CPU inference.
+
+        If a test dataset is given, the quantized policy is compared with the fp32 policy (action
+        agreement and reward delta, see check_policy_drift) and the result is stored in the metadata.
+
+        Args:
+            policy: The trained fp32 policy
+            dataset_test: Optional test dataset for the drift check
+            metadata: Additional information to save with the model
+            filename: Filename of the quantized model
+
+        Returns:
+            Tuple: (path to the saved model file, drift report or None)
+        """
+        metadata = dict(metadata) if metadata is not None else {}
+
+        # Quantized Linear layers only run on the CPU
+        fp32_policy = copy.deepcopy(policy).cpu().eval()
+        int8_policy = quantize_policy(fp32_policy)
+
+        drift = None
+        if dataset_test is not None:
+            drift = check_policy_drift(fp32_policy, int8_policy, dataset_test, device=torch.device("cpu"))
+            print(f"Quantization drift: action agreement = {drift['action_agreement']:.2%}, "
+                  f"reward fp32 = {drift['reference_reward']:.2f}, reward int8 = {drift['candidate_reward']:.2f}")
+            metadata['quantization_drift'] = drift
+
+        metadata['quantization'] = 'dynamic_int8'
+        filepath = self.save_model(int8_policy, metadata=metadata, filename=filename)
+        return filepath, drift
+
+    def export_serving_model(self,
+                             policy: "TensorDictSequential",
+                             env: "AdOptimizationEnv",
+                             metadata: Dict[str, Any] = None,
+                             filename: str = "best_model_serving.pt",
+                             export_format: str = "torchscript") -> str:
+        """
+        Export the greedy policy as a self-contained artifact for lightweight serving.
+
+        The artifact contains the normalization constants of the environment, the flatten step,
+        the value network and the argmax (see ServingPolicy). It takes raw keyword metrics, cash and
+        holdings and returns the action and the Q-values. It can be loaded with policy_runtime.py,
+        which only needs torch (TorchScript) or onnxruntime (ONNX).
+
+        ONNX is optional: the export needs the onnx package and serving needs onnxruntime, neither
+        is part of environment.yml. Quantized policies (quantize_policy) can only be exported to
+        TorchScript, the ONNX exporter does not support dynamically quantized layers.
 
-def create_policy(env, feature_dim, num_keywords, device):
+        Args:
+            policy: The trained policy (fp32, or quantized for TorchScript)
+            env: Environment that provides the normalization constants and dimensions
+            metadata: Additional information to save with the artifact
+            filename: Filename of the artifact
+            export_format: "torchscript" or "onnx"
+
+        Returns:
+            str: Path to the exported artifact
+        """
+        if export_format not in ("torchscript", "onnx"):
+            raise ValueError(f"Unknown export format: {export_format}")
+        if export_format == "onnx" and importlib.util.find_spec("onnx") is None:
+            raise ImportError("ONNX export needs the onnx package (pip install onnx, and onnxruntime for serving), "
+                              "use export_format='torchscript' to serve with plain torch")
+
+        metadata = dict(metadata) if metadata is not None else {}
+        metadata.update({
+            'num_keywords': env.num_keywords,
+            'feature_columns': list(feature_columns),
+            'keywords': list(env.panel.keywords),
+            'format': export_format
+        })
+
+        # The value network is the second module of the policy (flatten -> value network -> argmax)
+        value_net = copy.deepcopy(policy.module[1].module).cpu().eval()
+        if export_format == "onnx" and any(isinstance(module, torch.ao.nn.quantized.dynamic.Linear) for module in value_net.modules()):
+            raise ValueError("Quantized policies can only be exported to TorchScript, export the fp32 policy to ONNX")
+        serving_policy = ServingPolicy(value_net, env.feature_means.cpu(), env.feature_stds.cpu(), env.cash_mean, env.cash_std).eval()
+
+        example_inputs = (
+            torch.zeros(2, env.num_keywords, env.num_features),
+            torch.zeros(2),
+            torch.zeros(2, env.num_keywords)
+        )
+        filepath = os.path.join(self.save_dir, filename)
+
+        with torch.no_grad():
+            if export_format == "torchscript":
+                traced = torch.jit.trace(serving_policy, example_inputs)
+                torch.jit.save(traced, filepath, _extra_files={"metadata.json": json.dumps(metadata)})
+            else:
+                torch.onnx.export(
+                    serving_policy,
+                    example_inputs,
+                    filepath,
+                    input_names=["keyword_features", "cash", "holdings"],
+                    output_names=["action", "q_values"],
+                    dynamic_axes={name: {0: "batch"} for name in ["keyword_features", "cash", "holdings", "action", "q_values"]},
+                    opset_version=17
+                )
+                # ONNX has no place for arbitrary metadata, store it next to the model
+                with open(filepath + ".json", "w") as f:
+                    json.dump(metadata, f)
+
+        print(f"Serving model exported to {filepath}")
+        return filepath
+
+
+class PolicyCache:
+    """
+    A process-wide LRU cache of loaded policies with hot reload.
+
+    Policies are cached per checkpoint path, device and architecture key. When a checkpoint changes on
+    disk (mtime/size, confirmed by the content hash), the new weights are loaded into a freshly built
+    policy and the cache entry is swapped atomically. Callers that are still running inference with the
+    old policy object keep using it undisturbed, the next get() returns the new one.
+
+    Attributes:
+        max_entries (int): Maximum number of cached policies.
+        max_bytes (int or None): Maximum total size of the cached parameters and buffers.
+        check_interval (float): Minimum time in seconds between two checks of a checkpoint file.
+    """
+
+    def __init__(self, max_entries: int = 4, max_bytes: Optional[int] = None, check_interval: float = 1.0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.check_interval = check_interval
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _policy_bytes(policy):
+        return sum(t.numel() * t.element_size() for t in policy.state_dict().values() if isinstance(t, torch.Tensor))
+
+    def get(self,
+            filepath: str,
+            build_policy: Callable[[], "TensorDictSequential"],
+            device: torch.device,
+            architecture: Any = None) -> Tuple["TensorDictSequential", Dict[str, Any]]:
+        """
+        Returns the cached policy for a checkpoint, loading or reloading it if necessary.
+
+        Args:
+            filepath: Path to the model file
+            build_policy: Callable that creates an untrained policy with the right architecture
+            device: Device to load the model to
+            architecture: Hashable description of the architecture (part of the cache key)
+
+        Returns:
+            Tuple: (policy, metadata_dict)
+        """
+        key = (os.path.abspath(filepath), str(device), architecture)
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                if now - entry['checked'] < self.check_interval:
+                    return entry['policy'], entry['metadata']
+                entry['checked'] = now
+
+        stat = os.stat(filepath)
+        if entry is not None and (stat.st_mtime_ns, stat.st_size) == (entry['mtime_ns'], entry['size']):
+            return entry['policy'], entry['metadata']
+
+        sha256 = file_sha256(filepath)
+        if entry is not None and sha256 == entry['sha256']:
+            # Only the timestamp changed (e.g. the file was touched or copied), keep the weights
+            with self._lock:
+                entry['mtime_ns'], entry['size'] = stat.st_mtime_ns, stat.st_size
+            return entry['policy'], entry['metadata']
+
+        # (Re)load outside of the lock into a new policy object, in-flight inference keeps the old one
+        policy, metadata = ModelHandler(save_dir=os.path.dirname(filepath) or '.').load_model(
+            policy=build_policy(),
+            filepath=filepath,
+            device=device,
+            inference_only=True
+        )
+        new_entry = {
+            'policy': policy,
+            'metadata': metadata,
+            'mtime_ns': stat.st_mtime_ns,
+            'size': stat.st_size,
+            'sha256': sha256,
+            'bytes': self._policy_bytes(policy),
+            'checked': now
+        }
+        if entry is not None:
+            print(f"Checkpoint {filepath} changed, reloaded policy")
+
+        with self._lock:
+            self._entries[key] = new_entry
+            self._entries.move_to_end(key)
+            self._evict()
+        return policy, metadata
+
+    def _evict(self):
+        """Removes least recently used entries until the count and size limits are met (lock must be held)."""
+        while len(self._entries) > 1 and (
+            len(self._entries) > self.max_entries or
+            (self.max_bytes is not None and sum(e['bytes'] for e in self._entries.values()) > self.max_bytes)
+        ):
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        """Removes all cached policies."""
+        with self._lock:
+            self._entries.clear()
+
+
+_policy_cache = None
+
+
+def get_policy_cache() -> PolicyCache:
+    """Returns the process-wide PolicyCache."""
+    global _policy_cache
+    if _policy_cache is None:
+        _policy_cache = PolicyCache()
+    return _policy_cache
+
+
+DEFAULT_NUM_CELLS = (256, 256, 128, 64)
+
+
+def create_policy(env, feature_dim, num_keywords, device, keyword_groups=None, num_cells=None):
     """
     Creates a policy network with the standard architecture.
     
@@ -610,27 +1670,43 @@ def create_policy(env, feature_dim, num_keywords, device):
         feature_dim: Dimension of features per keyword
         num_keywords: Number of keywords
         device: Device to create the policy on
+        keyword_groups: Optional group index per keyword (see build_keyword_groups). If given,
+            a two-level HierarchicalQNet is used instead of the flat MLP.
+        num_cells: Hidden layer sizes of the value network. Defaults to DEFAULT_NUM_CELLS.
         
     Returns:
         policy: The complete policy model
     """
+    from tensordict.nn import TensorDictModule, TensorDictSequential
+    from torchrl.modules import MLP, QValueModule
+
     action_dim = env.action_spec.shape[-1]
     total_input_dim = feature_dim * num_keywords + 1 + num_keywords  # features per keyword + cash + holdings
+    num_cells = list(num_cells) if num_cells is not None else list(DEFAULT_NUM_CELLS)
     
-    # Create the flattening module
+    # The environment already provides the packed observation, it is passed on as a view (no copy).
+    # The module is kept in first position so that the parameter names of saved models do not change.
     flatten_module = TensorDictModule(
-        FlattenInputs(),
-        in_keys=[("observation", "keyword_features"), ("observation", "cash"), ("observation", "holdings")],
+        nn.Identity(),
+        in_keys=[("observation", "flat")],
         out_keys=["flattened_input"]
     )
     
     # Create the value network
-    value_mlp = MLP(
-        in_features=total_input_dim, 
-        out_features=action_dim, 
-        num_cells=[256, 256, 128, 64],  # Deeper and wider architecture
-        activation_class=nn.ReLU  # ReLU often performs better than Tanh
-    )
+    if keyword_groups is not None:
+        # Two-level action space: keyword group first, then the keyword within the group
+        value_mlp = HierarchicalQNet(
+            in_features=total_input_dim,
+            keyword_groups=keyword_groups,
+            num_cells=num_cells
+        )
+    else:
+        value_mlp = MLP(
+            in_features=total_input_dim, 
+            out_features=action_dim, 
+            num_cells=num_cells,  # Deeper and wider architecture by default
+            activation_class=nn.ReLU  # ReLU often performs better than Tanh
+        )
     
     value_net = TensorDictModule(value_mlp, in_keys=["flattened_input"], out_keys=["action_value"])
     
@@ -640,7 +1716,236 @@ def create_policy(env, feature_dim, num_keywords, device):
     return policy.to(device)
 
 
-def run_inference(model_path, dataset_test, device, feature_columns):
+def greedy_policy(policy):
+    """
+    Returns the greedy (exploration free) decision policy for a policy from create_policy.
+
+    For a HierarchicalQNet the argmax over all flat Q-values is replaced by the two-level decision
+    of HierarchicalGreedyModule, which only computes the Q-values of the selected keyword group.
+    The returned policy shares its modules with policy, so loaded weights are used by both. Other
+    policies are returned unchanged.
+    """
+    from tensordict.nn import TensorDictModule, TensorDictSequential
+
+    flatten_module, value_net = policy.module[0], policy.module[1]
+    if not isinstance(value_net.module, HierarchicalQNet):
+        return policy
+    return TensorDictSequential(
+        flatten_module,
+        TensorDictModule(HierarchicalGreedyModule(value_net.module), in_keys=["flattened_input"], out_keys=["action"])
+    )
+
+
+def create_policy_for_checkpoint(env, filepath, device, keyword_groups=None):
+    """
+    Creates a policy with the architecture recorded in the metadata of a saved model (num_cells
+    and keyword_groups), e.g. for distilled models with a smaller value network.
+
+    Args:
+        env: Environment containing action_spec
+        filepath: Path to the model file
+        device: Device to create the policy on
+        keyword_groups: Group index per keyword, only used if the metadata does not record it
+
+    Returns:
+        policy: The untrained policy model
+    """
+    metadata = ModelHandler(save_dir=os.path.dirname(filepath) or '.').get_metadata(filepath)
+    if 'keyword_groups' in metadata:
+        keyword_groups = metadata['keyword_groups']
+    if keyword_groups is not None:
+        keyword_groups = np.asarray(keyword_groups, dtype=np.int64)
+    return create_policy(
+        env,
+        env.num_features,
+        env.num_keywords,
+        device,
+        keyword_groups=keyword_groups,
+        num_cells=metadata.get('num_cells')
+    )
+
+
+def snapshot_to_cpu(value):
+    """Returns a copy of a (nested) state dict with all tensors detached and copied to the CPU."""
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        snapshot = type(value)((k, snapshot_to_cpu(v)) for k, v in value.items())
+        if hasattr(value, '_metadata'):
+            snapshot._metadata = copy.deepcopy(value._metadata)  # Module versions of state dicts
+        return snapshot
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot_to_cpu(v) for v in value)
+    return copy.deepcopy(value)
+
+
+def summarize_state_dict(state_dict):
+    """Returns a one-line summary of a state dict (number of tensors and parameters, weight norm)."""
+    tensors = [t for t in state_dict.values() if isinstance(t, torch.Tensor) and t.is_floating_point()]
+    num_parameters = sum(t.numel() for t in tensors)
+    weight_norm = torch.sqrt(sum((t.detach().float() ** 2).sum() for t in tensors)).item() if tensors else 0.0
+    return f"{len(tensors)} tensors, {num_parameters} parameters, weight norm {weight_norm:.4f}"
+
+
+class AsyncCheckpointWriter:
+    """
+    Writes checkpoints in a background thread so that training never waits for disk I/O.
+
+    submit() takes a snapshot of the state dicts on the CPU (a memory copy) and returns immediately.
+    The writer thread saves the snapshot with ModelHandler.write_checkpoint (temporary file and
+    atomic rename). If several snapshots for the same filename are waiting, only the latest one is
+    written, e.g. when new best models are found in quick succession.
+
+    Attributes:
+        model_handler (ModelHandler): The handler that writes the checkpoints.
+        num_submitted (int): Number of submitted snapshots.
+        num_coalesced (int): Number of snapshots that were replaced by a newer one before being written.
+    """
+
+    def __init__(self, model_handler: "ModelHandler"):
+        self.model_handler = model_handler
+        self.num_submitted = 0
+        self.num_coalesced = 0
+        self._pending = OrderedDict()  # filename -> save_dict
+        self._writing = False
+        self._closed = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name="checkpoint-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self,
+               policy: "TensorDictSequential",
+               optim: Optional[torch.optim.Optimizer] = None,
+               metadata: Dict[str, Any] = None,
+               filename: Optional[str] = None):
+        """
+        Queue a checkpoint, arguments as in ModelHandler.save_model.
+
+        Returns:
+            str: Path the checkpoint will be written to
+        """
+        metadata = copy.deepcopy(metadata) if metadata is not None else {}
+        save_dict = {
+            'policy_state_dict': snapshot_to_cpu(policy.state_dict()),
+            'metadata': metadata,
+            'timestamp': time.time()
+        }
+        if optim is not None:
+            save_dict['optimizer_state_dict'] = snapshot_to_cpu(optim.state_dict())
+        filename = self.model_handler.resolve_filename(filename, metadata)
+
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("AsyncCheckpointWriter is closed")
+            if filename in self._pending:
+                self.num_coalesced += 1
+            self._pending[filename] = save_dict
+            self._pending.move_to_end(filename)
+            self.num_submitted += 1
+            self._condition.notify_all()
+        return os.path.join(self.model_handler.save_dir, filename)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending and not self._closed:
+                    self._condition.wait()
+                if not self._pending:
+                    return
+                filename, save_dict = self._pending.popitem(last=False)
+                self._writing = True
+            try:
+                self.model_handler.write_checkpoint(save_dict, filename)
+            except Exception as e:
+                print(f"Error writing checkpoint {filename}: {e}")
+            finally:
+                with self._condition:
+                    self._writing = False
+                    self._condition.notify_all()
+
+    def flush(self):
+        """Wait until all queued checkpoints are written."""
+        with self._condition:
+            while self._pending or self._writing:
+                self._condition.wait()
+
+    def close(self):
+        """Write the queued checkpoints and stop the writer thread."""
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._thread.join()
+
+
+def quantize_policy(policy):
+    """
+    Returns a dynamically quantized copy of the policy: the weights of all Linear layers are stored as
+    int8 and the activations are quantized on the fly. The quantized policy runs on the CPU.
+
+    Args:
+        policy: The fp32 policy
+
+    Returns:
+        policy: The quantized policy
+    """
+    fp32_policy = copy.deepcopy(policy).cpu().eval()
+    return torch.ao.quantization.quantize_dynamic(fp32_policy, {nn.Linear}, dtype=torch.qint8)
+
+
+def check_policy_drift(reference_policy, candidate_policy, dataset, device):
+    """
+    Compares a candidate policy (e.g. a quantized model) with a reference policy on a dataset.
+
+    The action agreement is measured on the observations of the reference trajectory. The rewards
+    are the total rewards of one greedy episode of each policy.
+
+    Args:
+        reference_policy: The reference policy (e.g. the fp32 model)
+        candidate_policy: The policy to compare
+        dataset: Dataset for the evaluation episodes
+        device: Device to run on
+
+    Returns:
+        dict: action_agreement, reference_reward, candidate_reward, reward_delta and steps
+    """
+    from ad_optimization_env import AdOptimizationEnv
+
+    reference_env = AdOptimizationEnv(dataset, device=device)
+    candidate_env = AdOptimizationEnv(dataset, device=device)
+    reference_td = reference_env.reset()
+    candidate_td = candidate_env.reset()
+
+    reference_reward, candidate_reward = 0.0, 0.0
+    reference_done, candidate_done = False, False
+    agreements, steps = 0, 0
+
+    with torch.no_grad():
+        while not (reference_done and candidate_done):
+            if not reference_done:
+                reference_td = reference_policy(reference_td)
+                # Action of the candidate for the same observation
+                candidate_action = candidate_policy(reference_td.select("observation"))["action"]
+                agreements += int(candidate_action.argmax(-1).item() == reference_td["action"].argmax(-1).item())
+                steps += 1
+                reference_td = reference_env.step(reference_td)
+                reference_reward += reference_td["reward"].item()
+                reference_done = reference_td["done"].item()
+            if not candidate_done:
+                candidate_td = candidate_policy(candidate_td)
+                candidate_td = candidate_env.step(candidate_td)
+                candidate_reward += candidate_td["reward"].item()
+                candidate_done = candidate_td["done"].item()
+
+    return {
+        'action_agreement': agreements / max(steps, 1),
+        'reference_reward': reference_reward,
+        'candidate_reward': candidate_reward,
+        'reward_delta': candidate_reward - reference_reward,
+        'steps': steps
+    }
+
+
+def run_inference(model_path, dataset_test, device, feature_columns, keyword_groups=None, quantized=False):
     """
     Run inference using a saved model
     
@@ -649,25 +1954,54 @@ def run_inference(model_path, dataset_test, device, feature_columns):
         dataset_test: Test dataset 
         device: Device to run on
         feature_columns: List of feature column names
+        keyword_groups: Group index per keyword if the model was trained with hierarchical actions
+            (only used if the metadata of the model does not record the keyword groups)
+        quantized: Set to True if model_path is an int8 model from ModelHandler.export_quantized_model (runs on the CPU)
     """
+    from ad_optimization_env import AdOptimizationEnv
+
+    if quantized:
+        # Dynamically quantized models only run on the CPU
+        device = torch.device("cpu")
+
     # Create test environment
     test_env = AdOptimizationEnv(dataset_test, device=device)
     
     # Get dimensions
     feature_dim = len(feature_columns)
     num_keywords = test_env.num_keywords
+
+    # The architecture (hidden layers, keyword groups) is recorded in the metadata of the model
+    model_metadata = ModelHandler(save_dir=os.path.dirname(model_path) or '.').get_metadata(model_path)
+    if 'keyword_groups' in model_metadata:
+        keyword_groups = model_metadata['keyword_groups']
+    num_cells = model_metadata.get('num_cells')
     
-    # Create a fresh policy with the same architecture
-    inference_policy = create_policy(test_env, feature_dim, num_keywords, device)
-    
-    # Load the saved model handler
-    model_handler = ModelHandler()
-    inference_policy, metadata = model_handler.load_model(
-        policy=inference_policy,
-        filepath=model_path,
-        device=device,
-        inference_only=True
+    # Get the policy from the process-wide cache, it is only built and loaded if the checkpoint
+    # is not cached yet or changed on disk
+    architecture = (
+        feature_dim,
+        num_keywords,
+        quantized,
+        None if keyword_groups is None else hashlib.sha1(np.asarray(keyword_groups, dtype=np.int64).tobytes()).hexdigest(),
+        None if num_cells is None else tuple(num_cells)
+    )
+    inference_policy, metadata = get_policy_cache().get(
+        model_path,
+        lambda: create_policy(
+            test_env,
+            feature_dim,
+            num_keywords,
+            device,
+            keyword_groups=None if keyword_groups is None else np.asarray(keyword_groups, dtype=np.int64),
+            num_cells=num_cells
+        ),
+        device,
+        architecture=architecture
     )
+
+    # Greedy two-level decision for hierarchical models: only the Q-values of the selected keyword group are computed
+    inference_policy = greedy_policy(inference_policy)
     
     # Run inference
     test_td = test_env.reset()
@@ -688,7 +2022,79 @@ def run_inference(model_path, dataset_test, device, feature_columns):
     return total_reward, inference_policy
 
 
-def learn(params=None, train_data=None, test_data=None):
+class PhaseTimer:
+    """
+    Accumulates the wall-clock time of the phases of a training loop.
+
+    On CUDA devices the device is synchronized at the phase boundaries, otherwise asynchronous kernels
+    would be counted in the phase that waits for them.
+
+    Example:
+        timer = PhaseTimer(device)
+        with timer.phase("sampling"):
+            sample = rb.sample(batch_size)
+        timer.summary()  # {'sampling': {'seconds': ..., 'percent': ..., 'count': ...}, ..., 'other': {...}}
+    """
+
+    def __init__(self, device=None):
+        self.synchronize = device is not None and torch.device(device).type == "cuda"
+        self.seconds = OrderedDict()
+        self.counts = OrderedDict()
+        self.start_time = time.perf_counter()
+
+    def add(self, name, seconds):
+        """Adds time to a phase, for phases that cannot be wrapped in phase() (e.g. iterating a collector)."""
+        self.seconds[name] = self.seconds.get(name, 0.0) + seconds
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+    def now(self):
+        if self.synchronize:
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self.now()
+        try:
+            yield
+        finally:
+            self.add(name, self.now() - start)
+
+    def summary(self):
+        """
+        Returns the seconds, share of the elapsed time (percent) and number of calls per phase. The time
+        not spent in any phase since the timer was created is reported as 'other'.
+        """
+        elapsed = time.perf_counter() - self.start_time
+        phases = OrderedDict(
+            (name, {'seconds': seconds, 'percent': 100.0 * seconds / elapsed if elapsed > 0 else 0.0, 'count': self.counts[name]})
+            for name, seconds in self.seconds.items()
+        )
+        other = max(0.0, elapsed - sum(self.seconds.values()))
+        phases['other'] = {'seconds': other, 'percent': 100.0 * other / elapsed if elapsed > 0 else 0.0, 'count': 0}
+        return phases
+
+
+def peak_memory_mb(device):
+    """
+    Returns the peak memory in MB: the peak allocated CUDA memory since the last
+    torch.cuda.reset_peak_memory_stats on CUDA devices, otherwise the peak resident set size of the
+    process (not resettable, so it covers everything the process did before as well).
+    """
+    if torch.device(device).type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    try:
+        import resource
+    except ImportError:
+        return None  # Windows
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, kilobytes on Linux
+    return peak / 2 ** 20 if os.uname().sysname == "Darwin" else peak / 2 ** 10
+
+
+def learn(params=None, train_data=None, test_data=None, device=None, writer=None, save_dir='saves', progress_callback=None,
+          max_steps=10_000, resume_from=None, training_state_path=None, stats=None, max_frames=None,
+          relative_budget=False, final_inference=True):
     """
     Trains an advertisement optimization model using reinforcement learning.
 
@@ -706,10 +2112,61 @@ def learn(params=None, train_data=None, test_data=None):
             Weight decay (L2 regularization) for the optimizer. Default is 1e-5.
         - eps : float, optional
             Initial value for epsilon in epsilon-greedy exploration. Default is 0.99.
-    train_data : DataFrame, optional
-        Training dataset. If None, synthetic data will be generated.
-    test_data : DataFrame, optional
+        - hierarchical_actions : bool, optional
+            Use the two-level action space (keyword group, then keyword). Default is False.
+        - num_keyword_groups : int, optional
+            Number of keyword groups for the hierarchical action space. Default is ceil(sqrt(num_keywords)).
+        - num_cells : list of int, optional
+            Hidden layer sizes of the value network. Default is DEFAULT_NUM_CELLS.
+        - optim_steps : int, optional
+            Gradient steps per collected batch of 100 frames. Default is 10.
+    train_data : DataFrame or KeywordPanel, optional
+        Training dataset. If None, synthetic data will be generated. Panels (e.g. memory-mapped and
+        shared by several tuning trials) are used without copying.
+    test_data : DataFrame or KeywordPanel, optional
         Test dataset. If None, synthetic data will be generated.
+    device : torch.device, optional
+        Device to train on. Defaults to the best device of the machine (see get_device).
+    writer : SummaryWriter, optional
+        TensorBoard writer. Defaults to the module-wide writer (see get_writer).
+    save_dir : str, optional
+        Directory for the saved models. Default is 'saves'. Parallel runs (e.g. tuning trials)
+        should use separate directories.
+    progress_callback : callable, optional
+        Called after every periodic test evaluation as progress_callback(total_steps, test_reward).
+        If it returns True, training stops and learn returns the best test reward so far without
+        the final inference run (e.g. for pruning in hyperparameter tuning).
+    max_steps : int, optional
+        Training budget: training stops once more than max_steps training steps were done (counted
+        from the start of the first run if resumed). None for no step limit. Default is 10_000.
+    resume_from : str, optional
+        Training state written by a previous learn call (see training_state_path) to continue from:
+        policy, target network, optimizer, exploration, replay buffer and counters are restored,
+        so no random warm-up is collected again.
+    training_state_path : str, optional
+        If given, the complete training state is written to this file when training stops, so a
+        later call can continue with a larger max_steps (multi-fidelity tuning).
+    stats : dict, optional
+        If given, filled with the cost of the run: collected frames, gradient steps, training time
+        (seconds), frames_per_second, gradient_steps_per_second, time_to_best_reward (seconds until
+        the best test reward was reached, None if a resumed run did not improve it),
+        peak_memory_mb (see peak_memory_mb) and phases, the seconds spent in collection,
+        replay_extend, sampling, loss_backward, target_update, evaluation, checkpointing and other
+        (see PhaseTimer). total_steps and total_frames are the training steps and collected frames
+        counted from the start of the first run.
+    max_frames : int, optional
+        Frame budget: training stops once max_frames frames were collected (including the random
+        warm-up, counted from the start of the first run if resumed). Unlike the training steps,
+        which grow by frames_per_batch per gradient step, the frames do not depend on optim_steps.
+        Default is None (no frame limit).
+    relative_budget : bool, optional
+        Count max_steps and max_frames from the resumed training state instead of the start of the
+        first run, e.g. a fixed number of steps per interval of population based training.
+        Default is False.
+    final_inference : bool, optional
+        Run the best model on the test data at the end (run_inference) and return its reward. If
+        False, the best test reward of the periodic evaluations is returned, e.g. for runs that are
+        continued later. Default is True.
 
     Returns:
     --------
@@ -724,6 +2181,20 @@ def learn(params=None, train_data=None, test_data=None):
     - The best model is saved based on test performance.
     - TensorBoard is used for logging training metrics.
     """
+    from tensordict.nn import TensorDictSequential
+    from torchrl.collectors import SyncDataCollector
+    from torchrl.data import LazyTensorStorage, ReplayBuffer
+    from torchrl.modules import EGreedyModule
+    from torchrl.objectives import DQNLoss, SoftUpdate
+    from ad_optimization_env import AdOptimizationEnv
+
+    if max_steps is None and max_frames is None:
+        raise ValueError("learn needs a budget, max_steps or max_frames")
+    if device is None:
+        device = get_device()
+    if writer is None:
+        writer = get_writer()
+    print("Device used: ", device)
     
     if (train_data is not None) and (test_data is not None):
         # Use the provided training and test data
@@ -732,32 +2203,36 @@ def learn(params=None, train_data=None, test_data=None):
     else:
         # Load the organized dataset if the file exists
         if os.path.exists(file_path):
-            # If file exists, load it directly
-            dataset = pd.read_csv(file_path)
+            # If file exists, load its panel (columnar cache, the CSV file is only parsed once)
+            dataset = load_panel(file_path)
             print(f"Dataset loaded from {file_path}")
         else:
-            # If file doesn't exist, generate synthetic data
+            # If file doesn't exist, generate synthetic data (20 keywords, 5000 time steps)
             print(f"File {file_path} not found. Generating synthetic data...")       
-            # Create the directory if it doesn't exist
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            dataset = generate_synthetic_data(1000)
-            dataset = pd.read_csv(file_path)
+            write_synthetic_dataset(file_path, num_keywords=20, num_steps=5000)
+            dataset = load_panel(file_path)
             print(f"Dataset loaded from newly created {file_path}")
-        # Split it into training and test data
-        dataset_training, dataset_test = split_dataset_by_ratio(dataset, train_ratio=0.8)
+        # Split it into training and test data (by time steps, as split_dataset_by_ratio)
+        dataset_training, dataset_test = dataset.split(train_ratio=0.8)
+
+    if params is None:
+        # Create an empty one, the default values will be used when fetching the hyperparameters
+        params = {
+        }
+
+    init_rand_steps = 5000
+    frames_per_batch = 100
+    optim_steps = params.get('optim_steps', 10)  # Gradient steps per collected batch
 
     # Initialize Environment
-    env = AdOptimizationEnv(dataset_training, device=device)
+    # The collector stacks the observations of a whole batch before copying them, so the observation
+    # buffer needs enough slots for all steps (and resets) of one batch
+    env = AdOptimizationEnv(dataset_training, device=device, observation_slots=2 * frames_per_batch + 2, writer=writer)
     
     # Define data and dimensions
     feature_dim = len(feature_columns)
     num_keywords = env.num_keywords
 
-    # Hyperparameters
-    if params is None:
-        # Create an empty one, the default values will be used when fetching the hyperparameters
-        params = {
-        }
     # Extract hyperparameters
     lr = params.get('lr', 0.001) # Learning rate for the optimizer
     batch_size = params.get('batch_size', 128) # Batch size for training
@@ -765,12 +2240,32 @@ def learn(params=None, train_data=None, test_data=None):
     exploration_eps_init = params.get('exploration_eps_init', 0.9) # Initial value for epsilon in epsilon-greedy exploration
     exploration_eps_end = params.get('exploration_eps_end', 0.01)   # Final value for epsilon in epsilon-greedy exploration
     softupdate_eps = params.get('softupdate_eps', 0.99)  # Soft update rate for target network
+    gamma = params.get('gamma', 0.99)  # Discount factor for future rewards
+    hierarchical_actions = params.get('hierarchical_actions', False)  # Two-level action space (keyword group, keyword)
+    num_keyword_groups = params.get('num_keyword_groups', None)  # Number of keyword groups, None = ceil(sqrt(num_keywords))
+    keep_top_k = params.get('keep_top_k', None)  # Keep only the k best checkpoints (plus keep_last_n), None = keep all
+    keep_last_n = params.get('keep_last_n', None)  # Keep only the n most recent checkpoints (plus keep_top_k), None = keep all
+    save_optimizer = params.get('save_optimizer', True)  # Store the optimizer state (separate file) for continued training
+    compress_checkpoints = params.get('compress_checkpoints', False)  # gzip compressed checkpoints
+    dedup_checkpoints = params.get('dedup_checkpoints', False)  # Hard-link checkpoints with identical weights
+    num_cells = list(params.get('num_cells', DEFAULT_NUM_CELLS))  # Hidden layer sizes of the value network
+
+    # Training state of a previous run to continue from
+    resume_state = torch.load(resume_from, map_location=device) if resume_from is not None else None
+
+    # Cluster the keywords once if the hierarchical action space is used (a resumed run keeps its groups)
+    if resume_state is not None:
+        keyword_groups = None if resume_state['keyword_groups'] is None else np.asarray(resume_state['keyword_groups'], dtype=np.int64)
+    else:
+        keyword_groups = build_keyword_groups(dataset_training, num_keyword_groups) if hierarchical_actions else None
 
     # Create the main policy for training
-    policy = create_policy(env, feature_dim, num_keywords, device)
+    policy = create_policy(env, feature_dim, num_keywords, device, keyword_groups=keyword_groups, num_cells=num_cells)
 
     # Create the evaluation policy (now using the same architecture)
-    policy_eval = create_policy(env, feature_dim, num_keywords, device)
+    policy_eval = create_policy(env, feature_dim, num_keywords, device, keyword_groups=keyword_groups, num_cells=num_cells)
+    # Greedy decisions of the evaluation policy (two-level for hierarchical actions, shares the weights of policy_eval)
+    policy_greedy = greedy_policy(policy_eval)
 
     exploration_module = EGreedyModule(
         env.action_spec, annealing_num_steps=100_000, eps_init=exploration_eps_init, eps_end=exploration_eps_end
@@ -778,32 +2273,68 @@ def learn(params=None, train_data=None, test_data=None):
     exploration_module = exploration_module.to(device)
     policy_explore = TensorDictSequential(policy, exploration_module).to(device)
 
-    init_rand_steps = 5000
-    frames_per_batch = 100
-    optim_steps = 10
     collector = SyncDataCollector(
         env,
         policy_explore,
         frames_per_batch=frames_per_batch,
         total_frames=-1,
-        init_random_frames=init_rand_steps,
+        init_random_frames=init_rand_steps if resume_state is None else 0,  # A resumed replay buffer is already filled
     )
     replay_buffer_size = 100_000
     rb = ReplayBuffer(storage=LazyTensorStorage(replay_buffer_size))
 
     loss = DQNLoss(value_network=policy, action_space=env.action_spec, delay_value=True).to(device)
+    loss.make_value_estimator(gamma=gamma)
     
     optim = Adam(loss.parameters(), lr=lr, weight_decay=weight_decay)  # Add weight decay for regularization
     updater = SoftUpdate(loss, eps=softupdate_eps)
 
     total_count = 0
     total_episodes = 0
+    total_frames = 0  # Cost of this call (not restored on resume)
+    frames_before = 0  # Frames collected by the resumed runs
+    gradient_steps = 0
+    time_to_best_reward = None
+    if torch.device(device).type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    timer = PhaseTimer(device)  # Wall-clock time per phase of the training loop
     t0 = time.time()
     # Evaluation parameters
     evaluation_frequency = 1000  # Run evaluation every 1000 steps
     best_test_reward = float('-inf')
-    test_env = AdOptimizationEnv(dataset_test, device=device)  # Create a test environment with the test dataset
-    model_handler = ModelHandler(save_dir='saves')
+    stopped_early = False  # Set when the progress callback requests to stop
+
+    if resume_state is not None:
+        loss.load_state_dict(resume_state['loss_state_dict'])  # Value and target network
+        optim.load_state_dict(resume_state['optimizer_state_dict'])
+        exploration_module.load_state_dict(resume_state['exploration_state_dict'])
+        # The hyperparameters of this call apply from now on (they may differ from the resumed run,
+        # e.g. in population based training), the current exploration epsilon is kept
+        for param_group in optim.param_groups:
+            param_group['lr'] = lr
+            param_group['weight_decay'] = weight_decay
+        exploration_module.eps_init.fill_(exploration_eps_init)
+        exploration_module.eps_end.fill_(exploration_eps_end)
+        rb.load_state_dict(resume_state['replay_buffer_state_dict'])
+        total_count = resume_state['total_count']
+        total_episodes = resume_state['total_episodes']
+        best_test_reward = resume_state['best_test_reward']
+        frames_before = resume_state.get('total_frames', 0)
+        print(f"Resumed training from {resume_from} after {total_count} steps (best test reward {best_test_reward})")
+
+    # Budgets of this call, counted from the start of the first run or from the resumed state
+    step_limit = None if max_steps is None else max_steps + (total_count if relative_budget else 0)
+    frame_limit = None if max_frames is None else max_frames + (frames_before if relative_budget else 0)
+    test_env = AdOptimizationEnv(dataset_test, device=device, writer=writer)  # Create a test environment with the test dataset
+    model_handler = ModelHandler(
+        save_dir=save_dir,
+        keep_top_k=keep_top_k,
+        keep_last_n=keep_last_n,
+        save_optimizer=save_optimizer,
+        compress=compress_checkpoints,
+        dedup=dedup_checkpoints
+    )
+    checkpoint_writer = AsyncCheckpointWriter(model_handler)  # Saves in a background thread
  
     # Write the hyperparameters to tensorboard
     writer.add_text("Feature Columns", str(feature_columns))
@@ -812,36 +2343,49 @@ def learn(params=None, train_data=None, test_data=None):
     writer.add_text("frames_per_batch", str(frames_per_batch))
     writer.add_text("batch_size", str(batch_size))
     writer.add_text("optim_steps", str(optim_steps))
+    writer.add_text("num_cells", str(num_cells))
     writer.add_text("lr", str(lr))
     writer.add_text("weight_decay", str(weight_decay))
     writer.add_text("exploration_eps_init", str(exploration_eps_init))
     writer.add_text("exploration_eps_end", str(exploration_eps_end))
     writer.add_text("softupdate_eps", str(softupdate_eps))
+    writer.add_text("gamma", str(gamma))
+    writer.add_text("hierarchical_actions", str(hierarchical_actions))
+    if keyword_groups is not None:
+        writer.add_text("num_keyword_groups", str(int(keyword_groups.max()) + 1))
  
+    collection_start = timer.now()
     for i, data in enumerate(collector):
+        timer.add("collection", timer.now() - collection_start)
         # Write data in replay buffer
         step_count = data["step_count"]
 
         print(f'data: step_count: {step_count}')
-        rb.extend(data.to(device))
-        max_length = rb[:]["step_count"].max()
+        with timer.phase("replay_extend"):
+            rb.extend(data.to(device))
+            total_frames += data.numel()
+            max_length = rb[:]["step_count"].max()
         if len(rb) > init_rand_steps:
             # Optim loop (we do several optim steps per batch collected for efficiency)
             for _ in range(optim_steps):
-                sample = rb.sample(batch_size)
+                with timer.phase("sampling"):
+                    sample = rb.sample(batch_size)
+                    # Make sure sample is on the correct device
+                    sample = sample.to(device)  # Move the sample to the specified device
                 total_count += data.numel()
 
-                # Make sure sample is on the correct device
-                sample = sample.to(device)  # Move the sample to the specified device
-                loss_vals = loss(sample)
-                writer.add_scalar("Loss Value", loss_vals["loss"].item(), total_count)
-                loss_vals["loss"].backward()
-                optim.step()
-                optim.zero_grad()
-                # Update exploration factor
-                exploration_module.step(data.numel())
-                # Update target params
-                updater.step()
+                with timer.phase("loss_backward"):
+                    loss_vals = loss(sample)
+                    writer.add_scalar("Loss Value", loss_vals["loss"].item(), total_count)
+                    loss_vals["loss"].backward()
+                    optim.step()
+                    optim.zero_grad()
+                gradient_steps += 1
+                with timer.phase("target_update"):
+                    # Update exploration factor
+                    exploration_module.step(data.numel())
+                    # Update target params
+                    updater.step()
                 if i % 10 == 0:  # Fixed condition (was missing '== 0')
                     print(f"Max num steps: {max_length}, rb length {len(rb)}")
 
@@ -850,30 +2394,31 @@ def learn(params=None, train_data=None, test_data=None):
                 # Evaluate on test data periodically
                 if total_count % evaluation_frequency == 0:
                     print(f"\n--- Testing model performance after {total_count} training steps ---")
-                    # Use policy without exploration for evaluation
-                    policy_eval.load_state_dict(policy.state_dict())  # Just use the trained policy without exploration
-                    policy_eval.eval()
-
-                    # Reset the test environment
-                    test_td = test_env.reset()
-                    total_test_reward = 0.0
-                    done = False
-                    max_test_steps = 100  # Limit test steps to avoid infinite loops
-                    test_step = 0
-
-                    # Run the model on test environment until done or max steps reached
-                    while not done and test_step < max_test_steps:
-                        # Forward pass through policy without exploration
-                        with torch.no_grad():
-                            # Get Q-values
-                            test_td = policy_eval(test_td)
-
-                        # Step in the test environment
-                        test_td = test_env.step(test_td)
-                        reward = test_td["reward"].item()
-                        total_test_reward += reward
-                        done = test_td["done"].item()
-                        test_step += 1
+                    with timer.phase("evaluation"):
+                        # Use policy without exploration for evaluation
+                        policy_eval.load_state_dict(policy.state_dict())  # Just use the trained policy without exploration
+                        policy_eval.eval()
+
+                        # Reset the test environment
+                        test_td = test_env.reset()
+                        total_test_reward = 0.0
+                        done = False
+                        max_test_steps = 100  # Limit test steps to avoid infinite loops
+                        test_step = 0
+
+                        # Run the model on test environment until done or max steps reached
+                        while not done and test_step < max_test_steps:
+                            # Forward pass through policy without exploration
+                            with torch.no_grad():
+                                # Get the greedy action
+                                test_td = policy_greedy(test_td)
+
+                            # Step in the test environment
+                            test_td = test_env.step(test_td)
+                            reward = test_td["reward"].item()
+                            total_test_reward += reward
+                            done = test_td["done"].item()
+                            test_step += 1
 
                     writer.add_scalar("Test performance", total_test_reward, total_count)
                     print(f"Test performance: Total reward = {total_test_reward}, Steps = {test_step}")
@@ -881,50 +2426,102 @@ def learn(params=None, train_data=None, test_data=None):
                     # Save model if it's the best so far
                     if total_test_reward > best_test_reward:
                         best_test_reward = total_test_reward
+                        time_to_best_reward = time.time() - t0
                         print(f"New best model! Saving with reward: {best_test_reward}")
 
-                        # Save the model
-                        model_handler.save_model(
-                            policy=policy,
-                            optim=optim,
-                            metadata={
-                                'total_steps': total_count,
-                                'test_reward': best_test_reward,
-                                'test_steps': test_step,
-                                'num_keywords': num_keywords,
-                                'feature_columns': feature_columns
-                            },
-                            filename=f"best_model.pt"  # Overwrite the same file for best model
-                        )
-                        print(policy.state_dict())
+                        # Save the model (snapshot now, written to disk in the background)
+                        with timer.phase("checkpointing"):
+                            checkpoint_writer.submit(
+                                policy=policy,
+                                optim=optim,
+                                metadata={
+                                    'total_steps': total_count,
+                                    'test_reward': best_test_reward,
+                                    'test_steps': test_step,
+                                    'num_keywords': num_keywords,
+                                    'feature_columns': feature_columns,
+                                    'keyword_groups': keyword_groups.tolist() if keyword_groups is not None else None,
+                                    'num_cells': num_cells,
+                                    'dataset_fingerprint': env.panel.fingerprint(),
+                                    'hyperparameters': params
+                                },
+                                filename=f"best_model.pt"  # Overwrite the same file for best model
+                            )
+                        print(f"Policy: {summarize_state_dict(policy.state_dict())}")
 
                     print("--- Testing completed ---\n")
 
-        if total_count > 10_000:
+                    if progress_callback is not None and progress_callback(total_count, total_test_reward):
+                        print(f"Training stopped by the progress callback after {total_count} steps")
+                        stopped_early = True
+                        break
+
+        out_of_frames = frame_limit is not None and frames_before + total_frames >= frame_limit
+        if stopped_early or out_of_frames or (step_limit is not None and total_count > step_limit):
             break
+        collection_start = timer.now()
 
     t1 = time.time()
 
+    # Wait for the last checkpoints before looking for the best model
+    with timer.phase("checkpointing"):
+        checkpoint_writer.close()
+    phases = timer.summary()
+    for name, phase in phases.items():
+        writer.add_scalar(f"Phase seconds/{name}", phase['seconds'], total_count)
+        writer.add_scalar(f"Phase percent/{name}", phase['percent'], total_count)
+    writer.add_text("Phase breakdown", ", ".join(f"{name}: {phase['seconds']:.1f}s ({phase['percent']:.1f}%)" for name, phase in phases.items()))
+    print("Time per phase: " + ", ".join(f"{name} {phase['percent']:.1f}%" for name, phase in phases.items()))
+
     print(f"Finished after {total_count} steps, {total_episodes} episodes and in {t1-t0}s.")
     print(f"Best test performance: {best_test_reward}")
 
+    if stats is not None:
+        stats.update({
+            'frames': total_frames,
+            'gradient_steps': gradient_steps,
+            'train_time': t1 - t0,
+            'frames_per_second': total_frames / (t1 - t0),
+            'gradient_steps_per_second': gradient_steps / (t1 - t0),
+            'time_to_best_reward': time_to_best_reward,
+            'peak_memory_mb': peak_memory_mb(device),
+            'phases': {name: phase['seconds'] for name, phase in phases.items()},
+            'total_steps': total_count,
+            'total_frames': frames_before + total_frames
+        })
+
+    if training_state_path is not None:
+        # Everything a later call needs to continue the training (see resume_from)
+        training_state = {
+            'loss_state_dict': loss.state_dict(),
+            'optimizer_state_dict': optim.state_dict(),
+            'exploration_state_dict': exploration_module.state_dict(),
+            'replay_buffer_state_dict': rb.state_dict(),
+            'total_count': total_count,
+            'total_frames': frames_before + total_frames,
+            'total_episodes': int(total_episodes),
+            'best_test_reward': best_test_reward,
+            'keyword_groups': keyword_groups.tolist() if keyword_groups is not None else None,
+            'hyperparameters': params
+        }
+        os.makedirs(os.path.dirname(training_state_path) or '.', exist_ok=True)
+        tmp_path = f"{training_state_path}.{os.getpid()}.tmp"
+        torch.save(training_state, tmp_path)
+        os.replace(tmp_path, training_state_path)
+        print(f"Training state saved to {training_state_path}")
+
+    if stopped_early or not final_inference:
+        return best_test_reward
+
     # Run inference with the best model
     best_model_path = model_handler.find_best_model()
     if best_model_path:
-        total_reward, _ = run_inference(best_model_path, dataset_test, device, feature_columns)
+        total_reward, _ = run_inference(best_model_path, dataset_test, device, feature_columns, keyword_groups=keyword_groups)
         return total_reward
     else:
         return best_test_reward
 
 # Some global variables
-# Select the best device for our machine
-device = torch.device(
-    "cuda" if torch.cuda.is_available() else
-    "mps" if torch.backends.mps.is_available() else
-    "cpu"
-)
-print("Device used: ", device)
-
 # Define the feature columns
 feature_columns = ["competitiveness", "difficulty_score", "organic_rank", "organic_clicks", "organic_ctr", "paid_clicks", "paid_ctr", "ad_spend", "ad_conversions", "ad_roas", "conversion_rate", "cost_per_click"]
 
@@ -932,17 +2529,8 @@ if __name__ == "__main__":
     # Check if the dataset file exists before running learn()
     if not os.path.exists(file_path):
         print(f"Dataset file {file_path} not found. Creating directory and generating synthetic data...")
-        # Create the directory if it doesn't exist
-        os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        
-        # Generate synthetic data
-        synthetic_data = pd.DataFrame()
-
-        for i in range(5000):
-            synthetic_data = pd.concat([synthetic_data, generate_synthetic_data(20)], ignore_index=True)
-        
-        # Save the generated data to CSV
-        synthetic_data.to_csv(file_path, index=False)
+        # Generate synthetic data (20 keywords, 5000 time steps) and save it to CSV, streamed in chunks
+        write_synthetic_dataset(file_path, num_keywords=20, num_steps=5000)
         print(f"Synthetic data generated and saved to {file_path}")
     
     # Now run the learning process
@@ -24,6 +24,7 @@ from torchrl.data.tensor_specs import (
 from torchrl.envs import EnvBase
 from torchrl.modules import EGreedyModule, MLP, QValueModule
 from torchrl.objectives import DQNLoss, SoftUpdate
+from dataset_cache import load_dataset
 
 # Define the file path
 file_path = 'data/organized_dataset.csv'
@@ -734,16 +735,16 @@ def learn(params=None, train_data=None, test_data=None):
     else:
         # Load the organized dataset if the file exists
         if os.path.exists(file_path):
-            # If file exists, load it directly
-            dataset = pd.read_csv(file_path)
+            # If file exists, load it through the columnar cache (the CSV file is only parsed once)
+            dataset = load_dataset(file_path)
             print(f"Dataset loaded from {file_path}")
         else:
             # If file doesn't exist, generate synthetic data
             print(f"File {file_path} not found. Generating synthetic data...")       
             # Create the directory if it doesn't exist
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
-            dataset = generate_synthetic_data(1000)
-            dataset = pd.read_csv(file_path)
+            dataset = pd.concat([generate_synthetic_data(20) for i in range(5000)], ignore_index=True)
+            dataset.to_csv(file_path, index=False)
             print(f"Dataset loaded from newly created {file_path}")
         # Split it into training and test data
         dataset_training, dataset_test = split_dataset_by_ratio(dataset, train_ratio=0.8)
@@ -940,10 +941,8 @@ if __name__ == "__main__":
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
         
         # Generate synthetic data
-        synthetic_data = pd.DataFrame()
-
-        for i in range(5000):
-            synthetic_data = pd.concat([synthetic_data, generate_synthetic_data(20)], ignore_index=True)
+        # One concatenation of all blocks (concatenating in the loop copies the growing frame every time)
+        synthetic_data = pd.concat([generate_synthetic_data(20) for i in range(5000)], ignore_index=True)
         
         # Save the generated data to CSV
         synthetic_data.to_csv(file_path, index=False)
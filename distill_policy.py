@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Distillation of a trained policy into a compact value network for cheaper inference.
+#
+# The teacher (a checkpoint written by learn) is rolled out on the training data, with some random
+# actions so that the student also sees holdings off the greedy trajectory. A small MLP is then
+# trained to match the teacher's Q-values (regression) or its greedy actions (classification).
+# The student is compared with the teacher on the test data (action agreement and reward, see
+# check_policy_drift) and saved through ModelHandler with its lineage in the metadata. run_inference
+# and the decision service rebuild the smaller architecture from the metadata (num_cells).
+
+import os
+import copy
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+from torch.optim import Adam
+
+from dataset_cache import load_dataset
+from digital_advertising import (
+    AdOptimizationEnv, ModelHandler, check_policy_drift, create_policy, create_policy_for_checkpoint,
+    feature_columns, file_path, file_sha256, split_dataset_by_ratio
+)
+
+
+def count_parameters(module):
+    """Returns the number of parameters of a module."""
+    return sum(p.numel() for p in module.parameters())
+
+
+def measure_latency(value_net, observation_dim, batch_size=256, repeats=50):
+    """Returns the mean time in seconds of a forward pass of the value network on a CPU batch."""
+    value_net = copy.deepcopy(value_net).cpu().eval()  # A copy, the network itself stays on its device
+    x = torch.randn(batch_size, observation_dim)
+    with torch.no_grad():
+        value_net(x)  # Warm-up
+        t0 = time.perf_counter()
+        for _ in range(repeats):
+            value_net(x)
+    return (time.perf_counter() - t0) / repeats
+
+
+def collect_teacher_targets(teacher, dataset, device, episodes=5, exploration_eps=0.2, seed=0):
+    """
+    Rolls out the teacher on a dataset and records the observations and the teacher Q-values.
+
+    The first episode is greedy, in the following episodes a random action is taken with
+    probability exploration_eps, so the student also learns the holdings states the greedy
+    trajectory does not visit.
+
+    Args:
+        teacher: The trained policy
+        dataset: Dataset for the rollouts
+        device: Device to run on
+        episodes: Number of episodes
+        exploration_eps: Probability of a random action (except in the first episode)
+        seed: Seed of the random actions
+
+    Returns:
+        tuple: (observations [N, observation_dim], q_values [N, num_keywords + 1])
+    """
+    generator = torch.Generator().manual_seed(seed)
+    env = AdOptimizationEnv(dataset, device=device)
+    observations, q_values = [], []
+
+    with torch.no_grad():
+        for episode in range(episodes):
+            td = env.reset()
+            done = False
+            while not done:
+                td = teacher(td)
+                # The observation is a view into the buffer of the environment, it has to be copied
+                observations.append(td["observation", "flat"].clone())
+                q_values.append(td["action_value"].clone())
+                if episode > 0 and torch.rand((), generator=generator).item() < exploration_eps:
+                    action = torch.zeros_like(td["action"])
+                    action[torch.randint(action.shape[-1], (), generator=generator).item()] = 1
+                    td["action"] = action
+                td = env.step(td)
+                done = td["done"].item()
+
+    return torch.stack(observations), torch.stack(q_values)
+
+
+def train_student(student, observations, teacher_q_values, mode="q_values", epochs=50, batch_size=256,
+                  lr=1e-3, weight_decay=0.0, temperature=1.0, seed=0):
+    """
+    Trains the value network of the student on the teacher targets.
+
+    Args:
+        student: The student policy (see create_policy)
+        observations: Observations [N, observation_dim]
+        teacher_q_values: Teacher Q-values [N, num_keywords + 1]
+        mode: "q_values" (mean squared error on the Q-values) or "actions" (cross entropy on the
+            greedy actions of the teacher)
+        epochs: Number of passes over the observations
+        batch_size: Batch size
+        lr: Learning rate
+        weight_decay: Weight decay
+        temperature: Temperature of the student logits in "actions" mode
+        seed: Seed of the batch order
+
+    Returns:
+        dict: Final loss and action agreement on the training observations
+    """
+    if mode not in ("q_values", "actions"):
+        raise ValueError(f"Unknown distillation mode: {mode}")
+
+    value_net = student.module[1].module
+    value_net.train()
+    optim = Adam(value_net.parameters(), lr=lr, weight_decay=weight_decay)
+    teacher_actions = teacher_q_values.argmax(-1)
+    generator = torch.Generator().manual_seed(seed)
+
+    for epoch in range(epochs):
+        total_loss = 0.0
+        permutation = torch.randperm(observations.shape[0], generator=generator).to(observations.device)
+        for indices in permutation.split(batch_size):
+            q_values = value_net(observations[indices])
+            if mode == "q_values":
+                loss = F.mse_loss(q_values, teacher_q_values[indices])
+            else:
+                loss = F.cross_entropy(q_values / temperature, teacher_actions[indices])
+            optim.zero_grad()
+            loss.backward()
+            optim.step()
+            total_loss += loss.item() * indices.numel()
+
+        if (epoch + 1) % 10 == 0 or epoch == epochs - 1:
+            print(f"Epoch {epoch + 1}/{epochs}: loss = {total_loss / observations.shape[0]:.6f}")
+
+    value_net.eval()
+    with torch.no_grad():
+        agreement = (value_net(observations).argmax(-1) == teacher_actions).float().mean().item()
+    return {'loss': total_loss / observations.shape[0], 'train_action_agreement': agreement}
+
+
+def distill(teacher_path, dataset_training, dataset_test, device, num_cells=(64, 32), mode="q_values",
+            episodes=5, exploration_eps=0.2, epochs=50, batch_size=256, lr=1e-3, weight_decay=0.0,
+            temperature=1.0, seed=0, save_dir=None, filename=None):
+    """
+    Distills a saved policy into a student with a smaller value network and saves the student.
+
+    Args:
+        teacher_path: Path to the teacher model
+        dataset_training: Dataset for the teacher rollouts
+        dataset_test: Dataset for the comparison of teacher and student
+        device: Device to run on
+        num_cells: Hidden layer sizes of the student
+        mode, epochs, batch_size, lr, weight_decay, temperature, seed: See train_student
+        episodes, exploration_eps: See collect_teacher_targets
+        save_dir: Directory for the student, defaults to the directory of the teacher
+        filename: Filename of the student, defaults to a generated name
+
+    Returns:
+        tuple: (path to the saved student, report dict)
+    """
+    torch.manual_seed(seed)
+    env = AdOptimizationEnv(dataset_training, device=device)
+    teacher_handler = ModelHandler(save_dir=os.path.dirname(teacher_path) or '.')
+    teacher, teacher_metadata = teacher_handler.load_model(
+        policy=create_policy_for_checkpoint(env, teacher_path, device),
+        filepath=teacher_path,
+        device=device,
+        inference_only=True
+    )
+
+    observations, teacher_q_values = collect_teacher_targets(
+        teacher, dataset_training, device, episodes=episodes, exploration_eps=exploration_eps, seed=seed
+    )
+    print(f"Collected {observations.shape[0]} teacher samples")
+
+    # The student always uses the flat action space
+    student = create_policy(env, env.num_features, env.num_keywords, device, num_cells=num_cells)
+    training = train_student(
+        student, observations, teacher_q_values, mode=mode, epochs=epochs, batch_size=batch_size,
+        lr=lr, weight_decay=weight_decay, temperature=temperature, seed=seed
+    )
+    student.eval()
+
+    drift = check_policy_drift(teacher, student, dataset_test, device)
+    teacher_parameters = count_parameters(teacher.module[1].module)
+    student_parameters = count_parameters(student.module[1].module)
+    teacher_latency = measure_latency(teacher.module[1].module, env.observation_dim)
+    student_latency = measure_latency(student.module[1].module, env.observation_dim)
+
+    report = {
+        'action_agreement': drift['action_agreement'],
+        'train_action_agreement': training['train_action_agreement'],
+        'teacher_reward': drift['reference_reward'],
+        'student_reward': drift['candidate_reward'],
+        'reward_delta': drift['candidate_reward'] - drift['reference_reward'],
+        # A ratio is only meaningful for a positive teacher reward
+        'reward_ratio': drift['candidate_reward'] / drift['reference_reward'] if drift['reference_reward'] > 0 else None,
+        'teacher_parameters': teacher_parameters,
+        'student_parameters': student_parameters,
+        'parameter_ratio': teacher_parameters / student_parameters,
+        'cpu_speedup': teacher_latency / student_latency if student_latency > 0 else None
+    }
+    print(f"Action agreement: {report['action_agreement']:.2%}, reward teacher = {report['teacher_reward']:.2f}, "
+          f"reward student = {report['student_reward']:.2f}")
+    print(f"Parameters: {teacher_parameters} -> {student_parameters} ({report['parameter_ratio']:.1f}x smaller), "
+          f"CPU forward pass {report['cpu_speedup']:.1f}x faster")
+
+    # No test_reward: the student reward is the reward of a full greedy episode (check_policy_drift), not
+    # comparable with the test rewards of learn, so it is only recorded under distillation and
+    # ModelHandler.find_best_model does not consider the student
+    metadata = {
+        'num_keywords': env.num_keywords,
+        'feature_columns': feature_columns,
+        'keyword_groups': None,
+        'num_cells': list(num_cells),
+        'distillation': {
+            'teacher': os.path.abspath(teacher_path),
+            'teacher_sha256': file_sha256(teacher_path),
+            'teacher_test_reward': teacher_metadata.get('test_reward'),
+            'teacher_num_cells': teacher_metadata.get('num_cells'),
+            'teacher_hyperparameters': teacher_metadata.get('hyperparameters'),
+            'mode': mode,
+            'episodes': episodes,
+            'exploration_eps': exploration_eps,
+            'epochs': epochs,
+            'batch_size': batch_size,
+            'lr': lr,
+            'weight_decay': weight_decay,
+            'temperature': temperature,
+            'seed': seed,
+            'samples': observations.shape[0],
+            'final_loss': training['loss'],
+            **report
+        }
+    }
+    if filename is None:
+        teacher_name = os.path.splitext(os.path.basename(teacher_path))[0]
+        filename = f"{teacher_name}_distilled_{'x'.join(str(c) for c in num_cells)}.pt"
+    student_handler = ModelHandler(save_dir=save_dir or teacher_handler.save_dir)
+    filepath = student_handler.save_model(student, metadata=metadata, filename=filename)
+    return filepath, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Distill a trained policy into a compact serving network")
+    parser.add_argument("--teacher", type=str, default=None, help="Teacher checkpoint, defaults to the best model in --save_dir")
+    parser.add_argument("--save_dir", type=str, default="saves", help="Directory of the teacher and the student")
+    parser.add_argument("--dataset", type=str, default=file_path, help="Dataset (the first 80%% of the time steps are the training data, the rest the test data)")
+    parser.add_argument("--num_cells", type=int, nargs="+", default=[64, 32], help="Hidden layer sizes of the student")
+    parser.add_argument("--mode", type=str, default="q_values", choices=["q_values", "actions"], help="Match the Q-values or the greedy actions")
+    parser.add_argument("--episodes", type=int, default=5, help="Number of teacher rollouts")
+    parser.add_argument("--exploration_eps", type=float, default=0.2, help="Probability of random actions in the rollouts")
+    parser.add_argument("--epochs", type=int, default=50, help="Number of training epochs")
+    parser.add_argument("--batch_size", type=int, default=256, help="Batch size")
+    parser.add_argument("--lr", type=float, default=1e-3, help="Learning rate")
+    parser.add_argument("--weight_decay", type=float, default=0.0, help="Weight decay")
+    parser.add_argument("--temperature", type=float, default=1.0, help="Temperature for --mode actions")
+    parser.add_argument("--seed", type=int, default=0, help="Seed")
+    parser.add_argument("--filename", type=str, default=None, help="Filename of the student")
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    teacher_path = args.teacher or ModelHandler(save_dir=args.save_dir).find_best_model()
+    if teacher_path is None:
+        raise FileNotFoundError(f"No teacher model found in {args.save_dir}")
+
+    dataset = load_dataset(args.dataset)
+    dataset_training, dataset_test = split_dataset_by_ratio(dataset, train_ratio=0.8)
+
+    filepath, report = distill(
+        teacher_path, dataset_training, dataset_test, device,
+        num_cells=args.num_cells, mode=args.mode, episodes=args.episodes, exploration_eps=args.exploration_eps,
+        epochs=args.epochs, batch_size=args.batch_size, lr=args.lr, weight_decay=args.weight_decay,
+        temperature=args.temperature, seed=args.seed, save_dir=args.save_dir, filename=args.filename
+    )
+    print(f"Student saved to {filepath}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,490 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Vectorized ensemble training of many Q-networks in one process.
+#
+# The value networks of this project are small MLPs, one training run (one Optuna trial) keeps a CPU
+# core busy with tiny matrix multiplications. This script trains M independent members with different
+# learning rates, weight decays and seeds as one stacked model: the parameters of all members are
+# stacked along a leading member dimension (torch.func.stack_module_state) and the forward pass is
+# vectorized with torch.func.vmap, so every layer of all members is one batched matmul.
+#
+# All members learn from the same replay data. The behavior policy cycles through the members (one
+# collected batch per member, epsilon-greedy), so every member's own trajectories end up in the shared
+# replay buffer. Each member samples its own minibatch, has its own target network and its own Adam
+# state (StackedAdam with per-member learning rate and weight decay), is evaluated on the test data
+# separately and saves its best model to save_dir/member_<m> in the same format as learn.
+
+import os
+import csv
+import copy
+import math
+import time
+import random
+import argparse
+import torch
+
+from dataset_cache import load_panel
+from digital_advertising import (
+    AdOptimizationEnv, AsyncCheckpointWriter, DEFAULT_NUM_CELLS, ModelHandler, create_policy,
+    feature_columns, file_path
+)
+
+# Ranges the member hyperparameters are sampled from: (low, high), sampled on a log scale
+ENSEMBLE_SEARCH_SPACE = {
+    'lr': (1e-4, 1e-2),
+    'weight_decay': (1e-6, 1e-4)
+}
+
+
+def sample_member_params(members, rng):
+    """Samples the learning rate, weight decay and seed of every member."""
+    member_params = []
+    for member in range(members):
+        params = {
+            name: 10 ** rng.uniform(math.log10(low), math.log10(high))
+            for name, (low, high) in ENSEMBLE_SEARCH_SPACE.items()
+        }
+        params['seed'] = rng.randrange(2 ** 31)
+        member_params.append(params)
+    return member_params
+
+
+class StackedAdam:
+    """
+    Adam for parameters stacked along a leading member dimension, with a learning rate and a weight
+    decay per member. The update is the one of torch.optim.Adam (L2 weight decay added to the gradient),
+    computed for all members at once. Every member has its own moment estimates, the members never
+    share optimizer state.
+    """
+
+    def __init__(self, params, lr, weight_decay, betas=(0.9, 0.999), eps=1e-8):
+        """
+        Args:
+            params (dict): Stacked parameters by name, shape [members, ...]
+            lr (torch.Tensor): Learning rate per member, shape [members]
+            weight_decay (torch.Tensor): Weight decay per member, shape [members]
+            betas (tuple): Coefficients of the running averages of the gradient and its square
+            eps (float): Term added to the denominator for numerical stability
+        """
+        self.params = params
+        self.lr = lr
+        self.weight_decay = weight_decay
+        self.betas = betas
+        self.eps = eps
+        self.step_count = 0
+        self.exp_avg = {name: torch.zeros_like(p) for name, p in params.items()}
+        self.exp_avg_sq = {name: torch.zeros_like(p) for name, p in params.items()}
+
+    @staticmethod
+    def _per_member(values, like):
+        # [members] -> [members, 1, ...] to broadcast over the parameter dimensions
+        return values.view(-1, *([1] * (like.dim() - 1)))
+
+    @torch.no_grad()
+    def step(self):
+        self.step_count += 1
+        beta1, beta2 = self.betas
+        bias_correction1 = 1 - beta1 ** self.step_count
+        bias_correction2 = 1 - beta2 ** self.step_count
+        for name, p in self.params.items():
+            if p.grad is None:
+                continue
+            grad = p.grad.add(p * self._per_member(self.weight_decay, p))
+            exp_avg, exp_avg_sq = self.exp_avg[name], self.exp_avg_sq[name]
+            exp_avg.mul_(beta1).add_(grad, alpha=1 - beta1)
+            exp_avg_sq.mul_(beta2).addcmul_(grad, grad, value=1 - beta2)
+            denom = (exp_avg_sq / bias_correction2).sqrt_().add_(self.eps)
+            p.sub_(self._per_member(self.lr, p) * (exp_avg / bias_correction1) / denom)
+
+    def zero_grad(self):
+        for p in self.params.values():
+            p.grad = None
+
+    def member_state_dict(self, member):
+        """Returns the moment estimates of one member, e.g. to continue training it with torch.optim.Adam."""
+        return {
+            'step': self.step_count,
+            'exp_avg': {name: value[member].detach().cpu().clone() for name, value in self.exp_avg.items()},
+            'exp_avg_sq': {name: value[member].detach().cpu().clone() for name, value in self.exp_avg_sq.items()}
+        }
+
+
+class StackedQNetworks:
+    """
+    M value networks with the architecture of create_policy (flat action space), stored as stacked
+    parameters and evaluated with torch.func.vmap.
+    """
+
+    def __init__(self, env, seeds, device, num_cells=None):
+        """
+        Args:
+            env: Environment, defines the observation and action dimensions
+            seeds (list): Seed of the initial weights of every member
+            device: Device of the parameters
+            num_cells: Hidden layer sizes, defaults to DEFAULT_NUM_CELLS
+        """
+        from torch.func import functional_call, stack_module_state
+
+        self.env = env
+        self.device = device
+        self.num_cells = list(num_cells) if num_cells is not None else list(DEFAULT_NUM_CELLS)
+        value_nets = []
+        for seed in seeds:
+            torch.manual_seed(seed)
+            policy = create_policy(env, env.num_features, env.num_keywords, device, num_cells=self.num_cells)
+            value_nets.append(policy.module[1].module)
+        self.params, self.buffers = stack_module_state(value_nets)
+        self.target_params = {name: p.detach().clone() for name, p in self.params.items()}
+
+        # Stateless copy of the architecture, the weights are passed to every call
+        self._base = copy.deepcopy(value_nets[0]).to("meta")
+        self._functional_call = functional_call
+
+    @property
+    def members(self):
+        return next(iter(self.params.values())).shape[0]
+
+    def _forward(self, params, buffers, x):
+        return self._functional_call(self._base, (params, buffers), (x,))
+
+    def __call__(self, x, params=None):
+        """
+        Q-values of all members.
+
+        Args:
+            x (torch.Tensor): Observations per member, shape [members, batch, observation_dim]
+            params (dict, optional): Stacked parameters, defaults to the online parameters
+
+        Returns:
+            torch.Tensor: Q-values, shape [members, batch, num_actions]
+        """
+        from torch.func import vmap
+
+        return vmap(self._forward)(self.params if params is None else params, self.buffers, x)
+
+    def member_q_values(self, member, x):
+        """Q-values of a single member for observations [batch, observation_dim]."""
+        params = {name: p[member] for name, p in self.params.items()}
+        buffers = {name: b[member] for name, b in self.buffers.items()}
+        return self._forward(params, buffers, x)
+
+    @torch.no_grad()
+    def soft_update(self, eps):
+        """Moves the target networks towards the online networks, as torchrl's SoftUpdate."""
+        for name, target in self.target_params.items():
+            target.mul_(eps).add_(self.params[name].detach(), alpha=1 - eps)
+
+    def member_policy(self, member):
+        """Returns a policy (see create_policy) with the weights of one member, e.g. to save it."""
+        policy = create_policy(self.env, self.env.num_features, self.env.num_keywords, self.device, num_cells=self.num_cells)
+        policy.module[1].module.load_state_dict({
+            **{name: p[member].detach() for name, p in self.params.items()},
+            **{name: b[member] for name, b in self.buffers.items()}
+        })
+        return policy
+
+
+class SharedReplayBuffer:
+    """Ring buffer of transitions on the training device, sampled independently by every member."""
+
+    def __init__(self, capacity, observation_dim, device):
+        self.capacity = capacity
+        self.observations = torch.zeros(capacity, observation_dim, device=device)
+        self.next_observations = torch.zeros(capacity, observation_dim, device=device)
+        self.actions = torch.zeros(capacity, dtype=torch.int64, device=device)
+        self.rewards = torch.zeros(capacity, device=device)
+        self.dones = torch.zeros(capacity, device=device)
+        self.position = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, observation, action, reward, next_observation, done):
+        self.observations[self.position] = observation
+        self.next_observations[self.position] = next_observation
+        self.actions[self.position] = action
+        self.rewards[self.position] = reward
+        self.dones[self.position] = float(done)
+        self.position = (self.position + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, members, batch_size, generator=None):
+        """Returns a minibatch per member, every tensor has the shape [members, batch_size, ...]."""
+        indices = torch.randint(self.size, (members, batch_size), generator=generator).to(self.observations.device)
+        return (self.observations[indices], self.actions[indices], self.rewards[indices],
+                self.next_observations[indices], self.dones[indices])
+
+
+def collect_batch(env, td, networks, member, rb, frames, eps, generator):
+    """
+    Steps the environment with the epsilon-greedy policy of one member and stores the transitions.
+
+    Args:
+        env: Training environment
+        td: Current tensordict of the environment
+        networks (StackedQNetworks): The members
+        member (int): Member that acts, None for random actions
+        rb (SharedReplayBuffer): Replay buffer
+        frames (int): Number of steps
+        eps (float): Probability of a random action
+        generator: Random generator of the exploration
+
+    Returns:
+        tuple: (tensordict to continue from, number of finished episodes)
+    """
+    num_actions = env.action_spec.shape[-1]
+    episodes = 0
+    for _ in range(frames):
+        # The observation is a view into the buffer of the environment, it has to be copied
+        observation = td["observation", "flat"].clone()
+        if member is None or torch.rand((), generator=generator).item() < eps:
+            action_idx = torch.randint(num_actions, (), generator=generator).item()
+        else:
+            with torch.no_grad():
+                action_idx = networks.member_q_values(member, observation.unsqueeze(0)).argmax(-1).item()
+        action = torch.zeros(num_actions, dtype=torch.bool, device=observation.device)
+        action[action_idx] = True
+        td["action"] = action
+        td = env.step(td)
+        done = td["done"].item()
+        rb.add(observation, action_idx, td["reward"].item(), td["observation", "flat"], done)
+        if done:
+            episodes += 1
+            td = env.reset()
+    return td, episodes
+
+
+@torch.no_grad()
+def evaluate_members(networks, test_envs, max_test_steps=100):
+    """
+    Runs the greedy policy of every member on its own test environment, the Q-values of all members
+    are computed in one vectorized forward pass per step.
+
+    Returns:
+        tuple: (total reward per member, steps per member)
+    """
+    members = networks.members
+    tds = [test_env.reset() for test_env in test_envs]
+    total_rewards = [0.0] * members
+    steps = [0] * members
+    active = [True] * members
+    for _ in range(max_test_steps):
+        if not any(active):
+            break
+        observations = torch.stack([td["observation", "flat"] for td in tds]).unsqueeze(1)
+        actions = networks(observations).squeeze(1).argmax(-1).tolist()
+        for member in range(members):
+            if not active[member]:
+                continue
+            action = torch.zeros(test_envs[member].action_spec.shape[-1], dtype=torch.bool, device=observations.device)
+            action[actions[member]] = True
+            tds[member]["action"] = action
+            tds[member] = test_envs[member].step(tds[member])
+            total_rewards[member] += tds[member]["reward"].item()
+            steps[member] += 1
+            active[member] = not tds[member]["done"].item()
+    return total_rewards, steps
+
+
+def train_ensemble(member_params, train_data, test_data, device, writer=None, save_dir="saves/ensemble",
+                   max_steps=10_000, batch_size=128, gamma=0.99, softupdate_eps=0.99, exploration_eps_init=0.9,
+                   exploration_eps_end=0.01, num_cells=None, seed=0):
+    """
+    Trains all members together, with the schedule of learn (random warm-up, batches of 100 frames,
+    10 optimization steps per batch, evaluation every 1000 steps).
+
+    Args:
+        member_params (list): Hyperparameters per member, dicts with lr, weight_decay and seed
+        train_data: Training data (DataFrame or KeywordPanel)
+        test_data: Test data (DataFrame or KeywordPanel)
+        device: Device to train on
+        writer: TensorBoard writer, metrics are logged per member (member_<m>/...)
+        save_dir: The best model of member m is saved to save_dir/member_<m>/best_model.pt
+        max_steps: Training steps, counted as in learn
+        batch_size: Minibatch size of every member
+        gamma: Discount factor
+        softupdate_eps: Soft update rate of the target networks
+        exploration_eps_init, exploration_eps_end: Epsilon of the behavior policy, annealed over 100000 steps
+        num_cells: Hidden layer sizes, defaults to DEFAULT_NUM_CELLS
+        seed: Seed of the exploration and the minibatches
+
+    Returns:
+        list: Result per member (hyperparameters, best test reward, steps of the best evaluation, model path)
+    """
+    init_rand_steps = 5000
+    frames_per_batch = 100
+    optim_steps = 10
+    evaluation_frequency = 1000
+    annealing_num_steps = 100_000
+
+    members = len(member_params)
+    generator = torch.Generator().manual_seed(seed)
+    env = AdOptimizationEnv(train_data, device=device)
+    test_envs = [AdOptimizationEnv(test_data, device=device) for _ in range(members)]
+
+    networks = StackedQNetworks(env, [params['seed'] for params in member_params], device, num_cells=num_cells)
+    optim = StackedAdam(
+        networks.params,
+        lr=torch.tensor([params['lr'] for params in member_params], device=device),
+        weight_decay=torch.tensor([params['weight_decay'] for params in member_params], device=device)
+    )
+    rb = SharedReplayBuffer(100_000, env.observation_dim, device)
+
+    checkpoint_writers = [
+        AsyncCheckpointWriter(ModelHandler(save_dir=os.path.join(save_dir, f"member_{member}")))
+        for member in range(members)
+    ]
+    best_test_rewards = [float('-inf')] * members
+    best_steps = [None] * members
+
+    if writer is not None:
+        writer.add_text("members", str(members))
+        writer.add_text("batch_size", str(batch_size))
+        writer.add_text("gamma", str(gamma))
+        writer.add_text("softupdate_eps", str(softupdate_eps))
+        for member, params in enumerate(member_params):
+            writer.add_text(f"member_{member}/hyperparameters", str(params))
+
+    total_count = 0
+    total_episodes = 0
+    batch_index = 0
+    td = env.reset()
+    t0 = time.time()
+
+    # Random warm-up, as init_random_frames of the collector in learn
+    while len(rb) < init_rand_steps:
+        td, episodes = collect_batch(env, td, networks, None, rb, frames_per_batch, 1.0, generator)
+        total_episodes += episodes
+
+    while total_count <= max_steps:
+        # The members take turns as behavior policy
+        eps = exploration_eps_end + (exploration_eps_init - exploration_eps_end) * max(0.0, 1 - total_count / annealing_num_steps)
+        td, episodes = collect_batch(env, td, networks, batch_index % members, rb, frames_per_batch, eps, generator)
+        total_episodes += episodes
+        batch_index += 1
+
+        for _ in range(optim_steps):
+            total_count += frames_per_batch
+            observations, actions, rewards, next_observations, dones = rb.sample(members, batch_size, generator)
+
+            q_values = networks(observations).gather(-1, actions.unsqueeze(-1)).squeeze(-1)
+            with torch.no_grad():
+                next_q_values = networks(next_observations, params=networks.target_params).max(-1).values
+                targets = rewards + gamma * (1 - dones) * next_q_values
+            # Mean squared TD error per member (the default l2 loss of DQNLoss). The sum over the members
+            # keeps the gradients of the members independent of each other.
+            member_losses = ((q_values - targets) ** 2).mean(-1)
+            member_losses.sum().backward()
+            optim.step()
+            optim.zero_grad()
+            networks.soft_update(softupdate_eps)
+
+            if writer is not None:
+                for member, member_loss in enumerate(member_losses.tolist()):
+                    writer.add_scalar(f"member_{member}/Loss Value", member_loss, total_count)
+
+            if total_count % evaluation_frequency == 0:
+                test_rewards, test_steps = evaluate_members(networks, test_envs)
+                print(f"\n--- Testing {members} members after {total_count} training steps ---")
+                for member, (test_reward, steps) in enumerate(zip(test_rewards, test_steps)):
+                    if writer is not None:
+                        writer.add_scalar(f"member_{member}/Test performance", test_reward, total_count)
+                    if test_reward > best_test_rewards[member]:
+                        best_test_rewards[member] = test_reward
+                        best_steps[member] = total_count
+                        checkpoint_writers[member].submit(
+                            policy=networks.member_policy(member),
+                            metadata={
+                                'total_steps': total_count,
+                                'test_reward': test_reward,
+                                'test_steps': steps,
+                                'num_keywords': env.num_keywords,
+                                'feature_columns': feature_columns,
+                                'keyword_groups': None,
+                                'num_cells': networks.num_cells,
+                                'dataset_fingerprint': env.panel.fingerprint(),
+                                'hyperparameters': {
+                                    **member_params[member],
+                                    'batch_size': batch_size,
+                                    'gamma': gamma,
+                                    'softupdate_eps': softupdate_eps,
+                                    'exploration_eps_init': exploration_eps_init,
+                                    'exploration_eps_end': exploration_eps_end
+                                },
+                                'ensemble': {'member': member, 'members': members}
+                            },
+                            filename="best_model.pt"
+                        )
+                print(f"Test performance: best member {max(range(members), key=lambda m: test_rewards[m])} "
+                      f"with reward {max(test_rewards):.2f}, mean reward {sum(test_rewards) / members:.2f}")
+
+    for checkpoint_writer in checkpoint_writers:
+        checkpoint_writer.close()
+    elapsed = time.time() - t0
+    print(f"Finished {members} members after {total_count} steps, {total_episodes} episodes and in {elapsed:.0f}s "
+          f"({members * total_count / elapsed:.0f} member steps/s).")
+
+    return [
+        {
+            'member': member,
+            **member_params[member],
+            'best_test_reward': best_test_rewards[member],
+            'best_step': best_steps[member],
+            'model_path': os.path.join(save_dir, f"member_{member}", "best_model.pt") if best_steps[member] is not None else None
+        }
+        for member in range(members)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train many Q-networks with different hyperparameters as one vectorized ensemble")
+    parser.add_argument("--members", type=int, default=16, help="Number of Q-networks trained together")
+    parser.add_argument("--max_steps", type=int, default=10_000, help="Training steps (as in learn)")
+    parser.add_argument("--batch_size", type=int, default=128, help="Minibatch size per member")
+    parser.add_argument("--gamma", type=float, default=0.99, help="Discount factor")
+    parser.add_argument("--softupdate_eps", type=float, default=0.99, help="Soft update rate of the target networks")
+    parser.add_argument("--num_cells", type=int, nargs="+", default=None, help="Hidden layer sizes (default: DEFAULT_NUM_CELLS)")
+    parser.add_argument("--num_threads", type=int, default=None, help="Number of torch threads")
+    parser.add_argument("--save_dir", type=str, default="saves/ensemble", help="Directory of the member checkpoints and the results")
+    parser.add_argument("--dataset", type=str, default=file_path, help="Dataset CSV")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the member hyperparameters and the exploration")
+    args = parser.parse_args()
+
+    from torch.utils.tensorboard import SummaryWriter
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if not os.path.exists(args.dataset):
+        raise FileNotFoundError(f"Dataset {args.dataset} not found, run digital_advertising.py once to generate it")
+    train_panel, test_panel = load_panel(args.dataset).split(train_ratio=0.8)
+
+    member_params = sample_member_params(args.members, random.Random(args.seed))
+    writer = SummaryWriter(log_dir=os.path.join("runs", "ensemble"))
+    try:
+        results = train_ensemble(
+            member_params, train_panel, test_panel, device, writer=writer, save_dir=args.save_dir,
+            max_steps=args.max_steps, batch_size=args.batch_size, gamma=args.gamma,
+            softupdate_eps=args.softupdate_eps, num_cells=args.num_cells, seed=args.seed
+        )
+    finally:
+        writer.close()
+
+    results.sort(key=lambda result: result['best_test_reward'], reverse=True)
+    os.makedirs(args.save_dir, exist_ok=True)
+    results_path = os.path.join(args.save_dir, "ensemble_results.csv")
+    with open(results_path, "w", newline="") as f:
+        csv_writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        csv_writer.writeheader()
+        csv_writer.writerows(results)
+
+    print(f"{'member':>6} {'lr':>10} {'weight_decay':>12} {'best reward':>12}")
+    for result in results:
+        print(f"{result['member']:>6} {result['lr']:>10.2e} {result['weight_decay']:>12.2e} {result['best_test_reward']:>12.2f}")
+    print(f"Results written to {results_path}")
+
+
+if __name__ == "__main__":
+    main()
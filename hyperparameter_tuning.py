@@ -6,61 +6,799 @@ import torch.nn as nn
 import numpy as np
 import pandas as pd
 import os
+import json
+import time
+import shutil
+import sqlite3
+import hashlib
+import contextlib
 import optuna
 import argparse
+import multiprocessing
 import matplotlib.pyplot as plt
 import seaborn as sns
 from datetime import datetime
 from copy import deepcopy
 
 # Import functions and classes from digital_advertising.py
-from digital_advertising import (
-    AdOptimizationEnv, generate_synthetic_data, create_policy,
-    split_dataset_by_ratio, learn
-)
+from dataset_cache import load_panel
+from digital_advertising import DEFAULT_NUM_CELLS, KeywordPanel, ModelHandler, learn, file_path
 
-# Set device
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-print(f"Using device: {device}")
+# Environment variables that limit the thread pools of torch, OpenMP and the BLAS libraries
+THREAD_ENV_VARS = ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS", "NUMEXPR_NUM_THREADS"]
 
-def objective(trial, dataset):
+# Hidden layer sizes of the value network that are searched (categorical choices must be plain values)
+NUM_CELLS_CHOICES = {
+    'small': [64, 64],
+    'medium': [128, 128, 64],
+    'default': list(DEFAULT_NUM_CELLS)
+}
+
+# Search space of the trials. The distributions are also needed to add cached results to a study.
+SEARCH_SPACE = {
+    'lr': optuna.distributions.FloatDistribution(1e-4, 1e-2, log=True),                  # Learning rate for the optimizer
+    'batch_size': optuna.distributions.CategoricalDistribution([32, 64, 128, 256]),      # Batch size for training
+    'exploration_eps_init': optuna.distributions.FloatDistribution(0.5, 1.0),            # Initial value for epsilon in epsilon-greedy exploration
+    'exploration_eps_end': optuna.distributions.FloatDistribution(0.01, 0.1),            # Final value for epsilon in epsilon-greedy exploration
+    'softupdate_eps': optuna.distributions.FloatDistribution(0.9, 0.99),                 # Soft update rate for target network
+    'gamma': optuna.distributions.FloatDistribution(0.9, 0.99),                          # Discount factor for future rewards
+    'weight_decay': optuna.distributions.FloatDistribution(1e-6, 1e-4)                   # Weight decay for regularization
+}
+
+# Cost dimensions, only searched in the cost-aware mode (--search_cost, implied by --multi_objective).
+# Without them learn uses its default network and gradient steps per batch.
+COST_SEARCH_SPACE = {
+    'network': optuna.distributions.CategoricalDistribution(list(NUM_CELLS_CHOICES)),    # Hidden layer sizes, see NUM_CELLS_CHOICES
+    'optim_steps': optuna.distributions.CategoricalDistribution([2, 5, 10])             # Gradient steps per collected batch
+}
+
+# Training budget of a trial without multi-fidelity (the default of learn)
+MAX_STEPS = 10_000
+
+# Files whose content determines the result of a trial, see code_version
+CODE_FILES = ["digital_advertising.py", "ad_optimization_env.py", "hyperparameter_tuning.py"]
+
+# Cost of a trial recorded as user attributes (see the stats argument of learn)
+COST_ATTRS = ['frames', 'gradient_steps', 'train_time', 'frames_per_second', 'gradient_steps_per_second',
+              'time_to_best_reward', 'peak_memory_mb']
+
+
+def create_storage(storage):
+    """
+    Creates the Optuna storage.
+
+    Args:
+        storage (str): "journal:<path>" for a journal file (append-only log, safe for many concurrent
+            writer processes and, on a shared filesystem, for several hosts) or a database URL
+            (e.g. sqlite:///optuna/digital_ad1.db or postgresql://...).
+
+    Returns:
+        Storage object or URL for optuna.create_study / optuna.load_study
+    """
+    if not storage.startswith("journal:"):
+        return storage
+
+    path = storage[len("journal:"):]
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    try:
+        # Optuna >= 4.0
+        from optuna.storages.journal import JournalFileBackend, JournalFileOpenLock
+        return optuna.storages.JournalStorage(JournalFileBackend(path, lock_obj=JournalFileOpenLock(path)))
+    except ImportError:
+        from optuna.storages import JournalFileOpenLock, JournalFileStorage
+        # The open lock also works on network filesystems (NFS), where symlink locks are not reliable
+        return optuna.storages.JournalStorage(JournalFileStorage(path, lock_obj=JournalFileOpenLock(path)))
+
+
+def limit_threads(num_threads):
+    """Limits the number of threads torch uses in this process."""
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(max(1, num_threads // 2))
+    except RuntimeError:
+        pass  # Can only be set before the first parallel work, keep the default
+
+
+def create_pruner(name, warmup_steps=2000, max_steps=10_000, reduction_factor=3):
+    """
+    Creates the Optuna pruner. The resource of a trial is the number of training steps of learn, in
+    multi-fidelity mode the number of collected frames (the rung budgets).
+
+    Args:
+        name (str): "none", "median", "halving" (successive halving) or "hyperband"
+        warmup_steps (int): Training steps before a trial can be pruned
+        max_steps (int): Training steps of a complete trial (for Hyperband)
+        reduction_factor (int): Only the best 1/reduction_factor of the trials reach the next rung (halving, Hyperband)
+
+    Returns:
+        optuna.pruners.BasePruner
+    """
+    if name == "none":
+        return optuna.pruners.NopPruner()
+    if name == "median":
+        return optuna.pruners.MedianPruner(n_startup_trials=5, n_warmup_steps=warmup_steps)
+    if name == "halving":
+        return optuna.pruners.SuccessiveHalvingPruner(min_resource=warmup_steps, reduction_factor=reduction_factor)
+    if name == "hyperband":
+        return optuna.pruners.HyperbandPruner(min_resource=warmup_steps, max_resource=max_steps, reduction_factor=reduction_factor)
+    raise ValueError(f"Unknown pruner: {name}")
+
+
+def load_panels(train_data, test_data):
+    """Returns the training and test panels, directories (saved panels) are memory-mapped."""
+    if isinstance(train_data, str):
+        train_data = KeywordPanel.load(train_data)
+    if isinstance(test_data, str):
+        test_data = KeywordPanel.load(test_data)
+    return train_data, test_data
+
+
+def fidelity_rungs(min_budget, max_budget, reduction_factor=3):
+    """
+    Returns the training budgets (collected frames) of the rungs of successive halving:
+    min_budget, min_budget * reduction_factor, ... and finally max_budget.
+    """
+    rungs = []
+    budget = min_budget
+    while budget < max_budget:
+        rungs.append(budget)
+        budget *= reduction_factor
+    rungs.append(max_budget)
+    return rungs
+
+
+def search_space(search_cost=False):
+    """Returns the distributions of the trial parameters: SEARCH_SPACE, with search_cost also COST_SEARCH_SPACE."""
+    return {**SEARCH_SPACE, **COST_SEARCH_SPACE} if search_cost else dict(SEARCH_SPACE)
+
+
+def suggest_params(trial, search_cost=False):
+    """Samples the hyperparameters of a trial from search_space(search_cost) (keyed by the Optuna parameter names)."""
+    params = {}
+    for name, distribution in search_space(search_cost).items():
+        if isinstance(distribution, optuna.distributions.CategoricalDistribution):
+            params[name] = trial.suggest_categorical(name, distribution.choices)
+        else:
+            params[name] = trial.suggest_float(name, distribution.low, distribution.high, log=distribution.log)
+    return params
+
+
+def in_search_space(params, search_cost=False):
+    """
+    Returns True if the parameters are a point of search_space(search_cost) (not e.g. cached results of
+    an older search space or of the other search mode).
+    """
+    space = search_space(search_cost)
+    if set(params) != set(space):
+        return False
+    for name, distribution in space.items():
+        if isinstance(distribution, optuna.distributions.CategoricalDistribution):
+            if params[name] not in distribution.choices:
+                return False
+        elif not distribution.low <= params[name] <= distribution.high:
+            return False
+    return True
+
+
+def learn_params(params):
+    """Converts trial parameters into the hyperparameters of learn."""
+    params = dict(params)
+    if 'network' in params:
+        params['num_cells'] = NUM_CELLS_CHOICES[params.pop('network')]
+    return params
+
+
+def normalize_params(params):
+    """
+    Returns a canonical JSON string of the parameters: sorted keys, floats rounded to 12 significant
+    digits (so values that went through a database or a CSV file still match).
+    """
+    def normalize(value):
+        if isinstance(value, float):
+            return float(f"{value:.12g}")
+        if isinstance(value, (list, tuple)):
+            return [normalize(v) for v in value]
+        if isinstance(value, dict):
+            return {k: normalize(v) for k, v in value.items()}
+        return value
+    return json.dumps(normalize(params), sort_keys=True)
+
+
+def dataset_hash(train_data, test_data):
+    """Returns a hash of the content of the training and test panels."""
+    return hashlib.sha256(f"{train_data.fingerprint()}:{test_data.fingerprint()}".encode()).hexdigest()
+
+
+def code_version(files=CODE_FILES):
+    """Returns a hash of the source files that determine the result of a trial."""
+    digest = hashlib.sha256()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in files:
+        with open(os.path.join(directory, name), 'rb') as f:
+            digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+
+class TrialCache:
+    """
+    Results of completed trials in an SQLite database, shared by all studies.
+
+    A result is keyed on the normalized trial parameters, the dataset hash, the code version, the seed
+    and the training budget, so a trial with the same key does not have to be trained again. Pruned
+    trials are not cached (whether a trial is pruned depends on the other trials of its study). Every
+    call opens its own connection, so the cache can be used by several worker processes.
+    """
+
+    def __init__(self, path="optuna/trial_cache.db"):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    params TEXT NOT NULL,
+                    dataset_hash TEXT NOT NULL,
+                    code_version TEXT NOT NULL,
+                    seed INTEGER NOT NULL,
+                    budget TEXT NOT NULL,
+                    reward REAL NOT NULL,
+                    user_attrs TEXT NOT NULL,
+                    model_path TEXT,
+                    study_name TEXT,
+                    trial_number INTEGER,
+                    created REAL NOT NULL
+                )""")
+
+    @contextlib.contextmanager
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=60)
+        try:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.row_factory = sqlite3.Row
+            with connection:  # Commits on success
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def key(params, dataset_hash, code_version, seed, budget):
+        return hashlib.sha256(json.dumps(
+            [normalize_params(params), dataset_hash, code_version, seed, normalize_params(budget)]
+        ).encode()).hexdigest()
+
+    @staticmethod
+    def _entry(row):
+        return {
+            'params': json.loads(row['params']),
+            'reward': row['reward'],
+            'user_attrs': json.loads(row['user_attrs']),
+            'model_path': row['model_path'],
+            'study_name': row['study_name'],
+            'trial_number': row['trial_number']
+        }
+
+    def lookup(self, params, dataset_hash, code_version, seed, budget):
+        """Returns the cached result (dict) of a configuration or None."""
+        with self._connect() as connection:
+            row = connection.execute(
+                "SELECT * FROM results WHERE key = ?", (self.key(params, dataset_hash, code_version, seed, budget),)
+            ).fetchone()
+        return self._entry(row) if row is not None else None
+
+    def store(self, params, dataset_hash, code_version, seed, budget, reward, user_attrs, model_path=None,
+              study_name=None, trial_number=None):
+        """Stores the result of a completed trial (replaces an existing result of the same key)."""
+        with self._connect() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (self.key(params, dataset_hash, code_version, seed, budget), normalize_params(params), dataset_hash,
+                 code_version, seed, normalize_params(budget), reward, json.dumps(user_attrs), model_path,
+                 study_name, trial_number, time.time())
+            )
+
+    def entries(self, dataset_hash, code_version, seed, budget):
+        """Returns all cached results for a dataset, code version, seed and budget."""
+        with self._connect() as connection:
+            rows = connection.execute(
+                "SELECT * FROM results WHERE dataset_hash = ? AND code_version = ? AND seed = ? AND budget = ? ORDER BY created",
+                (dataset_hash, code_version, seed, normalize_params(budget))
+            ).fetchall()
+        return [self._entry(row) for row in rows]
+
+
+def objective_values(reward, cost, multi_objective):
+    """Returns the objective value(s) of a trial: the reward, or (reward, time to reward)."""
+    if not multi_objective:
+        return reward
+    # A run without any improvement of the test reward counts with its complete training time
+    time_to_reward = cost.get('time_to_best_reward')
+    return reward, time_to_reward if time_to_reward is not None else cost.get('train_time')
+
+
+def warm_start(study, cache, dataset_hash, code_version, seed, budget, multi_objective=False, search_cost=False):
+    """
+    Adds the cached results for the same dataset, code version, seed and budget to a study as completed
+    trials, so the sampler starts from them. Configurations the study already contains and results
+    outside search_space(search_cost) are skipped.
+
+    Returns:
+        int: Number of added trials
+    """
+    known = {normalize_params(trial.params) for trial in study.get_trials(deepcopy=False)}
+    added = 0
+    for entry in cache.entries(dataset_hash, code_version, seed, budget):
+        params = entry['params']
+        if not in_search_space(params, search_cost) or normalize_params(params) in known:
+            continue
+        if multi_objective and objective_values(entry['reward'], entry['user_attrs'], True)[1] is None:
+            continue
+        values = objective_values(entry['reward'], entry['user_attrs'], multi_objective)
+        study.add_trial(optuna.trial.create_trial(
+            params=params,
+            distributions=search_space(search_cost),
+            values=list(values) if multi_objective else [values],
+            user_attrs={**entry['user_attrs'], 'cached_from': f"{entry['study_name']}/{entry['trial_number']}"}
+        ))
+        known.add(normalize_params(params))
+        added += 1
+    return added
+
+
+def record_cost(trial, runs):
+    """
+    Stores the cost of a trial as user attributes. runs are the stats dicts of the learn calls of the
+    trial (several in multi-fidelity mode), frames, gradient steps and time are summed over them.
+
+    The wall-clock time per phase of learn is stored as phase_<name>_seconds and phase_<name>_percent
+    (share of the total time of all phases).
+    """
+    frames = sum(run['frames'] for run in runs)
+    gradient_steps = sum(run['gradient_steps'] for run in runs)
+    train_time = sum(run['train_time'] for run in runs)
+    peak_memory = [run['peak_memory_mb'] for run in runs if run['peak_memory_mb'] is not None]
+    cost = {
+        'frames': frames,
+        'gradient_steps': gradient_steps,
+        'train_time': train_time,
+        'frames_per_second': frames / train_time if train_time > 0 else None,
+        'gradient_steps_per_second': gradient_steps / train_time if train_time > 0 else None,
+        # Only meaningful for a single run, a resumed run does not know when the earlier runs improved
+        'time_to_best_reward': runs[0]['time_to_best_reward'] if len(runs) == 1 else None,
+        'peak_memory_mb': max(peak_memory) if peak_memory else None
+    }
+    phases = {}
+    for run in runs:
+        for name, seconds in run.get('phases', {}).items():
+            phases[name] = phases.get(name, 0.0) + seconds
+    phase_total = sum(phases.values())
+    for name, seconds in phases.items():
+        cost[f"phase_{name}_seconds"] = seconds
+        cost[f"phase_{name}_percent"] = 100.0 * seconds / phase_total if phase_total > 0 else 0.0
+
+    for name, value in cost.items():
+        trial.set_user_attr(name, value)
+    return cost
+
+
+def throughput_report(study, threshold=3.5, group_by=("network", "batch_size", "optim_steps"), min_group_size=3):
+    """
+    Summarizes the cost of the completed and pruned trials of a study and flags trials whose throughput
+    deviates from comparable trials.
+
+    Throughput (frames/s) is compared with the robust z-score (deviation from the median in units of
+    the median absolute deviation) within the trials of the same configuration (group_by), or within
+    all trials for configurations with fewer than min_group_size trials. The dominant phase of every
+    trial is reported to see where the time of an outlier went.
+
+    Args:
+        study: The Optuna study
+        threshold (float): Absolute robust z-score above which a trial is flagged
+        group_by (tuple): Trial parameters that define comparable trials
+        min_group_size (int): Minimum number of trials of a configuration to compare within it
+
+    Returns:
+        pd.DataFrame: One row per trial with throughput, phase shares, z-score and outlier flag
+    """
+    states = (optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+    rows = []
+    for trial in study.get_trials(deepcopy=False, states=states):
+        if trial.user_attrs.get('frames_per_second') is None or 'cached_from' in trial.user_attrs:
+            continue  # No measurement (older trial) or not trained in this study
+        phase_percent = {
+            name[len("phase_"):-len("_percent")]: value
+            for name, value in trial.user_attrs.items() if name.startswith("phase_") and name.endswith("_percent")
+        }
+        rows.append({
+            'trial': trial.number,
+            'state': trial.state.name,
+            **{name: trial.params.get(name) for name in group_by},
+            'frames_per_second': trial.user_attrs['frames_per_second'],
+            'gradient_steps_per_second': trial.user_attrs.get('gradient_steps_per_second'),
+            'peak_memory_mb': trial.user_attrs.get('peak_memory_mb'),
+            'dominant_phase': max(phase_percent, key=phase_percent.get) if phase_percent else None,
+            **{f"{name}_%": value for name, value in phase_percent.items()}
+        })
+    report = pd.DataFrame(rows)
+    if report.empty:
+        return report
+
+    def robust_z(values):
+        median = values.median()
+        mad = (values - median).abs().median() * 1.4826  # Consistent with the standard deviation
+        return (values - median) / mad if mad > 0 else values * 0.0
+
+    report['z_score'] = robust_z(report['frames_per_second'])
+    group_columns = [name for name in group_by if report[name].notna().any()]
+    if group_columns:
+        for _, group in report.groupby(group_columns, dropna=False):
+            if len(group) >= min_group_size:
+                report.loc[group.index, 'z_score'] = robust_z(group['frames_per_second'])
+    report['outlier'] = report['z_score'].abs() > threshold
+    return report.sort_values('trial')
+
+
+def export_pareto_front(study, path):
+    """
+    Writes the Pareto optimal trials of a multi-objective study (reward, time to reward) with their
+    hyperparameters and cost to a CSV file.
+
+    Returns:
+        pd.DataFrame: The Pareto front, sorted by reward
+    """
+    rows = []
+    for trial in study.best_trials:
+        reward, time_to_reward = trial.values
+        rows.append({
+            'trial': trial.number,
+            'reward': reward,
+            'time_to_reward': time_to_reward,
+            **trial.params,
+            **{name: trial.user_attrs.get(name) for name in COST_ATTRS}
+        })
+    front = pd.DataFrame(rows)
+    if not front.empty:
+        front = front.sort_values('reward', ascending=False)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    front.to_csv(path, index=False)
+    return front
+
+
+def copy_checkpoint(model_path, trial_dir):
+    """Copies a cached best model (and its optimizer state) into the directory of a trial."""
+    os.makedirs(trial_dir, exist_ok=True)
+    handler = ModelHandler(save_dir=trial_dir)
+    shutil.copy2(model_path, os.path.join(trial_dir, os.path.basename(model_path)))
+    optimizer_path = handler.optimizer_path(model_path)
+    if os.path.exists(optimizer_path):
+        shutil.copy2(optimizer_path, os.path.join(trial_dir, os.path.basename(optimizer_path)))
+    handler.rebuild_manifest()
+
+
+def objective(trial, train_data, test_data, save_root="saves/tuning", rungs=None, multi_objective=False,
+              cache=None, seed=0, code_hash=None, reuse_checkpoints=False, search_cost=False):
     """
     Optuna objective function for hyperparameter optimization.
+
+    Every trial saves its models in its own directory (save_root/<study name>/trial_<number>) and
+    logs to its own TensorBoard directory, so trials can run in parallel. The periodic test rewards
+    of learn are reported to the trial, and the trial is pruned as soon as the pruner decides so.
+    The training and test data (KeywordPanel) are loaded once per worker and shared by all trials.
+
+    With rungs (multi-fidelity mode), the trial is trained rung by rung: learn runs until it collected
+    the frames of the rung, saves its training state and the next rung continues from it. The budget is
+    counted in frames, not training steps, because the training steps grow with optim_steps. After
+    every rung the best test reward is reported (the final inference run only follows the last rung),
+    and the successive halving pruner only lets the best trials continue.
+
+    The cost of every trial (throughput, peak memory, time to the best reward) is stored in its user
+    attributes. With multi_objective, the trial returns (best reward, seconds until the best reward was
+    reached) and is never pruned (Optuna does not prune multi-objective trials). With search_cost, the
+    network size and the gradient steps per batch are searched as well (COST_SEARCH_SPACE).
+
+    With a cache (TrialCache), a configuration that was already completed on the same data, code
+    version (code_hash), seed and budget is not trained again: the cached result is returned and with
+    reuse_checkpoints the cached best model is copied into the trial directory. Completed trials are
+    added to the cache.
     """
     # Sample hyperparameters
-    params = {
-        'lr': trial.suggest_float('lr', 1e-4, 1e-2, log=True),                          # Learning rate for the optimizer
-        'batch_size': trial.suggest_categorical('batch_size', [32, 64, 128, 256]),      # Batch size for training
-        'exploration_eps_init': trial.suggest_float('exploration_eps_init', 0.5, 1.0),  # Initial value for epsilon in epsilon-greedy exploration
-        'exploration_eps_end': trial.suggest_float('exploration_eps_end', 0.01, 0.1),   # Final value for epsilon in epsilon-greedy exploration
-        'softupdate_eps': trial.suggest_float('softupdate_eps', 0.9, 0.99),             # Soft update rate for target network
-        'gamma': trial.suggest_float('gamma', 0.9, 0.99),                               # Discount factor for future rewards
-        'weight_decay':  trial.suggest_float('weight_decay', 1e-6, 1e-4)                # Weight decay for regularization
-    }
-    
-    # Run training with the sampled hyperparameters
-    best_reward = learn(params)
+    trial_params = suggest_params(trial, search_cost)
+    params = learn_params(trial_params)
     
-    return best_reward
+    from torch.utils.tensorboard import SummaryWriter
+
+    trial_name = f"trial_{trial.number}"
+    trial_dir = os.path.join(save_root, trial.study.study_name, trial_name)
+    budget = {'rungs': rungs} if rungs is not None else {'max_steps': MAX_STEPS}
+
+    if cache is not None:
+        data_hash = dataset_hash(train_data, test_data)
+        cached = cache.lookup(trial_params, data_hash, code_hash, seed, budget)
+        if cached is not None:
+            for name, value in cached['user_attrs'].items():
+                trial.set_user_attr(name, value)
+            trial.set_user_attr('cached_from', f"{cached['study_name']}/{cached['trial_number']}")
+            if reuse_checkpoints and cached['model_path'] and os.path.exists(cached['model_path']):
+                copy_checkpoint(cached['model_path'], trial_dir)
+            print(f"Trial {trial.number}: cached result of {cached['study_name']} trial {cached['trial_number']}, reward {cached['reward']}")
+            return objective_values(cached['reward'], cached['user_attrs'], multi_objective)
+
+    torch.manual_seed(seed)
+    np.random.seed(seed)
+    writer = SummaryWriter(log_dir=os.path.join("runs", trial.study.study_name, trial_name))
+
+    if rungs is not None:
+        state_path = os.path.join(trial_dir, "training_state.ckpt")  # Not *.pt, which would be listed as a model
+        runs = []
+        try:
+            for rung, rung_budget in enumerate(rungs):
+                last_rung = rung == len(rungs) - 1
+                stats = {}
+                best_reward = learn(
+                    params,
+                    train_data=train_data,
+                    test_data=test_data,
+                    writer=writer,
+                    save_dir=trial_dir,
+                    max_steps=None,
+                    max_frames=rung_budget,
+                    resume_from=state_path if rung > 0 else None,
+                    training_state_path=None if last_rung else state_path,
+                    stats=stats,
+                    final_inference=last_rung
+                )
+                runs.append(stats)
+                cost = record_cost(trial, runs)
+                trial.report(best_reward, rung_budget)
+                if not last_rung and trial.should_prune():
+                    raise optuna.TrialPruned(f"Pruned at rung {rung} ({rung_budget} frames)")
+        finally:
+            writer.close()
+            # The training state contains the replay buffer, it is only needed while the trial runs
+            if os.path.exists(state_path):
+                os.remove(state_path)
+    else:
+        pruned = []
+        stats = {}
+
+        def report_progress(step, test_reward):
+            if multi_objective:
+                return False
+            trial.report(test_reward, step)
+            if trial.should_prune():
+                pruned.append(step)
+                return True  # Stop training
+            return False
+
+        try:
+            # Run training with the sampled hyperparameters
+            best_reward = learn(
+                params,
+                train_data=train_data,
+                test_data=test_data,
+                writer=writer,
+                save_dir=trial_dir,
+                progress_callback=report_progress,
+                max_steps=MAX_STEPS,
+                stats=stats
+            )
+        finally:
+            writer.close()
+
+        cost = record_cost(trial, [stats])
+        if pruned:
+            raise optuna.TrialPruned(f"Pruned after {pruned[0]} training steps")
+
+    if cache is not None:
+        model_path = os.path.join(trial_dir, "best_model.pt")
+        cache.store(
+            trial_params, data_hash, code_hash, seed, budget, best_reward, cost,
+            model_path=os.path.abspath(model_path) if os.path.exists(model_path) else None,
+            study_name=trial.study.study_name, trial_number=trial.number
+        )
+    return objective_values(best_reward, cost, multi_objective)
+
+
+def run_worker(worker_id, study_name, storage, n_trials, num_threads, save_root, train_data, test_data,
+               pruner="median", pruner_warmup_steps=2000, rungs=None, reduction_factor=3, multi_objective=False,
+               cache_path=None, seed=0, code_hash=None, reuse_checkpoints=False, search_cost=False):
+    """
+    Runs trials of a shared study until the study has n_trials finished trials.
+
+    Args:
+        worker_id (int): Number of the worker (for the log output)
+        study_name (str): Name of the study in the storage
+        storage (str): Storage specification, see create_storage
+        n_trials (int): Total number of finished (complete or pruned) trials of the study
+        num_threads (int): Number of torch threads of the worker
+        save_root (str): Root directory for the models of the trials
+        train_data (KeywordPanel or str): Training panel or directory of a saved panel (memory-mapped)
+        test_data (KeywordPanel or str): Test panel or directory of a saved panel (memory-mapped)
+        pruner (str): Pruner of the worker, see create_pruner (pruners are not stored in the storage)
+        pruner_warmup_steps (int): Training steps before a trial can be pruned
+        rungs (list, optional): Collected frames of the rungs in multi-fidelity mode, see fidelity_rungs
+        reduction_factor (int): Reduction factor of the halving and Hyperband pruners
+        multi_objective (bool): Trials return (reward, time to reward), see objective
+        cache_path (str, optional): SQLite file of the TrialCache, None disables the cache
+        seed (int): Seed of the training runs (part of the cache key)
+        code_hash (str): Code version of the cache key, see code_version
+        reuse_checkpoints (bool): Copy the best model of a cached result into the trial directory
+        search_cost (bool): Also search the cost dimensions (COST_SEARCH_SPACE)
+    """
+    limit_threads(num_threads)
+    study = optuna.load_study(
+        study_name=study_name,
+        storage=create_storage(storage),
+        pruner=create_pruner(pruner, warmup_steps=pruner_warmup_steps, reduction_factor=reduction_factor)
+    )
+
+    # Memory-mapped panels: the workers of a host share the pages of the same files
+    train_data, test_data = load_panels(train_data, test_data)
+    cache = TrialCache(cache_path) if cache_path is not None else None
+
+    # The trial count is shared by all workers (and hosts), each worker stops once the study has
+    # enough finished trials. Trials that are running at that moment still finish.
+    max_trials = optuna.study.MaxTrialsCallback(
+        n_trials, states=(optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)
+    )
+    print(f"Worker {worker_id} started ({num_threads} threads)")
+    study.optimize(
+        lambda trial: objective(trial, train_data, test_data, save_root=save_root, rungs=rungs, multi_objective=multi_objective,
+                                cache=cache, seed=seed, code_hash=code_hash, reuse_checkpoints=reuse_checkpoints,
+                                search_cost=search_cost),
+        n_trials=n_trials,
+        callbacks=[max_trials]
+    )
+
 
 def main():
     parser = argparse.ArgumentParser(description="Hyperparameter Tuning for Digital Advertising RL")
-    parser.add_argument("--n_trials", type=int, default=50, help="Number of optimization trials")
+    parser.add_argument("--n_trials", type=int, default=50, help="Number of optimization trials (in total, over all workers and hosts)")
+    parser.add_argument("--n_workers", type=int, default=1, help="Number of worker processes on this host")
+    parser.add_argument("--threads_per_worker", type=int, default=None, help="Number of torch/OpenMP threads per worker (default: CPU count / n_workers)")
+    parser.add_argument("--storage", type=str, default="journal:optuna/digital_ad.journal",
+                        help="journal:<path> (journal file, on a shared filesystem also for several hosts) or a database URL")
+    parser.add_argument("--study_name", type=str, default=None,
+                        help="Name of the study. An existing study of this name is joined (e.g. by workers on other hosts with the same "
+                             "storage), without a name every run creates a new study digital_ad_<timestamp>")
+    parser.add_argument("--save_dir", type=str, default="saves/tuning", help="Root directory for the models of the trials")
+    parser.add_argument("--dataset", type=str, default=file_path, help="Dataset CSV, loaded and split once for all trials")
+    parser.add_argument("--pruner", type=str, default="median", choices=["none", "median", "halving", "hyperband"], help="Pruner for unpromising trials")
+    parser.add_argument("--pruner_warmup_steps", type=int, default=2000, help="Training steps before a trial can be pruned")
+    parser.add_argument("--multi_fidelity", action="store_true",
+                        help="Asynchronous successive halving: trials start with --min_budget collected frames and only the best continue from their checkpoint")
+    parser.add_argument("--min_budget", type=int, default=6000,
+                        help="Collected frames of the first rung, including the 5000 random warm-up frames (multi-fidelity mode)")
+    parser.add_argument("--max_budget", type=int, default=18_000, help="Collected frames of a complete trial (multi-fidelity mode)")
+    parser.add_argument("--reduction_factor", type=int, default=3, help="Only the best 1/reduction_factor of the trials reach the next rung")
+    parser.add_argument("--multi_objective", action="store_true",
+                        help="Maximize the reward and minimize the time to reach it, the Pareto front is exported to --pareto_csv")
+    parser.add_argument("--search_cost", action="store_true",
+                        help="Also search the network size and the gradient steps per batch (always on with --multi_objective)")
+    parser.add_argument("--pareto_csv", type=str, default=None, help="Pareto front CSV (default: optuna/<study_name>_pareto.csv)")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the training runs (part of the result cache key)")
+    parser.add_argument("--cache", type=str, default="optuna/trial_cache.db", help="SQLite result cache shared by all studies")
+    parser.add_argument("--no_cache", action="store_true", help="Always train, do not read or write the result cache")
+    parser.add_argument("--code_version", type=str, default=None,
+                        help="Code version of the cache key (default: hash of the files in CODE_FILES)")
+    parser.add_argument("--reuse_checkpoints", action="store_true", help="Copy the best model of cached results into the trial directory")
+    parser.add_argument("--warm_start", action="store_true", help="Add the cached results for the same data, code, seed and budget to the study first")
+    parser.add_argument("--report", action="store_true",
+                        help="Only print the throughput and phase report of the study and flag trials with deviating throughput")
+    parser.add_argument("--outlier_threshold", type=float, default=3.5, help="Robust z-score of the throughput above which --report flags a trial")
     args = parser.parse_args()
+
+    # Only a study named on the command line is joined, otherwise every run starts a new study
+    join_study = args.study_name is not None
+    if args.report and not join_study:
+        parser.error("--report needs the --study_name of the study to report on")
+    if not join_study:
+        args.study_name = f"digital_ad_{time.strftime('%Y%m%d-%H%M%S')}"
+
+    if args.report:
+        study = optuna.load_study(study_name=args.study_name, storage=create_storage(args.storage))
+        report = throughput_report(study, threshold=args.outlier_threshold)
+        if report.empty:
+            print(f"No trials with cost measurements in study {args.study_name}")
+            return
+        with pd.option_context('display.max_columns', None, 'display.width', 200):
+            print(report.to_string(index=False, float_format=lambda value: f"{value:.2f}"))
+        outliers = report[report['outlier']]
+        print(f"\n{len(outliers)} of {len(report)} trials with deviating throughput (|z| > {args.outlier_threshold})")
+        for _, row in outliers.iterrows():
+            print(f"  Trial {row['trial']}: {row['frames_per_second']:.1f} frames/s (z = {row['z_score']:.1f}), "
+                  f"dominant phase {row['dominant_phase']}")
+        return
+
+    if args.multi_objective:
+        if args.multi_fidelity:
+            parser.error("--multi_objective cannot be combined with --multi_fidelity (multi-objective trials cannot be pruned)")
+        args.pruner = "none"
+        args.search_cost = True
+
+    threads_per_worker = args.threads_per_worker or max(1, (os.cpu_count() or 1) // args.n_workers)
+    print(f"Using device: {torch.device('cuda' if torch.cuda.is_available() else 'cpu')}")
+
+    rungs = None
+    if args.multi_fidelity:
+        # The rungs of the pruner are min_budget * reduction_factor^k, the trials report exactly there
+        rungs = fidelity_rungs(args.min_budget, args.max_budget, args.reduction_factor)
+        args.pruner, args.pruner_warmup_steps = "halving", args.min_budget
+        print(f"Multi-fidelity mode with rungs at {rungs} frames")
+
+    # Load and split the dataset once, the trials only build their networks
+    if not os.path.exists(args.dataset):
+        raise FileNotFoundError(f"Dataset {args.dataset} not found, run digital_advertising.py once to generate it")
+    panel = load_panel(args.dataset)  # Columnar cache, the CSV file is only parsed once
+    train_data, test_data = panel.split(train_ratio=0.8)
+    data_hash = dataset_hash(train_data, test_data)
+    code_hash = args.code_version or code_version()
+    cache_path = None if args.no_cache else args.cache
+    if args.n_workers > 1:
+        # The worker processes memory-map the saved panels instead of receiving copies
+        data_dir = os.path.join(args.save_dir, args.study_name, "data", panel.fingerprint()[:16])
+        train_data = train_data.save(os.path.join(data_dir, "train"))
+        test_data = test_data.save(os.path.join(data_dir, "test"))
     
-    # Load dataset
-    dataset = generate_synthetic_data(1000)
-    
-    # Create Optuna study
-    study = optuna.create_study(direction="maximize", storage="sqlite:///optuna/digital_ad1.db")
+    # Create Optuna study (or join the existing study given by --study_name)
+    directions = ["maximize", "minimize"] if args.multi_objective else ["maximize"]
+    study = optuna.create_study(
+        directions=directions,
+        storage=create_storage(args.storage),
+        study_name=args.study_name,
+        pruner=create_pruner(args.pruner, warmup_steps=args.pruner_warmup_steps, reduction_factor=args.reduction_factor),
+        load_if_exists=join_study
+    )
+    study_directions = [direction.name.lower() for direction in study.directions]
+    if study_directions != directions:
+        parser.error(f"Study {args.study_name} has the directions {study_directions}, this run needs {directions} "
+                     f"(--multi_objective), choose another --study_name")
+    print(f"Study {args.study_name} in {args.storage}")
+    if args.warm_start and cache_path is not None:
+        budget = {'rungs': rungs} if rungs is not None else {'max_steps': MAX_STEPS}
+        added = warm_start(study, TrialCache(cache_path), data_hash, code_hash, args.seed, budget, args.multi_objective, args.search_cost)
+        print(f"Warm start: added {added} cached results to the study")
+
+    # --n_trials counts all finished trials of the study (over all workers and hosts)
+    finished = len(study.get_trials(deepcopy=False, states=(optuna.trial.TrialState.COMPLETE, optuna.trial.TrialState.PRUNED)))
+    worker_args = (args.study_name, args.storage, args.n_trials, threads_per_worker, args.save_dir,
+                   train_data, test_data, args.pruner, args.pruner_warmup_steps, rungs, args.reduction_factor,
+                   args.multi_objective, cache_path, args.seed, code_hash, args.reuse_checkpoints, args.search_cost)
+    if finished >= args.n_trials:
+        print(f"Study {args.study_name} is already complete: it has {finished} finished trials and --n_trials is {args.n_trials}. "
+              f"No new trials are run, increase --n_trials to continue it or omit --study_name to start a new study.")
+    else:
+        print(f"Starting optimization with {args.n_trials - finished} of {args.n_trials} trials, {args.n_workers} workers and {threads_per_worker} threads per worker...")
+        if args.n_workers == 1:
+            run_worker(0, *worker_args)
+        else:
+            # The thread limits have to be in the environment before the workers import torch
+            for name in THREAD_ENV_VARS:
+                os.environ[name] = str(threads_per_worker)
+            # Separate processes (spawn, no forked torch state), they share the trials through the storage
+            context = multiprocessing.get_context("spawn")
+            workers = [context.Process(target=run_worker, args=(worker_id, *worker_args)) for worker_id in range(args.n_workers)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
     
-    print(f"Starting optimization with {args.n_trials} trials...")
-    study.optimize(lambda trial: objective(trial, dataset), n_trials=args.n_trials)
+    study = optuna.load_study(study_name=args.study_name, storage=create_storage(args.storage))
     
     print("Optimization completed!")
+    if args.multi_objective:
+        pareto_csv = args.pareto_csv or os.path.join("optuna", f"{args.study_name}_pareto.csv")
+        front = export_pareto_front(study, pareto_csv)
+        print(f"Pareto front ({len(front)} trials) written to {pareto_csv}:")
+        if not front.empty:
+            print(front.reindex(columns=['trial', 'reward', 'time_to_reward', 'frames_per_second', 'network', 'batch_size', 'optim_steps']).to_string(index=False))
+        return
+
     print("Best hyperparameters:")
     for param_name, param_value in study.best_params.items():
         print(f"  {param_name}: {param_value}")
+    print("Cost of the best trial:")
+    for name in COST_ATTRS:
+        print(f"  {name}: {study.best_trial.user_attrs.get(name)}")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Command line tool for the model manifest of a save directory (see ModelHandler).
+# Listing and selecting models only reads manifest.json, "rebuild" creates the manifest
+# for directories that were written before the manifest existed.
+
+import argparse
+
+from digital_advertising import ModelHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage saved models of the digital advertising RL agent")
+    parser.add_argument("--save_dir", type=str, default="saves", help="Directory with the saved models")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("rebuild", help="Rebuild the manifest from the model files (loads every checkpoint once)")
+
+    list_parser = subparsers.add_parser("list", help="List the saved models")
+    list_parser.add_argument("--sort_by", type=str, default="test_reward", help="Manifest field or metric to sort by")
+    list_parser.add_argument("--ascending", action="store_true", help="Sort in ascending order")
+    list_parser.add_argument("--top", type=int, default=20, help="Number of models to show (0 = all)")
+
+    subparsers.add_parser("best", help="Print the path of the best model")
+
+    export_parser = subparsers.add_parser("export_weights", help="Convert a checkpoint to memory-mappable inference weights (.safetensors)")
+    export_parser.add_argument("model", type=str, nargs="?", default=None, help="Checkpoint to convert, defaults to the best model")
+    export_parser.add_argument("--output", type=str, default=None, help="Output path, defaults to the checkpoint path with .safetensors")
+
+    prune_parser = subparsers.add_parser("prune", help="Delete models outside the top-k by test reward and the last N")
+    prune_parser.add_argument("--keep_top_k", type=int, default=None, help="Number of best models to keep")
+    prune_parser.add_argument("--keep_last_n", type=int, default=None, help="Number of most recent models to keep")
+
+    args = parser.parse_args()
+    model_handler = ModelHandler(save_dir=args.save_dir)
+
+    if args.command == "rebuild":
+        model_handler.rebuild_manifest()
+    elif args.command == "list":
+        entries = model_handler.list_models(sort_by=args.sort_by, descending=not args.ascending)
+        if args.top:
+            entries = entries[:args.top]
+        print(f"{'filename':<60} {'test_reward':>12} {'step':>8} {'size_mb':>8}  sha256")
+        for entry in entries:
+            reward = entry.get('test_reward')
+            reward = f"{reward:.2f}" if reward is not None else "-"
+            step = entry.get('step') if entry.get('step') is not None else "-"
+            print(f"{entry['filename']:<60} {reward:>12} {step:>8} {entry['size'] / 1e6:>8.2f}  {entry['sha256'][:12]}")
+    elif args.command == "best":
+        print(model_handler.find_best_model())
+    elif args.command == "export_weights":
+        model_path = args.model or model_handler.find_best_model()
+        if model_path is None:
+            parser.error("no model to export")
+        model_handler.export_inference_weights(model_path, output_path=args.output)
+    elif args.command == "prune":
+        if args.keep_top_k is None and args.keep_last_n is None:
+            parser.error("prune needs --keep_top_k and/or --keep_last_n")
+        deleted = model_handler.apply_retention(keep_top_k=args.keep_top_k, keep_last_n=args.keep_last_n)
+        for filename in deleted:
+            print(f"Deleted {filename}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Lightweight loader for the serving artifacts exported with ModelHandler.export_serving_model.
+# This module deliberately only depends on numpy and torch (TorchScript) or onnxruntime (ONNX),
+# so serving replicas do not need to import torchrl, tensordict or digital_advertising.py.
+
+import os
+import json
+import argparse
+import time
+import numpy as np
+
+
+class ServingPolicyRuntime:
+    """
+    Runs an exported greedy policy on raw keyword metrics.
+
+    Attributes:
+        path (str): Path to the artifact.
+        backend (str): "torchscript" or "onnx".
+        metadata (dict): Metadata stored with the artifact (num_keywords, feature_columns, keywords, ...).
+    """
+
+    def __init__(self, path, backend=None):
+        """
+        Loads the artifact.
+
+        Args:
+            path (str): Path to the artifact (.onnx for ONNX, everything else is treated as TorchScript).
+            backend (str, optional): Force "torchscript" or "onnx". Defaults to detection by file extension.
+        """
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"Serving model not found: {path}")
+
+        self.path = path
+        self.backend = backend or ("onnx" if path.endswith(".onnx") else "torchscript")
+
+        if self.backend == "onnx":
+            try:
+                import onnxruntime
+            except ImportError:
+                raise ImportError("ONNX artifacts need onnxruntime (pip install onnxruntime), "
+                                  "or export the policy to TorchScript") from None
+
+            self._session = onnxruntime.InferenceSession(path, providers=["CPUExecutionProvider"])
+            metadata_path = path + ".json"
+            self.metadata = {}
+            if os.path.exists(metadata_path):
+                with open(metadata_path) as f:
+                    self.metadata = json.load(f)
+        elif self.backend == "torchscript":
+            import torch
+
+            extra_files = {"metadata.json": ""}
+            self._module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+            self._module.eval()
+            self.metadata = json.loads(extra_files["metadata.json"] or "{}")
+        else:
+            raise ValueError(f"Unknown backend: {self.backend}")
+
+    def __call__(self, keyword_features, cash, holdings):
+        """
+        Computes the greedy actions for a batch of observations.
+
+        Args:
+            keyword_features (array-like): Raw keyword metrics with shape [batch, num_keywords, num_features].
+            cash (array-like): Raw cash balance with shape [batch].
+            holdings (array-like): Holdings with shape [batch, num_keywords].
+
+        Returns:
+            tuple: (actions [batch] as np.ndarray, q_values [batch, num_keywords + 1] as np.ndarray).
+                The action num_keywords means "buy nothing".
+        """
+        keyword_features = np.ascontiguousarray(keyword_features, dtype=np.float32)
+        cash = np.ascontiguousarray(cash, dtype=np.float32).reshape(-1)
+        holdings = np.ascontiguousarray(holdings, dtype=np.float32)
+
+        if self.backend == "onnx":
+            actions, q_values = self._session.run(
+                ["action", "q_values"],
+                {"keyword_features": keyword_features, "cash": cash, "holdings": holdings}
+            )
+            return actions, q_values
+
+        import torch
+
+        with torch.no_grad():
+            actions, q_values = self._module(
+                torch.from_numpy(keyword_features), torch.from_numpy(cash), torch.from_numpy(holdings)
+            )
+        return actions.numpy(), q_values.numpy()
+
+
+def load_serving_policy(path, backend=None):
+    """
+    Loads a serving artifact exported with ModelHandler.export_serving_model.
+
+    Args:
+        path (str): Path to the artifact.
+        backend (str, optional): Force "torchscript" or "onnx".
+
+    Returns:
+        ServingPolicyRuntime: Callable that maps (keyword_features, cash, holdings) to (actions, q_values).
+    """
+    return ServingPolicyRuntime(path, backend=backend)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Smoke test and latency check for an exported serving policy")
+    parser.add_argument("model", type=str, help="Path to the exported artifact (.pt TorchScript or .onnx)")
+    parser.add_argument("--backend", type=str, default=None, choices=["torchscript", "onnx"], help="Force the backend")
+    parser.add_argument("--batch_size", type=int, default=1, help="Batch size of the random test input")
+    parser.add_argument("--repeats", type=int, default=100, help="Number of timed forward passes")
+    args = parser.parse_args()
+
+    t0 = time.time()
+    policy = load_serving_policy(args.model, backend=args.backend)
+    print(f"Loaded {args.model} ({policy.backend}) in {time.time() - t0:.3f}s")
+
+    num_keywords = policy.metadata["num_keywords"]
+    num_features = len(policy.metadata["feature_columns"])
+    rng = np.random.default_rng(0)
+    keyword_features = rng.random((args.batch_size, num_keywords, num_features), dtype=np.float32)
+    cash = np.full(args.batch_size, 100000.0, dtype=np.float32)
+    holdings = np.zeros((args.batch_size, num_keywords), dtype=np.float32)
+
+    policy(keyword_features, cash, holdings)  # Warm-up
+    t0 = time.time()
+    for _ in range(args.repeats):
+        actions, _ = policy(keyword_features, cash, holdings)
+    elapsed = (time.time() - t0) / args.repeats
+    print(f"Actions: {actions[:10]}")
+    print(f"Mean latency per batch of {args.batch_size}: {elapsed * 1000:.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
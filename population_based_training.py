@@ -0,0 +1,306 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Population based training (PBT) on top of learn().
+#
+# A population of members trains concurrently, each member in its own process. Every member trains
+# in intervals of --interval_steps training steps; learn saves the complete training state at the end
+# of an interval and the next interval continues from it for another --interval_steps training steps
+# (also from a copied state). After every interval the member reports the test reward of its current
+# weights to a file based coordinator (pbt_dir/population.json). A member in the bottom quantile copies
+# the training state (weights, target network, optimizer, replay buffer) of a member in the top quantile
+# (exploit) and perturbs the copied hyperparameters (explore). All decisions are appended to
+# pbt_dir/history.jsonl, so the hyperparameter schedule of the best member can be traced.
+
+import os
+import json
+import math
+import time
+import random
+import shutil
+import argparse
+import multiprocessing
+
+from dataset_cache import load_panel
+from digital_advertising import KeywordPanel, file_path
+
+# Hyperparameters that are sampled and perturbed: (low, high, log scale)
+PBT_SEARCH_SPACE = {
+    'lr': (1e-4, 1e-2, True),
+    'exploration_eps_init': (0.5, 1.0, False),
+    'exploration_eps_end': (0.01, 0.1, False),
+    'softupdate_eps': (0.9, 0.99, False),
+    'gamma': (0.9, 0.99, False),
+    'weight_decay': (1e-6, 1e-4, True)
+}
+
+
+def sample_params(rng, batch_size=128):
+    """Samples the initial hyperparameters of a member from PBT_SEARCH_SPACE."""
+    params = {'batch_size': batch_size}
+    for name, (low, high, log) in PBT_SEARCH_SPACE.items():
+        if log:
+            params[name] = 10 ** rng.uniform(math.log10(low), math.log10(high))
+        else:
+            params[name] = rng.uniform(low, high)
+    return params
+
+
+def perturb_params(params, rng, factor=0.2):
+    """Multiplies every searched hyperparameter by 1 - factor or 1 + factor, clipped to its range."""
+    perturbed = dict(params)
+    for name, (low, high, _) in PBT_SEARCH_SPACE.items():
+        perturbed[name] = min(high, max(low, params[name] * rng.choice([1.0 - factor, 1.0 + factor])))
+    return perturbed
+
+
+class PBTCoordinator:
+    """
+    File based coordinator of a population, shared by the member processes of one host (or of several
+    hosts with a shared filesystem).
+
+    The latest report of every member is stored in population.json, every decision is appended to
+    history.jsonl. Updates are serialized with a lock file, the same way ModelHandler updates its manifest.
+    """
+
+    def __init__(self, directory, quantile=0.25, perturb_factor=0.2, population_size=None, min_reports=None):
+        """
+        Args:
+            directory (str): Directory of the population
+            quantile (float): Fraction of the population that is exploited (bottom) and copied from (top)
+            perturb_factor (float): Relative perturbation of the hyperparameters after an exploit
+            population_size (int, optional): Number of members of the population
+            min_reports (int, optional): Number of members that must have reported before members are
+                exploited. Defaults to half of population_size (at least 2), without population_size
+                to half of the members that reported at least once.
+        """
+        self.directory = directory
+        self.population_path = os.path.join(directory, "population.json")
+        self.history_path = os.path.join(directory, "history.jsonl")
+        self.quantile = quantile
+        self.perturb_factor = perturb_factor
+        self.population_size = population_size
+        if min_reports is None and population_size is not None:
+            min_reports = max(2, (population_size + 1) // 2)
+        self.min_reports = min_reports
+        os.makedirs(directory, exist_ok=True)
+
+    def member_dir(self, member):
+        return os.path.join(self.directory, f"member_{member}")
+
+    def state_path(self, member):
+        return os.path.join(self.member_dir(member), "training_state.ckpt")
+
+    def _lock(self, timeout=60.0):
+        lock_path = self.population_path + ".lock"
+        start = time.time()
+        while True:
+            try:
+                os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                return lock_path
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(lock_path) > timeout:
+                        os.remove(lock_path)  # Stale lock of a crashed member
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.time() - start > timeout:
+                    raise TimeoutError(f"Could not lock {self.population_path}")
+                time.sleep(0.01)
+
+    def read_population(self):
+        """Returns the latest report of every member by member id."""
+        if not os.path.exists(self.population_path):
+            return {}
+        with open(self.population_path) as f:
+            return json.load(f)
+
+    def _write_population(self, population):
+        tmp_path = f"{self.population_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(population, f, indent=2)
+        os.replace(tmp_path, self.population_path)
+
+    def _append_history(self, record):
+        with open(self.history_path, "a") as f:
+            f.write(json.dumps(record) + "\n")
+
+    def report(self, member, interval, total_steps, score, params, rng, exploit=True):
+        """
+        Records the score of a member after an interval and decides how the member continues.
+
+        If the member is in the bottom quantile of the population, the training state of a random
+        member of the top quantile is copied to the member and the copied hyperparameters are perturbed.
+        With exploit=False (last interval) the score is only recorded.
+
+        Returns:
+            tuple: (hyperparameters for the next interval, member id the state was copied from or None)
+        """
+        lock_path = self._lock()
+        try:
+            population = self.read_population()
+            population[str(member)] = {
+                'member': member, 'interval': interval, 'total_steps': total_steps,
+                'score': score, 'params': params, 'time': time.time()
+            }
+
+            ranked = sorted(population.values(), key=lambda record: record['score'], reverse=True)
+            cutoff = max(1, int(round(len(ranked) * self.quantile)))
+            min_reports = self.min_reports or max(2, (len(ranked) + 1) // 2)
+            rank = next(i for i, record in enumerate(ranked) if record['member'] == member)
+
+            source, next_params, action = None, params, "continue"
+            if exploit and len(ranked) >= min_reports and len(ranked) > cutoff and rank >= len(ranked) - cutoff:
+                source_record = rng.choice(ranked[:cutoff])
+                source = source_record['member']
+                # Exploit: continue from the training state of the better member (atomic copy)
+                tmp_path = f"{self.state_path(member)}.{os.getpid()}.tmp"
+                shutil.copyfile(self.state_path(source), tmp_path)
+                os.replace(tmp_path, self.state_path(member))
+                # Explore: perturbed hyperparameters of the better member
+                next_params = perturb_params(source_record['params'], rng, self.perturb_factor)
+                population[str(member)]['params'] = next_params
+                action = "exploit"
+
+            self._write_population(population)
+            self._append_history({
+                'time': time.time(), 'member': member, 'interval': interval, 'total_steps': total_steps,
+                'score': score, 'rank': rank, 'population': len(ranked), 'action': action,
+                'source': source, 'params': params, 'next_params': next_params
+            })
+        finally:
+            os.remove(lock_path)
+        return next_params, source
+
+
+def run_member(member, pbt_dir, train_data, test_data, intervals, interval_steps, quantile, perturb_factor,
+               num_threads, seed, population_size=None):
+    """
+    Trains one member of the population for the given number of intervals.
+
+    Args:
+        member (int): Member id
+        pbt_dir (str): Directory of the population
+        train_data (str): Directory of the saved training panel (memory-mapped)
+        test_data (str): Directory of the saved test panel (memory-mapped)
+        intervals (int): Number of intervals
+        interval_steps (int): Training steps per interval
+        quantile (float): See PBTCoordinator
+        perturb_factor (float): See PBTCoordinator
+        num_threads (int): Number of torch threads of the member
+        seed (int): Seed of the population
+        population_size (int, optional): Number of members, see PBTCoordinator
+    """
+    import torch
+    from torch.utils.tensorboard import SummaryWriter
+    from digital_advertising import learn
+
+    torch.set_num_threads(num_threads)
+    torch.manual_seed(seed + member)
+    rng = random.Random(seed * 1000 + member)
+
+    coordinator = PBTCoordinator(pbt_dir, quantile=quantile, perturb_factor=perturb_factor, population_size=population_size)
+    train_data, test_data = KeywordPanel.load(train_data), KeywordPanel.load(test_data)
+    params = sample_params(rng)
+    writer = SummaryWriter(log_dir=os.path.join("runs", os.path.basename(os.path.normpath(pbt_dir)), f"member_{member}"))
+
+    try:
+        for interval in range(intervals):
+            test_rewards = []
+
+            def record_test_reward(step, test_reward):
+                test_rewards.append(test_reward)
+                return False
+
+            state_path = coordinator.state_path(member)
+            stats = {}
+            learn(
+                params,
+                train_data=train_data,
+                test_data=test_data,
+                writer=writer,
+                save_dir=coordinator.member_dir(member),
+                progress_callback=record_test_reward,
+                max_steps=interval_steps,
+                resume_from=state_path if interval > 0 else None,
+                training_state_path=state_path,
+                stats=stats,
+                relative_budget=True,  # An exploited member continues from the step count of its source
+                final_inference=False
+            )
+
+            # The score is the test reward of the current weights (the last evaluation of the interval)
+            score = test_rewards[-1] if test_rewards else float('-inf')
+            total_steps = stats['total_steps']
+            for name, value in params.items():
+                writer.add_scalar(f"pbt/{name}", value, total_steps)
+            writer.add_scalar("pbt/score", score, total_steps)
+
+            last_interval = interval == intervals - 1
+            params, source = coordinator.report(
+                member, interval, total_steps, score, params, rng, exploit=not last_interval
+            )
+            if source is not None:
+                print(f"Member {member}: interval {interval} score {score:.2f}, continues from member {source} with {params}")
+    finally:
+        writer.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Population based training for the digital advertising RL agent")
+    parser.add_argument("--population", type=int, default=8, help="Number of members (processes)")
+    parser.add_argument("--intervals", type=int, default=5, help="Number of exploit/explore intervals per member")
+    parser.add_argument("--interval_steps", type=int, default=2000, help="Training steps per interval (at least one evaluation, 1000 steps)")
+    parser.add_argument("--quantile", type=float, default=0.25, help="Fraction of the population that is replaced / copied from")
+    parser.add_argument("--perturb_factor", type=float, default=0.2, help="Relative perturbation of the hyperparameters")
+    parser.add_argument("--threads_per_member", type=int, default=None, help="Number of torch threads per member (default: CPU count / population)")
+    parser.add_argument("--pbt_dir", type=str, default="saves/pbt", help="Directory of the population (coordinator files, checkpoints)")
+    parser.add_argument("--dataset", type=str, default=file_path, help="Dataset CSV, loaded and split once")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the population")
+    args = parser.parse_args()
+
+    if os.path.exists(os.path.join(args.pbt_dir, "population.json")):
+        raise FileExistsError(f"{args.pbt_dir} already contains a population, use another --pbt_dir")
+    if not os.path.exists(args.dataset):
+        raise FileNotFoundError(f"Dataset {args.dataset} not found, run digital_advertising.py once to generate it")
+    threads_per_member = args.threads_per_member or max(1, (os.cpu_count() or 1) // args.population)
+
+    # Load and split the dataset once, the members memory-map the saved panels
+    train_panel, test_panel = load_panel(args.dataset).split(train_ratio=0.8)
+    train_dir = train_panel.save(os.path.join(args.pbt_dir, "data", "train"))
+    test_dir = test_panel.save(os.path.join(args.pbt_dir, "data", "test"))
+
+    for name in ["OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"]:
+        os.environ[name] = str(threads_per_member)
+    context = multiprocessing.get_context("spawn")
+    members = [
+        context.Process(
+            target=run_member,
+            args=(member, args.pbt_dir, train_dir, test_dir, args.intervals, args.interval_steps,
+                  args.quantile, args.perturb_factor, threads_per_member, args.seed, args.population)
+        )
+        for member in range(args.population)
+    ]
+    t0 = time.time()
+    for process in members:
+        process.start()
+    for process in members:
+        process.join()
+
+    population = PBTCoordinator(args.pbt_dir).read_population()
+    if not population:
+        print("No member finished an interval")
+        return
+    best = max(population.values(), key=lambda record: record['score'])
+    print(f"Population based training finished in {time.time() - t0:.0f}s")
+    print(f"Best member: {best['member']} with test reward {best['score']:.2f} after {best['total_steps']} steps")
+    print(f"Hyperparameters: {best['params']}")
+    best_model_path = os.path.join(args.pbt_dir, f"member_{best['member']}", "best_model.pt")
+    print(f"Model: {best_model_path}, history: {os.path.join(args.pbt_dir, 'history.jsonl')}")
+    with open(os.path.join(args.pbt_dir, "result.json"), "w") as f:
+        json.dump(best, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# Temporally correlated synthetic workloads for capacity tests of the environment and the training loop.
+#
+# generate_synthetic_data draws every row independently, so its "time series" have no temporal
+# structure. This generator gives every keyword latent processes that evolve over time:
+#   - ROAS: AR(1) process (log scale) around a keyword level, with weekly seasonality
+#   - Search volume: AR(1) process (log scale) with weekly and yearly seasonality
+#   - Paid CTR: random walk with a keyword specific drift (logit scale)
+#   - Competitiveness, conversion rate and impression share: AR(1) processes
+# The observed metrics are derived from the latent state, so they are correlated the way the real
+# metrics are: clicks follow volume, CTR and impression share, the CPC follows the competitiveness,
+# ad spend is clicks x CPC, conversions follow clicks and the conversion rate, the conversion value is
+# ad spend x ROAS, and previous_recommendation reflects the ROAS of the previous step.
+#
+# All keywords are simulated as vectors. The keywords are split into chunks that are generated in
+# parallel processes and written into one memory-mapped panel (see KeywordPanel.load). Every chunk has
+# its own seed derived from the global seed and the chunk index, so the data only depends on seed,
+# chunk_keywords and block_steps, not on the number of processes. Memory per process is bounded by
+# one block (chunk_keywords x block_steps), e.g. 10^5 keywords x 10^4 steps (a 64 GB panel) can be
+# generated on a machine with little memory.
+
+import os
+import json
+import time
+import argparse
+import multiprocessing
+import numpy as np
+
+from digital_advertising import KeywordPanel, SYNTHETIC_COLUMNS, feature_columns
+
+# Column order of KeywordPanel.from_dataframe: feature columns first
+PANEL_COLUMNS = list(feature_columns) + [c for c in SYNTHETIC_COLUMNS if c not in feature_columns]
+
+# Latent processes of a keyword, in the order of the last axis of the latent state
+LATENT_PROCESSES = ["log_roas", "log_volume", "logit_ctr", "competitiveness", "logit_conversion_rate", "logit_impression_share"]
+
+
+def _sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def _logit(p):
+    return np.log(p / (1.0 - p))
+
+
+def chunk_rngs(seed, chunk_index):
+    """
+    Returns the random generators of a keyword chunk (keyword parameters, latent noise, observation
+    noise). They only depend on the global seed and the chunk index.
+    """
+    return [np.random.default_rng(s) for s in np.random.SeedSequence(seed, spawn_key=(chunk_index,)).spawn(3)]
+
+
+def keyword_parameters(rng, num_keywords):
+    """
+    Draws the static parameters of the latent processes of num_keywords keywords.
+
+    The latent state x of a keyword follows x_t = mu + phi * (x_{t-1} - mu) + drift + sigma * eps_t
+    for every process (phi = 1 is a random walk).
+
+    Returns:
+        dict: Arrays with shape [num_keywords, num_processes] (mu, phi, drift, sigma, initial state)
+            and [num_keywords] (seasonality, CPC level, difficulty)
+    """
+    k = num_keywords
+    mu = np.stack([
+        rng.normal(np.log(1.5), 0.5, k),              # log ROAS, median ROAS 1.5
+        rng.normal(np.log(2000), 1.0, k),             # log search volume per step
+        _logit(rng.uniform(0.02, 0.15, k)),           # logit paid CTR (starting level of the random walk)
+        rng.uniform(0.1, 0.9, k),                     # competitiveness
+        _logit(rng.uniform(0.02, 0.2, k)),            # logit conversion rate
+        _logit(rng.uniform(0.2, 0.9, k))              # logit impression share
+    ], axis=1)
+    phi = np.stack([
+        rng.uniform(0.85, 0.98, k),
+        rng.uniform(0.7, 0.95, k),
+        np.ones(k),                                   # CTR: random walk
+        rng.uniform(0.95, 0.995, k),
+        rng.uniform(0.8, 0.95, k),
+        rng.uniform(0.8, 0.95, k)
+    ], axis=1)
+    sigma = np.stack([
+        rng.uniform(0.05, 0.2, k),
+        rng.uniform(0.05, 0.3, k),
+        rng.uniform(0.005, 0.03, k),
+        rng.uniform(0.005, 0.02, k),
+        rng.uniform(0.02, 0.1, k),
+        rng.uniform(0.02, 0.1, k)
+    ], axis=1)
+    drift = np.zeros((k, len(LATENT_PROCESSES)))
+    drift[:, 2] = rng.normal(0.0, 2e-4, k)            # CTR drift (creative fatigue or improvement)
+
+    return {
+        'mu': mu,
+        'phi': phi,
+        'sigma': sigma,
+        'drift': drift,
+        'state': mu + sigma * rng.standard_normal(mu.shape),
+        'weekly_amplitude': rng.uniform(0.0, 0.3, k),
+        'weekly_phase': rng.uniform(0.0, 2 * np.pi, k),
+        'yearly_amplitude': rng.uniform(0.0, 0.4, k),
+        'yearly_phase': rng.uniform(0.0, 2 * np.pi, k),
+        'cpc_level': rng.lognormal(np.log(1.5), 0.6, k),
+        'difficulty': rng.beta(2.0, 2.0, k),
+        'previous_roas': np.exp(mu[:, 0])
+    }
+
+
+def simulate_block(params, latent_rng, observation_rng, start_step, steps):
+    """
+    Advances the latent processes of a keyword chunk by steps time steps and derives the metrics.
+
+    Args:
+        params (dict): Keyword parameters (see keyword_parameters), the state is updated in place
+        latent_rng: Generator of the latent noise
+        observation_rng: Generator of the observation noise
+        start_step (int): Time step of the first step of the block (for the seasonality)
+        steps (int): Number of time steps
+
+    Returns:
+        dict: Metrics by column name, arrays with shape [steps, num_keywords]
+    """
+    mu, phi, drift = params['mu'], params['phi'], params['drift']
+    noise = latent_rng.standard_normal((steps,) + mu.shape) * params['sigma']
+    latent = np.empty_like(noise)
+    x = params['state']
+    for t in range(steps):
+        x = mu + phi * (x - mu) + drift + noise[t]
+        latent[t] = x
+    params['state'] = x
+    log_roas, log_volume, logit_ctr, competitiveness, logit_cvr, logit_share = np.moveaxis(latent, -1, 0)
+
+    t = np.arange(start_step, start_step + steps, dtype=np.float64)[:, None]
+    weekly = np.sin(2 * np.pi * t / 7 + params['weekly_phase'])
+    yearly = np.sin(2 * np.pi * t / 365 + params['yearly_phase'])
+    roas = np.clip(np.exp(log_roas + 0.5 * params['weekly_amplitude'] * weekly), 0.05, 20.0)
+    volume = np.exp(log_volume + params['weekly_amplitude'] * weekly + params['yearly_amplitude'] * yearly)
+    paid_ctr = np.clip(_sigmoid(logit_ctr), 0.005, 0.5)
+    competitiveness = np.clip(competitiveness, 0.0, 1.0)
+    conversion_rate = np.clip(_sigmoid(logit_cvr), 0.001, 0.6)
+    impression_share = np.clip(_sigmoid(logit_share), 0.05, 1.0)
+
+    shape = roas.shape
+    paid_clicks = observation_rng.poisson(volume * impression_share * paid_ctr)
+    cost_per_click = params['cpc_level'] * (0.5 + competitiveness) * observation_rng.lognormal(0.0, 0.1, shape)
+    ad_spend = paid_clicks * cost_per_click
+    ad_conversions = observation_rng.binomial(paid_clicks, conversion_rate)
+    conversion_value = ad_spend * roas
+
+    difficulty = np.clip(params['difficulty'] + observation_rng.normal(0.0, 0.02, shape), 0.0, 1.0)
+    organic_rank = np.clip(np.rint(1 + 9 * difficulty + observation_rng.normal(0.0, 0.7, shape)), 1, 10)
+    organic_ctr = np.clip(0.3 / organic_rank ** 0.8 * observation_rng.lognormal(0.0, 0.1, shape), 0.005, 0.4)
+    organic_clicks = observation_rng.poisson(volume * organic_ctr)
+
+    # The recommendation of the previous step: buy if the previous ROAS was above break-even
+    previous_roas = np.concatenate([params['previous_roas'][None, :], roas[:-1]])
+    params['previous_roas'] = roas[-1]
+
+    return {
+        "competitiveness": competitiveness,
+        "difficulty_score": difficulty,
+        "organic_rank": organic_rank,
+        "organic_clicks": organic_clicks,
+        "organic_ctr": organic_ctr,
+        "paid_clicks": paid_clicks,
+        "paid_ctr": paid_ctr,
+        "ad_spend": ad_spend,
+        "ad_conversions": ad_conversions,
+        "ad_roas": roas,
+        "conversion_rate": conversion_rate,
+        "cost_per_click": cost_per_click,
+        "cost_per_acquisition": ad_spend / np.maximum(ad_conversions, 1),
+        "previous_recommendation": (previous_roas > 1.0).astype(np.float64),
+        "impression_share": impression_share,
+        "conversion_value": conversion_value
+    }
+
+
+def generate_chunk(values_path, seed, chunk_index, keyword_start, keyword_end, num_steps, block_steps):
+    """
+    Generates the keywords [keyword_start, keyword_end) and writes them into the memory-mapped values
+    of the panel, block by block.
+
+    Returns:
+        int: Number of generated rows
+    """
+    params_rng, latent_rng, observation_rng = chunk_rngs(seed, chunk_index)
+    params = keyword_parameters(params_rng, keyword_end - keyword_start)
+    values = np.load(values_path, mmap_mode="r+")
+    for start in range(0, num_steps, block_steps):
+        steps = min(block_steps, num_steps - start)
+        metrics = simulate_block(params, latent_rng, observation_rng, start, steps)
+        values[start:start + steps, keyword_start:keyword_end, :] = np.stack([metrics[c] for c in PANEL_COLUMNS], axis=-1)
+    values.flush()
+    del values
+    return (keyword_end - keyword_start) * num_steps
+
+
+def _generate_chunk(args):
+    return generate_chunk(*args)
+
+
+def generate_workload(directory, num_keywords, num_steps, seed=0, processes=None, chunk_keywords=1000, block_steps=1000,
+                      fingerprint=False):
+    """
+    Generates a temporally correlated workload and saves it as a panel directory (see KeywordPanel.load).
+
+    Args:
+        directory (str): Target directory
+        num_keywords (int): Number of keywords (Keyword_0 ... Keyword_<num_keywords - 1>)
+        num_steps (int): Number of time steps
+        seed (int): Global seed
+        processes (int, optional): Number of worker processes, defaults to the CPU count
+        chunk_keywords (int): Keywords per chunk (unit of parallelism and of the seeds)
+        block_steps (int): Time steps simulated at once (bounds the memory per process)
+        fingerprint (bool): Compute the panel fingerprint now (reads the whole panel once), otherwise
+            it is computed on first use
+
+    Returns:
+        str: The directory
+    """
+    os.makedirs(directory, exist_ok=True)
+    values_path = os.path.join(directory, KeywordPanel.VALUES_FILENAME)
+    tmp_path = f"{values_path}.{os.getpid()}.tmp.npy"
+    # Creates the .npy file with its header, the workers fill it through memory maps
+    values = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(num_steps, num_keywords, len(PANEL_COLUMNS)))
+    del values
+
+    chunks = [
+        (tmp_path, seed, chunk_index, start, min(start + chunk_keywords, num_keywords), num_steps, block_steps)
+        for chunk_index, start in enumerate(range(0, num_keywords, chunk_keywords))
+    ]
+    processes = min(processes or os.cpu_count() or 1, len(chunks))
+    t0 = time.time()
+    rows = 0
+    if processes == 1:
+        for chunk in chunks:
+            rows += generate_chunk(*chunk)
+    else:
+        context = multiprocessing.get_context("spawn")
+        with context.Pool(processes) as pool:
+            for chunk_rows in pool.imap_unordered(_generate_chunk, chunks):
+                rows += chunk_rows
+                print(f"{rows:,} of {num_keywords * num_steps:,} rows ({rows / (time.time() - t0):,.0f} rows/s)")
+    os.replace(tmp_path, values_path)
+
+    keywords = [f"Keyword_{i}" for i in range(num_keywords)]
+    meta = {'keywords': keywords, 'columns': PANEL_COLUMNS}
+    if fingerprint:
+        meta['fingerprint'] = KeywordPanel(np.load(values_path, mmap_mode="r"), keywords, PANEL_COLUMNS).fingerprint()
+    with open(os.path.join(directory, KeywordPanel.META_FILENAME), "w") as f:
+        json.dump(meta, f)
+    print(f"Generated {rows:,} rows ({num_keywords} keywords x {num_steps} steps) in {time.time() - t0:.1f}s with {processes} processes")
+    return directory
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a temporally correlated synthetic workload as a memory-mapped panel")
+    parser.add_argument("--output", type=str, default="data/workload", help="Panel directory")
+    parser.add_argument("--num_keywords", type=int, default=1000, help="Number of keywords")
+    parser.add_argument("--num_steps", type=int, default=5000, help="Number of time steps")
+    parser.add_argument("--seed", type=int, default=0, help="Global seed")
+    parser.add_argument("--processes", type=int, default=None, help="Number of worker processes (default: CPU count)")
+    parser.add_argument("--chunk_keywords", type=int, default=1000, help="Keywords per chunk (the data depends on it)")
+    parser.add_argument("--block_steps", type=int, default=1000, help="Time steps per block (the data depends on it)")
+    parser.add_argument("--fingerprint", action="store_true", help="Compute the panel fingerprint after generating")
+    args = parser.parse_args()
+
+    size_gb = args.num_keywords * args.num_steps * len(PANEL_COLUMNS) * 4 / 1e9
+    print(f"Generating {args.num_keywords} keywords x {args.num_steps} steps ({size_gb:.1f} GB) into {args.output}")
+    generate_workload(
+        args.output, args.num_keywords, args.num_steps, seed=args.seed, processes=args.processes,
+        chunk_keywords=args.chunk_keywords, block_steps=args.block_steps, fingerprint=args.fingerprint
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+# Smoke test of the decision service loader on a tiny synthetic dataset.
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("pandas")
+pytest.importorskip("torch")
+pytest.importorskip("torchrl")
+
+
+def test_load_model_fn(tmp_path):
+    import torch
+    from dataset_cache import load_panel
+    from decision_service import load_model_fn
+    from digital_advertising import AdOptimizationEnv, ModelHandler, create_policy, feature_columns, write_synthetic_dataset
+
+    num_keywords = 4
+    dataset_path = write_synthetic_dataset(str(tmp_path / "dataset.csv"), num_keywords=num_keywords, num_steps=20, seed=0)
+    env = AdOptimizationEnv(load_panel(dataset_path))
+    policy = create_policy(env, env.num_features, env.num_keywords, torch.device("cpu"))
+    model_path = ModelHandler(save_dir=str(tmp_path / "saves")).save_model(policy, metadata={'test_reward': 1.0}, filename="model.pt")
+
+    model_fn, info = load_model_fn(model_path, dataset_path)
+    assert info['num_keywords'] == num_keywords
+    assert info['keywords'] == [f"Keyword_{i}" for i in range(num_keywords)]
+    assert info['test_reward'] == 1.0
+
+    batch_size = 3
+    keyword_features = np.zeros((batch_size, num_keywords, len(feature_columns)), dtype=np.float32)
+    cash = np.full(batch_size, 100.0, dtype=np.float32)
+    holdings = np.zeros((batch_size, num_keywords), dtype=np.float32)
+    actions, q_values = model_fn(keyword_features, cash, holdings)
+    assert actions.shape == (batch_size,)
+    assert q_values.shape == (batch_size, num_keywords + 1)
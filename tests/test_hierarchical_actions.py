@@ -0,0 +1,38 @@
+# The two-level greedy decision of HierarchicalQNet must pick the argmax of its flat Q-values.
+
+import pytest
+
+np = pytest.importorskip("numpy")
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchrl")
+
+
+@pytest.mark.parametrize("keyword_groups", [
+    [0, 0, 1, 1, 2, 2],           # equal group sizes
+    [0, 1, 1, 1, 2, 0, 1, 3, 3],  # unequal group sizes (padded slots)
+    [0, 0, 0, 0],                 # a single group
+])
+def test_greedy_action_matches_forward_argmax(keyword_groups):
+    from digital_advertising import HierarchicalQNet
+
+    torch.manual_seed(0)
+    in_features = 12
+    q_net = HierarchicalQNet(in_features, np.asarray(keyword_groups), num_cells=[16, 8])
+    x = torch.randn(256, in_features)
+    with torch.no_grad():
+        assert torch.equal(q_net.greedy_action(x), q_net(x).argmax(dim=-1))
+
+        # "Buy nothing" is the last flat action and the last group of the first level
+        q_net.group_head.bias[-1] = 1e3
+        assert torch.equal(q_net.greedy_action(x), torch.full((256,), len(keyword_groups)))
+        assert torch.equal(q_net(x).argmax(dim=-1), torch.full((256,), len(keyword_groups)))
+
+
+def test_greedy_action_single_observation():
+    from digital_advertising import HierarchicalQNet
+
+    torch.manual_seed(1)
+    q_net = HierarchicalQNet(6, np.asarray([0, 1, 0, 1, 2]), num_cells=[16, 8])
+    x = torch.randn(6)
+    with torch.no_grad():
+        assert q_net.greedy_action(x).item() == q_net(x).argmax().item()
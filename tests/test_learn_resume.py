@@ -0,0 +1,43 @@
+# learn continued from its training state counts the budget from the start of the first run.
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("pandas")
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchrl")
+
+
+class NullWriter:
+    """TensorBoard writer that drops everything."""
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: None
+
+
+def test_resumed_learn_continues_frame_and_step_counts(tmp_path):
+    from digital_advertising import generate_synthetic_panel, learn
+
+    train_data, test_data = generate_synthetic_panel(num_keywords=4, num_steps=200, seed=0).split(train_ratio=0.8)
+    state_path = str(tmp_path / "training_state.pt")
+    common = dict(train_data=train_data, test_data=test_data, device=torch.device("cpu"), writer=NullWriter(),
+                  save_dir=str(tmp_path / "saves"), max_steps=None, final_inference=False)
+
+    # 5000 random warm-up frames, then 1000 training steps (10 optim steps of 100 frames) per batch
+    torch.manual_seed(0)
+    first_stats = {}
+    first_reward = learn(max_frames=5200, training_state_path=state_path, stats=first_stats, **common)
+    first_state = torch.load(state_path)
+    assert first_state['total_frames'] == 5200
+    assert first_state['total_count'] == 2000
+    assert first_state['best_test_reward'] == first_reward
+    assert first_stats['frames'] == 5200
+
+    # The resumed run only collects the frames that are missing, its replay buffer is already filled
+    second_stats = {}
+    second_reward = learn(max_frames=5400, resume_from=state_path, training_state_path=state_path, stats=second_stats, **common)
+    second_state = torch.load(state_path)
+    assert second_stats['frames'] == 200
+    assert second_state['total_frames'] == 5400
+    assert second_state['total_count'] == 4000
+    assert second_reward >= first_reward
@@ -0,0 +1,215 @@
+# ModelHandler: manifest, retention and deduplication. Any nn.Module works as policy here.
+
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("pandas")
+torch = pytest.importorskip("torch")
+
+
+def make_policy(seed=0):
+    torch.manual_seed(seed)
+    return torch.nn.Linear(4, 3)
+
+
+def test_dedup_rebuild_keeps_per_file_metadata(tmp_path):
+    from digital_advertising import ModelHandler
+
+    handler = ModelHandler(save_dir=str(tmp_path), keep_top_k=2, keep_last_n=1, compress=True, dedup=True)
+    policy = make_policy()
+    paths = {reward: handler.save_model(policy, metadata={'test_reward': reward, 'total_steps': step}, filename=f"model_{step}.pt")
+             for step, reward in enumerate([1.0, 5.0, 3.0, 2.0, 4.0])}
+    best_path = handler.save_model(policy, metadata={'test_reward': 0.5}, filename="best_model.pt")
+    # All files share the weights (and the embedded metadata) of the first one
+    assert os.path.samefile(paths[5.0], best_path)
+
+    os.remove(handler.manifest_path)
+    assert handler.find_best_model() == paths[5.0]
+    assert handler.get_metadata(paths[5.0])['test_reward'] == 5.0
+    assert handler.get_metadata(best_path)['test_reward'] == 0.5
+    assert handler.read_manifest()['best_model.pt']['test_reward'] == 0.5
+
+    # Without the manifest, loading reads the metadata of the file itself as well
+    os.remove(handler.manifest_path)
+    _, metadata = handler.load_model(make_policy(1), paths[4.0], torch.device("cpu"))
+    assert metadata['test_reward'] == 4.0
+
+
+def test_overwriting_deduplicated_model_drops_its_metadata_file(tmp_path):
+    from digital_advertising import ModelHandler
+
+    handler = ModelHandler(save_dir=str(tmp_path), dedup=True)
+    handler.save_model(make_policy(0), metadata={'test_reward': 1.0}, filename="first.pt")
+    path = handler.save_model(make_policy(0), metadata={'test_reward': 2.0}, filename="second.pt")
+    assert os.path.exists(handler.metadata_path(path))
+
+    handler.save_model(make_policy(1), metadata={'test_reward': 3.0}, filename="second.pt")
+    assert not os.path.exists(handler.metadata_path(path))
+    assert handler.get_metadata(path)['test_reward'] == 3.0
+
+
+def test_manifest_records_saved_models(tmp_path):
+    from digital_advertising import ModelHandler
+
+    handler = ModelHandler(save_dir=str(tmp_path))
+    low = handler.save_model(make_policy(0), metadata={'test_reward': 1.0, 'total_steps': 100, 'hyperparameters': {'lr': 0.01}})
+    high = handler.save_model(make_policy(1), metadata={'test_reward': 2.0, 'total_steps': 200}, filename="high")
+
+    manifest = handler.read_manifest()
+    assert set(manifest) == {os.path.basename(low), "high.pt"}
+    entry = manifest["high.pt"]
+    assert entry['test_reward'] == 2.0
+    assert entry['step'] == 200
+    assert entry['size'] == os.path.getsize(high)
+    assert manifest[os.path.basename(low)]['hyperparameters'] == {'lr': 0.01}
+    assert [entry['filename'] for entry in handler.list_models()] == ["high.pt", os.path.basename(low)]
+    assert handler.find_best_model() == high
+
+
+def test_find_best_model_rebuilds_missing_manifest(tmp_path):
+    from digital_advertising import ModelHandler
+
+    handler = ModelHandler(save_dir=str(tmp_path))
+    best = handler.save_model(make_policy(0), metadata={'test_reward': 3.0}, filename="a.pt")
+    handler.save_model(make_policy(1), metadata={'test_reward': 1.0}, filename="b.pt")
+    # Derived models are never the best model
+    handler.save_model(make_policy(2), metadata={'test_reward': 9.0, 'distillation': {'teacher': 'a.pt'}}, filename="student.pt")
+    os.remove(handler.manifest_path)
+
+    assert handler.find_best_model() == best
+    assert set(handler.read_manifest()) == {"a.pt", "b.pt", "student.pt"}
+
+
+def test_manifest_updates_from_several_threads(tmp_path):
+    import threading
+    from digital_advertising import ModelHandler
+
+    handler = ModelHandler(save_dir=str(tmp_path))
+    threads = [
+        threading.Thread(target=handler.update_manifest, args=({f"model_{i}.pt": {'filename': f"model_{i}.pt"}},))
+        for i in range(16)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert set(handler.read_manifest()) == {f"model_{i}.pt" for i in range(16)}
+    assert not os.path.exists(handler.manifest_path + '.lock')
+
+
+def test_stale_manifest_lock_is_removed(tmp_path):
+    import time
+    from digital_advertising import ModelHandler
+
+    handler = ModelHandler(save_dir=str(tmp_path))
+    lock_path = handler.manifest_path + '.lock'
+    open(lock_path, 'w').close()
+    old = time.time() - 60
+    os.utime(lock_path, (old, old))
+
+    handler.update_manifest({"a.pt": {'filename': "a.pt"}})
+    assert set(handler.read_manifest()) == {"a.pt"}
+    assert not os.path.exists(lock_path)
+
+
+def test_manifest_lock_times_out(tmp_path):
+    import time
+    from digital_advertising import ModelHandler
+
+    handler = ModelHandler(save_dir=str(tmp_path))
+    lock_path = handler._lock_manifest()
+    # A lock that is held (and kept fresh) by another process
+    fresh = time.time() + 60
+    os.utime(lock_path, (fresh, fresh))
+    try:
+        with pytest.raises(TimeoutError):
+            handler._lock_manifest(timeout=0.05)
+    finally:
+        os.remove(lock_path)
+
+
+def test_async_checkpoint_writer_saves_snapshot(tmp_path):
+    from digital_advertising import AsyncCheckpointWriter, ModelHandler
+
+    handler = ModelHandler(save_dir=str(tmp_path))
+    writer = AsyncCheckpointWriter(handler)
+    policy = make_policy()
+    expected = {name: value.clone() for name, value in policy.state_dict().items()}
+    path = writer.submit(policy, metadata={'test_reward': 1.0}, filename="best_model.pt")
+    with torch.no_grad():
+        policy.weight.add_(1.0)  # Training continues while the checkpoint is written
+    writer.flush()
+
+    checkpoint = handler.load_checkpoint(path)
+    assert all(torch.equal(checkpoint['policy_state_dict'][name], value) for name, value in expected.items())
+    assert handler.read_manifest()["best_model.pt"]['test_reward'] == 1.0
+
+    writer.close()
+    with pytest.raises(RuntimeError):
+        writer.submit(policy, filename="best_model.pt")
+
+
+def test_async_checkpoint_writer_coalesces_pending_snapshots(tmp_path):
+    from digital_advertising import AsyncCheckpointWriter, ModelHandler
+
+    handler = ModelHandler(save_dir=str(tmp_path))
+    writer = AsyncCheckpointWriter(handler)
+    # Holding the condition keeps the writer thread from taking the snapshots in between
+    with writer._condition:
+        for reward in [1.0, 2.0, 3.0]:
+            writer.submit(make_policy(), metadata={'test_reward': reward}, filename="best_model.pt")
+    writer.close()
+
+    assert writer.num_submitted == 3
+    assert writer.num_coalesced == 2
+    assert handler.get_metadata(os.path.join(str(tmp_path), "best_model.pt"))['test_reward'] == 3.0
+
+
+def test_inference_weights_round_trip(tmp_path):
+    from digital_advertising import ModelHandler
+
+    handler = ModelHandler(save_dir=str(tmp_path))
+    policy = make_policy()
+    path = handler.save_model(policy, metadata={'test_reward': 2.5}, filename="best_model.pt")
+    weights_path = handler.export_inference_weights(path)
+    assert weights_path.endswith(ModelHandler.INFERENCE_WEIGHTS_SUFFIX)
+
+    loaded, metadata = handler.load_model(make_policy(1), weights_path, torch.device("cpu"), inference_only=True)
+    assert metadata['test_reward'] == 2.5
+    assert metadata['source_checkpoint'] == "best_model.pt"
+    assert handler.get_metadata(weights_path)['test_reward'] == 2.5
+    assert all(torch.equal(loaded.state_dict()[name], value) for name, value in policy.state_dict().items())
+    assert not loaded.training
+
+
+def test_inference_weights_mixed_dtypes(tmp_path):
+    from digital_advertising import load_inference_weights, save_inference_weights
+
+    state_dict = {
+        'half': torch.arange(3, dtype=torch.float16),
+        'double': torch.arange(5, dtype=torch.float64).reshape(5, 1),
+        'mask': torch.tensor([True, False, True]),
+        'index': torch.arange(7, dtype=torch.int64),
+        'weight': torch.randn(2, 3)
+    }
+    path = str(tmp_path / "weights.safetensors")
+    save_inference_weights(state_dict, path, metadata={'num_cells': [8, 4]})
+
+    loaded, metadata = load_inference_weights(path)
+    assert metadata == {'num_cells': [8, 4]}
+    assert set(loaded) == set(state_dict)
+    for name, value in state_dict.items():
+        assert loaded[name].dtype == value.dtype
+        assert torch.equal(loaded[name], value)
+        # Every tensor is aligned to its element size inside the mapping
+        assert loaded[name].data_ptr() % value.element_size() == 0
+
+
+def test_quantized_weights_are_rejected(tmp_path):
+    from digital_advertising import save_inference_weights
+
+    with pytest.raises(ValueError):
+        save_inference_weights({'scale': torch.quantize_per_tensor(torch.ones(2), 0.1, 0, torch.qint8)}, str(tmp_path / "q.safetensors"))
@@ -0,0 +1,53 @@
+# Observations handed out by AdOptimizationEnv must not change when a consumer keeps them.
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("pandas")
+torch = pytest.importorskip("torch")
+pytest.importorskip("torchrl")
+
+
+def reference_observations(env, policy, num_steps):
+    """Greedy rollout that clones every observation before the next step."""
+    from torchrl.envs.utils import step_mdp
+
+    observations = []
+    td = env.reset()
+    for _ in range(num_steps):
+        observations.append(td["observation", "flat"].clone())
+        with torch.no_grad():
+            td = policy(td)
+        td = step_mdp(env.step(td))
+    return torch.stack(observations)
+
+
+@pytest.mark.parametrize("observation_slots", [None, 2 * 8 + 2])
+def test_collector_observations_match_cloned_rollout(tmp_path, observation_slots):
+    from torchrl.collectors import SyncDataCollector
+    from dataset_cache import load_panel
+    from digital_advertising import AdOptimizationEnv, create_policy, write_synthetic_dataset
+
+    frames_per_batch = 8
+    panel = load_panel(write_synthetic_dataset(str(tmp_path / "dataset.csv"), num_keywords=4, num_steps=20, seed=0))
+    env = AdOptimizationEnv(panel, observation_slots=observation_slots)
+    torch.manual_seed(0)
+    policy = create_policy(env, env.num_features, env.num_keywords, torch.device("cpu"))
+
+    collector = SyncDataCollector(env, policy, frames_per_batch=frames_per_batch, total_frames=frames_per_batch)
+    batch = next(iter(collector))
+    collector.shutdown()
+
+    expected = reference_observations(AdOptimizationEnv(panel), policy, frames_per_batch)
+    collected = batch["observation", "flat"].reshape(frames_per_batch, -1)
+    assert torch.equal(collected, expected)
+    assert len({tuple(row.tolist()) for row in collected}) == frames_per_batch
+
+
+def test_too_few_observation_slots(tmp_path):
+    from dataset_cache import load_panel
+    from digital_advertising import AdOptimizationEnv, write_synthetic_dataset
+
+    panel = load_panel(write_synthetic_dataset(str(tmp_path / "dataset.csv"), num_keywords=4, num_steps=20, seed=0))
+    with pytest.raises(ValueError):
+        AdOptimizationEnv(panel, observation_slots=1)
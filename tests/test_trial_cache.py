@@ -0,0 +1,74 @@
+# TrialCache: results are keyed on normalized parameters, dataset, code version, seed and budget.
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("pandas")
+pytest.importorskip("torch")
+pytest.importorskip("matplotlib")
+pytest.importorskip("seaborn")
+optuna = pytest.importorskip("optuna")
+
+PARAMS = {
+    'lr': 0.001, 'batch_size': 64, 'exploration_eps_init': 0.9, 'exploration_eps_end': 0.05,
+    'softupdate_eps': 0.95, 'gamma': 0.97, 'weight_decay': 1e-5
+}
+BUDGET = {'max_steps': 10_000}
+
+
+def test_lookup_matches_normalized_params(tmp_path):
+    from hyperparameter_tuning import TrialCache
+
+    cache = TrialCache(str(tmp_path / "cache" / "trial_cache.db"))
+    assert cache.lookup(PARAMS, "data", "code", 0, BUDGET) is None
+
+    cache.store(PARAMS, "data", "code", 0, BUDGET, reward=12.5, user_attrs={'train_time': 3.0},
+                model_path="saves/trial_1/best_model.pt", study_name="study", trial_number=1)
+    # Key order and float noise (e.g. from a database round trip) do not matter
+    same_params = {name: PARAMS[name] for name in reversed(list(PARAMS))}
+    same_params['lr'] = 0.001 + 1e-17
+    entry = cache.lookup(same_params, "data", "code", 0, BUDGET)
+    assert entry['reward'] == 12.5
+    assert entry['params'] == PARAMS
+    assert entry['user_attrs'] == {'train_time': 3.0}
+    assert (entry['model_path'], entry['study_name'], entry['trial_number']) == ("saves/trial_1/best_model.pt", "study", 1)
+
+    # Every other part of the key is a different result
+    assert cache.lookup({**PARAMS, 'lr': 0.002}, "data", "code", 0, BUDGET) is None
+    assert cache.lookup(PARAMS, "other data", "code", 0, BUDGET) is None
+    assert cache.lookup(PARAMS, "data", "other code", 0, BUDGET) is None
+    assert cache.lookup(PARAMS, "data", "code", 1, BUDGET) is None
+    assert cache.lookup(PARAMS, "data", "code", 0, {'rungs': [6000, 18000]}) is None
+
+
+def test_store_replaces_result_and_entries_filter(tmp_path):
+    from hyperparameter_tuning import TrialCache
+
+    path = str(tmp_path / "trial_cache.db")
+    cache = TrialCache(path)
+    cache.store(PARAMS, "data", "code", 0, BUDGET, reward=1.0, user_attrs={})
+    cache.store(PARAMS, "data", "code", 0, BUDGET, reward=2.0, user_attrs={})
+    cache.store({**PARAMS, 'gamma': 0.9}, "data", "code", 0, BUDGET, reward=3.0, user_attrs={})
+    cache.store(PARAMS, "data", "code", 0, {'rungs': [6000, 18000]}, reward=4.0, user_attrs={})
+
+    # A second instance (e.g. another worker process) sees the same results
+    entries = TrialCache(path).entries("data", "code", 0, BUDGET)
+    assert [entry['reward'] for entry in entries] == [2.0, 3.0]
+
+
+def test_warm_start_adds_cached_trials_once(tmp_path):
+    from hyperparameter_tuning import TrialCache, warm_start
+
+    cache = TrialCache(str(tmp_path / "trial_cache.db"))
+    cache.store(PARAMS, "data", "code", 0, BUDGET, reward=5.0, user_attrs={}, study_name="old", trial_number=3)
+    # Outside the search space (an older search space), never added
+    cache.store({**PARAMS, 'gamma': 0.5}, "data", "code", 0, BUDGET, reward=9.0, user_attrs={})
+
+    study = optuna.create_study(direction="maximize")
+    assert warm_start(study, cache, "data", "code", 0, BUDGET) == 1
+    assert warm_start(study, cache, "data", "code", 0, BUDGET) == 0
+
+    (trial,) = study.get_trials()
+    assert trial.value == 5.0
+    assert trial.params == PARAMS
+    assert trial.user_attrs['cached_from'] == "old/3"
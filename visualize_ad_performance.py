@@ -18,6 +18,7 @@ from collections import defaultdict
 import re
 import sys
 import traceback
+from dataset_cache import load_dataset
 
 # On Windows, there is a problem OMP: Error #15: Initializing libiomp5md.dll, but found libiomp5md.dll already initialized.
 os.environ["KMP_DUPLICATE_LIB_OK"] = "TRUE"
@@ -1488,10 +1489,10 @@ def main():
         
         if os.path.exists(default_dataset_path):
             print(f"Loading dataset from {default_dataset_path}")
-            dataset = pd.read_csv(default_dataset_path)
+            dataset = load_dataset(default_dataset_path)
         elif args.dataset and os.path.exists(args.dataset):
             print(f"Loading dataset from {args.dataset}")
-            dataset = pd.read_csv(args.dataset)
+            dataset = load_dataset(args.dataset)
         else:
             print(f"Warning: Neither {default_dataset_path} nor {args.dataset} exist.")
             print(f"Generating synthetic dataset with {args.num_samples} samples")